@@ -0,0 +1,294 @@
+import logging
+import os
+import re
+import shutil
+import threading
+
+from daemon.config import DaemonConfig, Shared
+
+log = logging.getLogger(__name__)
+
+APPCDS_ARCHIVE = 'uni.jsa'
+# Директория стенда смонтирована в контейнер в /usr/local/uni
+APPCDS_OPTS = '-XX:+AutoCreateSharedArchive -XX:SharedArchiveFile=/usr/local/uni/cds/' + APPCDS_ARCHIVE
+
+# Распакованная сборка в кэше и точка монтирования всего кэша в контейнере
+BUILD_TREE = 'webapp'
+BUILDS_MOUNT = '/usr/local/builds'
+_BUILD_VERSION = 'version.txt'
+
+# Рабочая директория томката со скомпилированными JSP, монтируется из директории стенда
+TOMCAT_WORK = 'work'
+TOMCAT_WORK_MOUNT = '/usr/local/tomcat/work'
+# Файл с идентификатором сборки, для которой скомпилированы JSP в рабочей директории стенда
+_WORK_BUILD = '.build'
+# Сессии в рабочей директории принадлежат стенду и в кэш не попадают
+_WORK_IGNORE = shutil.ignore_patterns(_WORK_BUILD, 'SESSIONS.ser', '*.tmp')
+
+
+def build_id(project, build_number) -> str:
+    """
+    :return: идентификатор сборки дженкинса, пригодный для имени директории
+    """
+    return '{}_{}'.format(re.sub(r'[^\w.\-]', '_', project), build_number)
+
+
+def _publish(src, dst):
+    """
+    Атомарно положить файл src в dst. Жесткая ссылка, если файлы на одном разделе, иначе копия
+    """
+    tmp_path = dst + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class BuildCache:
+    """
+    Общие для стендов одной сборки дженкинса файлы в build_cache_dir/<сборка>.
+    Архив AppCDS создает JVM первого стенда сборки при остановке, остальные стенды сборки получают его перед
+    запуском. Устаревший архив JVM не использует и создает заново, новый архив заменяет старый в кэше.
+    Рабочая директория томката со скомпилированными JSP копируется в кэш после остановки стенда и в стенды
+    той же сборки перед запуском. Копия, а не ссылка: Jasper перезаписывает файлы на месте.
+    Распакованная сборка хранится один раз и монтируется в контейнеры только для чтения, webapp стенда -
+    ссылка на нее по пути внутри контейнера. Смена сборки - подмена ссылки
+    """
+
+    def __init__(self, config: DaemonConfig):
+        self.cache_dir = config.build_cache_dir
+        self.appcds = config.appcds and bool(self.cache_dir)
+        self.tomcat_work = config.tomcat_work_cache and bool(self.cache_dir)
+        self.shared_builds = config.shared_builds and bool(self.cache_dir)
+        self._work_lock = threading.Lock()
+        self._build_locks = {}
+        self._build_locks_lock = threading.Lock()
+        # Функция -> множество сборок, на которых есть стенды. Ее задает менеджер стендов
+        self.used_builds = None
+
+    def _path(self, build, file_name):
+        return os.path.join(self.cache_dir, build, file_name)
+
+    @staticmethod
+    def _stand_archive(stand):
+        return os.path.join(stand.stand_dir, 'cds', APPCDS_ARCHIVE)
+
+    def install(self, stand):
+        """
+        Перед запуском положить стенду файлы его сборки из кэша
+        """
+        if not stand.build_id:
+            return
+        if self.appcds:
+            self._install_archive(stand)
+        if self.tomcat_work:
+            self._install_work(stand)
+
+    def collect(self, stand):
+        """
+        После остановки сохранить в кэш файлы, которые стенд создал для своей сборки
+        """
+        if not stand.build_id:
+            return
+        if self.appcds:
+            self._collect_archive(stand)
+        if self.tomcat_work:
+            self._collect_work(stand)
+
+    def _install_archive(self, stand):
+        """
+        Архив сборки из кэша, если он новее архива стенда
+        """
+        cached = self._path(stand.build_id, APPCDS_ARCHIVE)
+        local = self._stand_archive(stand)
+        try:
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            if os.path.isfile(cached) and \
+                    (not os.path.isfile(local) or os.path.getmtime(cached) > os.path.getmtime(local)):
+                log.info('Install AppCDS archive of build %s to %s', stand.build_id, stand.name)
+                _publish(cached, local)
+        except OSError as e:
+            log.warning('Cannot install AppCDS archive to %s: %s', stand.name, e)
+
+    def _collect_archive(self, stand):
+        """
+        Архив, который JVM стенда создала заново
+        """
+        cached = self._path(stand.build_id, APPCDS_ARCHIVE)
+        local = self._stand_archive(stand)
+        try:
+            if not os.path.isfile(local):
+                return
+            if os.path.isfile(cached) and os.path.getmtime(cached) >= os.path.getmtime(local):
+                return
+            log.info('Save AppCDS archive of %s for build %s', stand.name, stand.build_id)
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            _publish(local, cached)
+        except OSError as e:
+            log.warning('Cannot save AppCDS archive of %s: %s', stand.name, e)
+
+    @staticmethod
+    def _work_build(work_dir):
+        path = os.path.join(work_dir, _WORK_BUILD)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rt') as f:
+            return f.read().strip()
+
+    @staticmethod
+    def _count_files(path) -> int:
+        """
+        :return: количество файлов, которые попадают в кэш
+        """
+        return sum(len(files) - len(_WORK_IGNORE(root, files)) for root, _, files in os.walk(path))
+
+    @staticmethod
+    def _clear_dir(path):
+        # Сама директория смонтирована в контейнер и должна остаться на месте
+        for name in os.listdir(path):
+            child = os.path.join(path, name)
+            if os.path.isdir(child) and not os.path.islink(child):
+                shutil.rmtree(child)
+            else:
+                os.remove(child)
+
+    def _install_work(self, stand):
+        """
+        Рабочая директория томката из кэша, если JSP стенда скомпилированы для другой сборки.
+        Директории нет у контейнеров, созданных без монтирования work
+        """
+        local = os.path.join(stand.stand_dir, TOMCAT_WORK)
+        cached = self._path(stand.build_id, TOMCAT_WORK)
+        try:
+            if not os.path.isdir(local) or self._work_build(local) == stand.build_id:
+                return
+            self._clear_dir(local)
+            if os.path.isdir(cached):
+                log.info('Install compiled JSP of build %s to %s', stand.build_id, stand.name)
+                for name in os.listdir(cached):
+                    src = os.path.join(cached, name)
+                    if os.path.isdir(src):
+                        shutil.copytree(src, os.path.join(local, name))
+                    else:
+                        shutil.copy2(src, local)
+            with open(os.path.join(local, _WORK_BUILD), 'wt') as f:
+                f.write(stand.build_id)
+        except OSError as e:
+            log.warning('Cannot install compiled JSP to %s: %s', stand.name, e)
+
+    def _collect_work(self, stand):
+        """
+        Рабочая директория томката, если стенд скомпилировал больше JSP, чем есть в кэше
+        """
+        local = os.path.join(stand.stand_dir, TOMCAT_WORK)
+        cached = self._path(stand.build_id, TOMCAT_WORK)
+        try:
+            if not os.path.isdir(local) or self._work_build(local) != stand.build_id:
+                return
+            if self._count_files(local) <= (self._count_files(cached) if os.path.isdir(cached) else 0):
+                return
+            log.info('Save compiled JSP of %s for build %s', stand.name, stand.build_id)
+            with self._work_lock:
+                tmp_path = cached + '.tmp'
+                if os.path.isdir(tmp_path):
+                    shutil.rmtree(tmp_path)
+                os.makedirs(os.path.dirname(cached), exist_ok=True)
+                shutil.copytree(local, tmp_path, ignore=_WORK_IGNORE)
+                if os.path.isdir(cached):
+                    shutil.rmtree(cached)
+                os.rename(tmp_path, cached)
+        except OSError as e:
+            log.warning('Cannot save compiled JSP of %s: %s', stand.name, e)
+
+    def _build_lock(self, build) -> threading.Lock:
+        with self._build_locks_lock:
+            return self._build_locks.setdefault(build, threading.Lock())
+
+    def get_build(self, jenkins, project, build_number, webapp_dir) -> str:
+        """
+        Распаковать сборку в кэш, если ее там нет, и сослаться на нее из webapp стенда
+        :param jenkins: Jenkins стенда
+        :param webapp_dir: директория webapp стенда, будет заменена ссылкой
+        :return: описание версии сборки
+        """
+        build = build_id(project, build_number)
+        tree = self._path(build, BUILD_TREE)
+        version_path = self._path(build, _BUILD_VERSION)
+
+        with self._build_lock(build):
+            if not os.path.isfile(version_path):
+                log.info('Extract build %s to build cache', build)
+                tmp_path = tree + '.tmp'
+                os.makedirs(os.path.dirname(tree), exist_ok=True)
+                version = jenkins.get_build(project, tmp_path, build_number)
+                # Распакованной сборки достаточно, war только занимает место
+                war_file = os.path.join(tmp_path, 'last_build.war')
+                if os.path.isfile(war_file):
+                    os.remove(war_file)
+                if os.path.isdir(tree):
+                    shutil.rmtree(tree)
+                os.rename(tmp_path, tree)
+                with open(version_path, 'wt') as f:
+                    f.write(version)
+            with open(version_path, 'rt') as f:
+                version = f.read()
+
+        if os.path.isdir(webapp_dir) and not os.path.islink(webapp_dir):
+            log.info('Replace own copy of build in %s with shared build', webapp_dir)
+            shutil.rmtree(webapp_dir)
+        # Ссылка разрешается внутри контейнера, где кэш смонтирован в BUILDS_MOUNT
+        tmp_link = webapp_dir + '.tmp'
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink('/'.join((BUILDS_MOUNT, build, BUILD_TREE)), tmp_link)
+        os.replace(tmp_link, webapp_dir)
+        return version
+
+    def invalidate(self, stand):
+        """
+        Удалить файлы стенда после смены сборки
+        """
+        local = self._stand_archive(stand)
+        if os.path.isfile(local):
+            log.info('Remove AppCDS archive of %s', stand.name)
+            os.remove(local)
+        work_dir = os.path.join(stand.stand_dir, TOMCAT_WORK)
+        if os.path.isdir(work_dir):
+            log.info('Remove compiled JSP of %s', stand.name)
+            self._clear_dir(work_dir)
+
+    def release(self, build):
+        """
+        Удалить из кэша сборку, с которой ушел последний стенд. Без менеджера стендов неизвестно, кто еще
+        ссылается на сборку, тогда ее удалит prune при запуске демона
+        """
+        if not self.cache_dir or not build or self.used_builds is None:
+            return
+        with self._build_lock(build):
+            if build in self.used_builds():
+                return
+            path = os.path.join(self.cache_dir, build)
+            if os.path.isdir(path):
+                log.info('Remove build %s from build cache', build)
+                shutil.rmtree(path, ignore_errors=True)
+
+    def prune(self, used_builds):
+        """
+        Удалить из кэша сборки, на которых нет ни одного стенда
+        """
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return
+        for build in os.listdir(self.cache_dir):
+            if build not in used_builds:
+                log.info('Remove build %s from build cache', build)
+                shutil.rmtree(os.path.join(self.cache_dir, build), ignore_errors=True)
+
+
+_shared = Shared(BuildCache)
+
+
+def shared(config=None) -> BuildCache:
+    return _shared.get(config)
@@ -0,0 +1,130 @@
+import itertools
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from daemon.exceptions import TaskCancelled
+
+log = logging.getLogger(__name__)
+
+
+class CancelToken:
+    """
+    Флаг отмены задачи. Длинные операции проверяют его между шагами, а на время блокирующих вызовов
+    регистрируют, как их прервать: убить процесс, завершить сессию mssql и т.п.
+    """
+
+    def __init__(self):
+        self.reason = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._handlers = {}
+        self._ids = itertools.count()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason='Task is cancelled'):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            handlers = list(self._handlers.values())
+        log.info('Cancel: %s', reason)
+        for handler in handlers:
+            try:
+                handler()
+            except Exception:
+                log.exception('Cancel handler failed')
+
+    def check(self):
+        """
+        :raise TaskCancelled: если задача отменена
+        """
+        if self._event.is_set():
+            raise TaskCancelled(self.reason)
+
+    def wait(self, seconds) -> bool:
+        """
+        Подождать seconds секунд или отмены
+        :return: отменена ли задача
+        """
+        return self._event.wait(seconds)
+
+    def sleep(self, seconds):
+        """
+        time.sleep, который прерывается отменой
+        """
+        if self.wait(seconds):
+            self.check()
+
+    @contextmanager
+    def on_cancel(self, handler):
+        """
+        На время блока отмена вызывает handler(). Если задача уже отменена, handler вызывается сразу
+        """
+        with self._lock:
+            handler_id = next(self._ids)
+            self._handlers[handler_id] = handler
+            cancelled = self._event.is_set()
+        if cancelled:
+            handler()
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._handlers[handler_id]
+
+
+class _NeverCancelled(CancelToken):
+    """
+    Токен вне задачи: операции, запущенные не из задачи, отменить нельзя
+    """
+
+    def cancel(self, reason='Task is cancelled'):
+        raise RuntimeError('Operation outside of task cannot be cancelled')
+
+    @contextmanager
+    def on_cancel(self, handler):
+        yield
+
+
+NEVER = _NeverCancelled()
+_local = threading.local()
+
+
+def current() -> CancelToken:
+    """
+    :return: токен задачи, которая выполняется в текущем потоке
+    """
+    return getattr(_local, 'token', None) or NEVER
+
+
+@contextmanager
+def activate(token):
+    """
+    Сделать token текущим для потока на время блока. None - блок нельзя отменить, например откат после отмены
+    """
+    previous = getattr(_local, 'token', None)
+    _local.token = token
+    try:
+        yield
+    finally:
+        _local.token = previous
+
+
+def bind(func):
+    """
+    Передать текущий токен в функцию, которая выполнится в другом потоке
+    """
+    token = current()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with activate(token):
+            return func(*args, **kwargs)
+
+    return wrapper
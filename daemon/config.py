@@ -1,5 +1,6 @@
 import logging
 import os
+import threading
 
 from configparser import ConfigParser, NoOptionError
 
@@ -19,6 +20,72 @@ class DaemonConfig(object):
         self.start_port = -1
         self.ports = -1
         self.stop_by_timeout = True
+        # Очередь запусков при исчерпании max_active_stands: сколько секунд ждать места и политика освобождения
+        # start_evict_policy: none - только ждать, lru - останавливать стенд, к которому дольше всех не обращались
+        # и не обращались start_evict_idle_minutes минут
+        self.start_queue_timeout = -1
+        self.start_evict_policy = 'undefined'
+        self.start_evict_idle_minutes = -1
+        # Допуск запусков по доступной памяти хоста вместо max_active_stands. Память java сверх -Xmx,
+        # ограничение контейнера pgdocker, неприкосновенный запас хоста и куча для стендов без -Xmx, в мегабайтах
+        self.memory_admission = True
+        self.memory_jvm_overhead_mb = -1
+        self.memory_pgdocker_mb = -1
+        self.memory_reserve_mb = -1
+        self.memory_default_heap_mb = -1
+        # Остановка простаивающих стендов: через сколько минут без активности (0 - не останавливать),
+        # интервал замеров в секундах, сетевой трафик за интервал в байтах и загрузка ядра в процентах,
+        # выше которых стенд считается активным
+        self.idle_stop_minutes = -1
+        self.idle_sample_seconds = -1
+        self.idle_net_bytes = -1
+        self.idle_cpu_percent = -1
+        # Заморозка вместо остановки: стенды, к которым обращались в последние pause_recent_minutes минут
+        # (0 - всегда останавливать), замораживаются. Замороженный стенд останавливается через pause_max_minutes
+        # минут или когда доступной памяти хоста меньше pause_min_free_mb мегабайт. Интервал проверки в секундах
+        self.pause_recent_minutes = -1
+        self.pause_max_minutes = -1
+        self.pause_min_free_mb = -1
+        self.pause_check_seconds = -1
+
+        # Пул клиентов докера: количество keep-alive соединений и таймаут одного запроса в секундах
+        self.docker_pool_size = -1
+        self.docker_timeout = -1
+
+        # Прокси к стендам /p/<стенд>/ и <стенд>.<proxy_domain> (пусто - без маршрутизации по Host): таймаут
+        # запроса и ожидания запуска стенда в секундах, через сколько минут остановить запущенный прокси стенд
+        self.proxy_domain = 'undefined'
+        self.proxy_timeout = -1
+        self.proxy_start_timeout = -1
+        self.proxy_stop_minutes = -1
+
+        # Монитор веб-интерфейса стендов: минимальный и максимальный интервал проверки и время запуска томката
+        # в секундах, количество ошибок подряд, после которого стенд считается недоступным
+        self.health_interval = -1
+        self.health_max_interval = -1
+        self.health_startup_timeout = -1
+        self.health_failures = -1
+        self.health_probe_timeout = -1
+
+        # Поток событий /events: сколько последних событий помнить для отставших клиентов
+        self.events_buffer = -1
+
+        # Очередь задач: через сколько минут ожидания задача поднимается на класс приоритета (0 - не поднимается)
+        self.task_aging_minutes = -1
+
+        # Ограничение ввода-вывода и процессора для бэкапов, восстановления и reduce. Меняется на лету через /throttle
+        # throttle_io_class: 0 - не ограничивать, 2 - best-effort, 3 - idle
+        self.throttle_io_class = -1
+        self.throttle_io_level = -1
+        self.throttle_cpu_nice = -1
+        self.throttle_blkio_weight = -1
+        self.throttle_bytes_per_sec = -1
+
+        # Проверка места на диске перед бэкапом и восстановлением: запас к оценке в процентах,
+        # сколько секунд ждать освобождения места и через сколько дней можно удалять бэкапы с метками (0 - никогда)
+        self.disk_margin_percent = -1
+        self.disk_wait_timeout = -1
+        self.disk_backup_retention_days = -1
 
         # Базы данных, таймауты в секундах
         self.backup_timeout = -1
@@ -37,6 +104,10 @@ class DaemonConfig(object):
         self.postgres_pass = 'undefined'
         self.postgres_backup_dir = 'undefined'
         self.postgres_ignore_restore_errors = True
+        # chunked - удалять блобы пачками и переписывать только databasefile_t, full - vacuum full всей базы
+        self.postgres_reduce_mode = 'undefined'
+        self.postgres_reduce_batch = -1
+        self.postgres_reduce_workers = -1
 
         self.pgdocker_start_port = -1
         self.pgdocker_ports = -1
@@ -52,6 +123,34 @@ class DaemonConfig(object):
         self.mssql_pass = 'undefined'
         self.mssql_backup_dir = 'undefined'
         self.mssql_db_dir = 'undefined'
+        # Бэкап mssql в несколько файлов (stripes). Каталоги через запятую, пусто - рядом с первым файлом
+        self.mssql_backup_stripes = -1
+        self.mssql_backup_stripe_dirs = 'undefined'
+        # 0 - значение по умолчанию sql server. maxtransfersize в байтах, кратно 64 KB
+        self.mssql_buffer_count = -1
+        self.mssql_max_transfer_size = -1
+        # Reduce: желаемое время одной пачки удаления блобов в секундах, порог заполнения лога в процентах
+        # и максимальное ожидание фоновой очистки удаленных записей в секундах
+        self.mssql_reduce_batch_seconds = -1
+        self.mssql_reduce_max_log_percent = -1
+        self.mssql_ghost_wait_timeout = -1
+
+        # Кэш восстановленных и уменьшенных баз для новых стендов из одного бэкапа. Пусто - не использовать.
+        # Максимальный размер кэша в гигабайтах, 0 - без ограничения
+        self.reduced_cache_dir = 'undefined'
+        self.reduced_cache_max_gb = -1
+
+        # Кэш общих для стендов одной сборки дженкинса файлов. Пусто - не использовать
+        self.build_cache_dir = 'undefined'
+        # Архив AppCDS на сборку: JVM стенда создает его при остановке, стенды той же сборки запускаются с ним.
+        # Нужна JDK 19+ в образе, флаги добавляются в CATALINA_OPTS новых контейнеров
+        self.appcds = False
+        # Кэш рабочей директории томката со скомпилированными JSP на сборку. Монтируется в новые контейнеры
+        self.tomcat_work_cache = False
+        # Распакованная сборка хранится в кэше один раз и монтируется в новые контейнеры только для чтения.
+        # Контейнеры, созданные без этого монтирования, получают свою копию сборки. Сборка удаляется из кэша,
+        # когда с нее уходит последний стенд
+        self.shared_builds = False
 
         self.jenkins_url = 'undefined'
         self.jenkins_user = 'undefined'
@@ -83,6 +182,22 @@ class DaemonConfig(object):
                 'daemon.jenkins': {'handlers': ['console', 'file']},
                 'daemon.stand': {'handlers': ['console', 'file']},
                 'daemon.stand_db': {'handlers': ['console', 'file']},
+                'daemon.reduced_cache': {'handlers': ['console', 'file']},
+                'daemon.build_cache': {'handlers': ['console', 'file']},
+                'daemon.throttle': {'handlers': ['console', 'file']},
+                'daemon.disk_space': {'handlers': ['console', 'file']},
+                'daemon.state_store': {'handlers': ['console', 'file']},
+                'daemon.docker_pool': {'handlers': ['console', 'file']},
+                'daemon.port_allocator': {'handlers': ['console', 'file']},
+                'daemon.health_monitor': {'handlers': ['console', 'file']},
+                'daemon.start_queue': {'handlers': ['console', 'file']},
+                'daemon.memory': {'handlers': ['console', 'file']},
+                'daemon.idle_detector': {'handlers': ['console', 'file']},
+                'daemon.scheduler': {'handlers': ['console', 'file']},
+                'daemon.events': {'handlers': ['console', 'file']},
+                'daemon.task_queue': {'handlers': ['console', 'file']},
+                'daemon.cancel': {'handlers': ['console', 'file']},
+                'daemon.warm_standby': {'handlers': ['console', 'file']},
                 'web_handlers': {'handlers': ['console', 'file']},
                 'service': {'handlers': ['console', 'file']},
             },
@@ -113,3 +228,26 @@ class DaemonConfig(object):
         self.defined = True
 
         return self
+
+
+class Shared:
+    """
+    Общие для всего демона объекты модуля: кэши, пулы, шина событий. Объект создается при первом обращении
+    по конфигу демона, без конфига - по конфигу по умолчанию. Ключ отличает несколько объектов одного модуля
+    """
+
+    def __init__(self, factory):
+        """
+        :param factory: factory(config, *key) создает объект
+        """
+        self._factory = factory
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def get(self, config=None, *key):
+        with self._lock:
+            if key not in self._objects:
+                if not config:
+                    config = DaemonConfig().load_default()
+                self._objects[key] = self._factory(config, *key)
+            return self._objects[key]
@@ -0,0 +1,146 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from daemon.config import DaemonConfig, Shared
+from daemon.exceptions import DaemonException
+
+log = logging.getLogger(__name__)
+
+# Отношения по умолчанию, пока нет истории: размер файла бэкапа к размеру базы и размер базы к файлу бэкапа
+DEFAULT_BACKUP_RATIO = 1.0
+DEFAULT_RESTORE_RATIO = 4.0
+# Вес последнего измерения в скользящем среднем
+HISTORY_WEIGHT = 0.3
+
+
+class NoDiskSpace(DaemonException):
+    pass
+
+
+class DiskSpaceGuard:
+    """
+    Оценивает сколько места нужно бэкапу или восстановлению и проверяет его наличие до начала задачи.
+    Если места не хватает, удаляет устаревшие копии из кэша и старые бэкапы с метками на том же диске.
+    Сам не ждет: задача из очереди откладывается и проверяет место снова, пока не пройдет disk_wait_timeout
+    """
+
+    def __init__(self, config: DaemonConfig):
+        self.stats_path = os.path.join(config.work_dir, 'disk_space.json')
+        self.reduced_cache_dir = config.reduced_cache_dir
+        self.margin_percent = config.disk_margin_percent
+        self.wait_timeout = config.disk_wait_timeout
+        self.backup_retention_days = config.disk_backup_retention_days
+        self._lock = threading.Lock()
+
+    def _read_stats(self) -> dict:
+        if not os.path.isfile(self.stats_path):
+            return {}
+        with open(self.stats_path, 'rt') as f:
+            return json.loads(f.read())
+
+    def ratio(self, db_type, operation) -> float:
+        default = DEFAULT_BACKUP_RATIO if operation == 'backup' else DEFAULT_RESTORE_RATIO
+        with self._lock:
+            return self._read_stats().get(db_type, {}).get(operation, default)
+
+    def record(self, db_type, operation, ratio):
+        """
+        Запомнить фактическое отношение размеров для следующих оценок
+        """
+        if ratio <= 0:
+            return
+        with self._lock:
+            stats = self._read_stats()
+            old = stats.setdefault(db_type, {}).get(operation)
+            stats[db_type][operation] = ratio if old is None else old * (1 - HISTORY_WEIGHT) + ratio * HISTORY_WEIGHT
+            tmp_path = self.stats_path + '.tmp'
+            with open(tmp_path, 'wt') as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, self.stats_path)
+        log.debug('%s %s ratio is %.2f now', db_type, operation, stats[db_type][operation])
+
+    def _with_margin(self, size):
+        return int(size * (100 + self.margin_percent) / 100)
+
+    def backup_estimate(self, db_type, db_size) -> int:
+        return self._with_margin(db_size * self.ratio(db_type, 'backup'))
+
+    def restore_estimate(self, db, db_type, backup_path) -> int:
+        size = db.restore_size(backup_path)
+        if size is None:
+            if not os.path.isfile(backup_path):
+                return 0
+            size = os.path.getsize(backup_path) * self.ratio(db_type, 'restore')
+        return self._with_margin(size)
+
+    def _evict(self, directory, needed, target_dir, keep=None):
+        """
+        Удаляет файлы кэша уменьшенных баз и бэкапы с метками старше disk_backup_retention_days,
+        начиная с самых старых, пока не освободится needed байт на диске target_dir
+        :param directory: директория бэкапов, в которой можно удалять старые бэкапы
+        :param keep: файл, который нужен операции, например восстанавливаемый бэкап
+        """
+        keep = os.path.abspath(keep) if keep else None
+        candidates = []
+        if self.reduced_cache_dir and os.path.isdir(self.reduced_cache_dir):
+            candidates += [p for p in glob.glob(os.path.join(self.reduced_cache_dir, '*'))
+                           if not p.endswith('index.json') and not p.endswith('.tmp')]
+        if self.backup_retention_days > 0 and os.path.isdir(directory):
+            expired = time.time() - self.backup_retention_days * 24 * 3600
+            # Бэкапы с именем по умолчанию нужны для клонирования, их не трогаем
+            candidates += [p for p in glob.glob(os.path.join(directory, '*'))
+                           if os.path.isfile(p) and '_default.' not in os.path.basename(p)
+                           and os.path.getmtime(p) < expired]
+
+        # Удаление файлов на другом диске места не освободит
+        device = os.stat(target_dir).st_dev
+        freed = 0
+        for path in sorted(candidates, key=os.path.getmtime):
+            if freed >= needed:
+                break
+            if os.path.abspath(path) == keep or os.stat(path).st_dev != device:
+                continue
+            size = os.path.getsize(path)
+            log.warning('Remove %s to free disk space', path)
+            os.remove(path)
+            freed += size
+        return freed
+
+    def ensure(self, what, needed, free_space_func, evict_dir=None, target_dir=None, keep=None):
+        """
+        Проверить, что на диске есть needed байт, при необходимости освободив место
+        :param what: описание операции для логов
+        :param free_space_func: функция, возвращающая свободное место в байтах или None, если его не узнать
+        :param evict_dir: локальная директория бэкапов, в которой можно удалить старые файлы
+        :param target_dir: локальная директория на проверяемом диске. Без нее место не освобождается
+        :param keep: файл, который удалять нельзя
+        :raise NoDiskSpace: если места не хватает
+        """
+        free = free_space_func()
+        if free is None:
+            log.debug('Free space for %s is unknown, check skipped', what)
+            return
+        log.info('%s needs about %s MB, free %s MB', what, needed // 2 ** 20, free // 2 ** 20)
+        if free >= needed:
+            return
+
+        if evict_dir and target_dir and os.path.isdir(target_dir):
+            self._evict(evict_dir, needed - free, target_dir, keep=keep)
+            free = free_space_func()
+            if free >= needed:
+                return
+
+        raise NoDiskSpace('Not enough disk space for {}: needs {} MB, free {} MB'.format(what,
+                                                                                       needed // 2 ** 20,
+                                                                                       free // 2 ** 20))
+
+
+_shared = Shared(DiskSpaceGuard)
+
+
+def shared(config=None) -> DiskSpaceGuard:
+    return _shared.get(config)
@@ -0,0 +1,118 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from docker import Client
+
+from daemon.config import Shared
+from daemon.exceptions import DaemonException
+
+log = logging.getLogger(__name__)
+
+DOCKER_URL = 'unix://var/run/docker.sock'
+
+
+class DockerPool:
+    """
+    Пул клиентов докера с keep-alive соединениями. Для обычных вызовов пул используется как клиент:
+    pool.inspect_container(...) берет свободного клиента на время одного запроса.
+    Несколько запросов подряд можно сделать одним клиентом из client(). Бесконечные потоки (events)
+    не должны занимать клиента пула, для них есть dedicated()
+    """
+
+    def __init__(self, size, timeout, base_url=DOCKER_URL):
+        self.size = size
+        self.timeout = timeout
+        self.base_url = base_url
+        self._clients = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        # {метод: [количество вызовов, суммарное время, максимальное время, ошибки]}
+        self._stats = {}
+
+    def _acquire(self, timeout):
+        try:
+            return self._clients.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return Client(base_url=self.base_url, timeout=self.timeout)
+        # Все клиенты заняты, ждем освобождения
+        try:
+            return self._clients.get(timeout=timeout)
+        except queue.Empty:
+            raise DaemonException('All {} docker clients are busy for {} seconds'.format(self.size, timeout))
+
+    @contextmanager
+    def client(self, timeout=None) -> Client:
+        """
+        Взять клиента из пула
+        :param timeout: сколько ждать свободного клиента, по умолчанию docker_timeout
+        """
+        cli = self._acquire(timeout or self.timeout)
+        try:
+            yield cli
+        finally:
+            self._clients.put(cli)
+
+    def dedicated(self) -> Client:
+        """
+        Отдельный клиент вне пула для долгих потоковых запросов. Закрыть после использования
+        """
+        return Client(base_url=self.base_url, timeout=self.timeout)
+
+    def _record(self, method, elapsed, failed):
+        with self._lock:
+            stat = self._stats.setdefault(method, [0, 0.0, 0.0, 0])
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = max(stat[2], elapsed)
+            if failed:
+                stat[3] += 1
+
+    def __getattr__(self, name):
+        attr = getattr(Client, name, None)
+        if not callable(attr):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            started = time.time()
+            failed = False
+            try:
+                with self.client() as cli:
+                    return getattr(cli, name)(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                self._record(name, time.time() - started, failed)
+
+        return call
+
+    def metrics(self) -> dict:
+        """
+        Метрики запросов к докеру: количество, среднее и максимальное время в миллисекундах, ошибки.
+        Метод не называется stats, чтобы не перекрыть stats клиента докера
+        """
+        with self._lock:
+            return {'clients': self._created,
+                    'idle_clients': self._clients.qsize(),
+                    'requests': {method: {'count': count,
+                                          'avg_ms': round(total / count * 1000, 1),
+                                          'max_ms': round(max_time * 1000, 1),
+                                          'errors': errors}
+                                 for method, (count, total, max_time, errors) in self._stats.items()}}
+
+
+_shared = Shared(lambda config: DockerPool(config.docker_pool_size, config.docker_timeout))
+
+
+def shared(config=None) -> DockerPool:
+    """
+    Общий для всего демона пул клиентов докера
+    """
+    return _shared.get(config)
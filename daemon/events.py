@@ -0,0 +1,165 @@
+import collections
+import logging
+import threading
+import time
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from daemon.config import Shared
+
+log = logging.getLogger(__name__)
+
+# Типы событий
+TASK = 'task'
+CONTAINER = 'container'
+WEB_INTERFACE = 'web_interface'
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class EventBus:
+    """
+    Последние события стендов в кольцевом буфере. Номер события служит курсором: клиент передает номер
+    последнего полученного события и получает следующие. Ожидающие клиенты - футуры торнадо, пока событий нет,
+    они ничего не стоят. Публиковать можно из любого потока, задачи ждут событий в своих потоках через wait_for
+    """
+
+    def __init__(self, size):
+        self._events = collections.deque(maxlen=size)
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # [(IOLoop, Future)]
+        self._waiters = []
+
+    @property
+    def cursor(self) -> int:
+        """
+        :return: номер последнего события
+        """
+        return self._last_id
+
+    def publish(self, event_type, stand, **data):
+        """
+        :param event_type: TASK, CONTAINER или WEB_INTERFACE
+        :param stand: название стенда
+        :param data: подробности события
+        """
+        with self._lock:
+            self._last_id += 1
+            event = dict(data, id=self._last_id, time=time.time(), type=event_type, stand=stand)
+            self._events.append(event)
+            waiters, self._waiters = self._waiters, []
+            self._cond.notify_all()
+        log.debug('Event %s', event)
+        for io_loop, future in waiters:
+            io_loop.add_callback(_resolve, future)
+
+    def since(self, cursor) -> list:
+        """
+        :return: события после cursor. Если клиент отстал больше чем на размер буфера, часть событий потеряна,
+        это видно по пропуску в номерах
+        """
+        with self._lock:
+            return [e for e in self._events if e['id'] > cursor]
+
+    def wait(self, cursor) -> Future:
+        """
+        Футура, которая завершится, когда появится событие после cursor. Вызывать из IOLoop
+        """
+        future = Future()
+        with self._lock:
+            if self._last_id > cursor:
+                future.set_result(None)
+            else:
+                self._waiters.append((IOLoop.current(), future))
+        return future
+
+    def wait_for(self, cursor, match, timeout, stop=None) -> dict:
+        """
+        Дождаться в потоке первого события после cursor, для которого match(event) истинно. Не вызывать из IOLoop
+        :param stop: прервать ожидание, если stop() истинно после пробуждения через wake
+        :return: событие или None по таймауту и stop
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while 1:
+                for event in self._events:
+                    if event['id'] > cursor:
+                        cursor = event['id']
+                        if match(event):
+                            return event
+                remaining = deadline - time.time()
+                if remaining <= 0 or (stop and stop()):
+                    return None
+                self._cond.wait(remaining)
+
+    def wake(self):
+        """
+        Разбудить потоки в wait_for, например при отмене задачи
+        """
+        with self._cond:
+            self._cond.notify_all()
+
+
+class ContainerEvents:
+    """
+    Переносит события докера о контейнерах стендов в шину событий. Поток держит одного клиента пула на
+    потоке событий и переподключается после разрыва
+    """
+    ACTIONS = ('start', 'stop', 'die', 'pause', 'unpause')
+
+    def __init__(self, sm, bus: EventBus):
+        self.sm = sm
+        self.bus = bus
+        self._last_nano = 0
+
+    def start(self):
+        threading.Thread(target=self._run, name='docker-events', daemon=True).start()
+
+    def _run(self):
+        log.info('Start docker events listener')
+        since = int(time.time())
+        while 1:
+            # Поток событий занимает клиента навсегда, клиент пула для него не берем
+            cli = self.sm.cli.dedicated()
+            try:
+                for event in cli.events(since=since, decode=True,
+                                        filters={'type': 'container', 'event': list(self.ACTIONS)}):
+                    since = event.get('time', since)
+                    self._on_event(event)
+            except Exception as e:
+                # Поток событий рвется по таймауту клиента, если событий долго нет
+                log.debug('Docker events stream is closed: %s', e)
+                time.sleep(1)
+            finally:
+                cli.close()
+
+    def _on_event(self, event):
+        # После переподключения с since докер повторяет события той же секунды
+        nano = event.get('timeNano', 0)
+        if nano and nano <= self._last_nano:
+            return
+        self._last_nano = nano
+
+        container_id = event.get('id')
+        action = event.get('Action') or event.get('status')
+        for stand in list(self.sm.stands.values()):
+            if stand.container_id == container_id:
+                data = {'action': action}
+                exit_code = event.get('Actor', {}).get('Attributes', {}).get('exitCode')
+                if exit_code is not None:
+                    data['exit_code'] = exit_code
+                self.bus.publish(CONTAINER, stand.name, **data)
+                return
+
+
+_shared = Shared(lambda config: EventBus(config.events_buffer))
+
+
+def shared(config=None) -> EventBus:
+    return _shared.get(config)
@@ -4,3 +4,7 @@ class DaemonException(Exception):
 
 class InvalidStandInfo(Exception):
     pass
+
+
+class TaskCancelled(DaemonException):
+    pass
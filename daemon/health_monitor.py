@@ -0,0 +1,170 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from docker import errors
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.ioloop import IOLoop
+
+from daemon import events
+from daemon.config import DaemonConfig
+from daemon.stand import is_paused_container
+
+log = logging.getLogger(__name__)
+
+# Строка в логе томката, после которой веб-интерфейс готов
+READY_SIGNAL = b'Server startup in'
+
+
+class _StandHealth:
+    def __init__(self, started_at, ready):
+        self.started_at = started_at
+        self.ready = ready
+        # Сообщено ли о результате запуска: событие о готовности ждет запускающая стенд задача
+        self.reported = ready
+        self.logs_since = int(started_at)
+        self.interval = 0
+        self.next_check = 0
+        self.failures = 0
+        self.paused = False
+
+
+class HealthMonitor:
+    """
+    Следит за веб-интерфейсом всех запущенных стендов в IOLoop торнадо и поддерживает web_interface_error.
+    Запускающийся стенд считается готовым по строке Server startup in в логе контейнера, готовые стенды
+    проверяются запросом к веб-интерфейсу. Пока стенд отвечает, интервал проверки растет до health_max_interval,
+    после ошибки сбрасывается до health_interval. Все запросы идут через один AsyncHTTPClient.
+    О результате запуска стенда монитор сообщает событием WEB_INTERFACE, даже если ошибка не изменилась
+    """
+
+    def __init__(self, sm, config: DaemonConfig):
+        self.sm = sm
+        self.config = config
+        self.interval = config.health_interval
+        self.max_interval = config.health_max_interval
+        self.startup_timeout = config.health_startup_timeout
+        self.max_failures = config.health_failures
+        self.probe_timeout = config.health_probe_timeout
+        self.http = AsyncHTTPClient()
+        # Запросы к докеру блокирующие, для них пара своих потоков
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.health = {}
+        self._first_check = True
+
+    def start(self):
+        IOLoop.current().spawn_callback(self._run)
+
+    def is_ready(self, name) -> bool:
+        """
+        Запущен ли стенд и отвечает ли его веб-интерфейс по последней проверке
+        """
+        health = self.health.get(name)
+        return bool(health and health.ready and not health.paused and not health.failures
+                    and not self.sm.stands[name].web_interface_error)
+
+    @gen.coroutine
+    def _run(self):
+        log.info('Start health monitor')
+        while 1:
+            try:
+                yield self._check_all()
+            except Exception:
+                log.exception('Health check failed')
+            yield gen.sleep(self.interval)
+
+    @gen.coroutine
+    def _check_all(self):
+        containers = yield self.executor.submit(self.sm.cli.containers)
+        running = {c['Id']: c for c in containers}
+
+        now = time.time()
+        checks = []
+        for stand in list(self.sm.stands.values()):
+            container = running.get(stand.container_id) if stand.container_id else None
+            if not container:
+                self.health.pop(stand.name, None)
+                continue
+            health = self.health.get(stand.name)
+            if stand.started_at and (not health or stand.started_at > health.started_at):
+                # Стенд запущен заново, возможно между проверками
+                health = self.health[stand.name] = _StandHealth(stand.started_at, ready=False)
+            elif not health:
+                # Стенд мог запуститься до прошлой проверки. Стенды, запущенные до старта демона,
+                # сразу проверяем запросом
+                health = self.health[stand.name] = _StandHealth(now - self.interval, ready=self._first_check)
+            # Замороженный стенд не отвечает, но после разморозки сразу готов
+            health.paused = is_paused_container(container)
+            if health.paused:
+                continue
+            if health.next_check <= now:
+                checks.append(self._check(stand, health))
+        self._first_check = False
+        if checks:
+            yield checks
+
+    @gen.coroutine
+    def _check(self, stand, health):
+        if not health.ready:
+            started = yield self._startup_finished(stand, health)
+            if not started:
+                if time.time() - health.started_at > self.startup_timeout:
+                    self._set_error(stand, 'Web interface was not started in {} seconds'.format(self.startup_timeout),
+                                    health)
+                    # Дальше проверяем как обычный стенд, вдруг веб-интерфейс все-таки поднимется
+                    health.ready = True
+                return
+            health.ready = True
+
+        error = yield self._probe(stand)
+        if error:
+            health.failures += 1
+            health.interval = self.interval
+            if health.failures >= self.max_failures:
+                self._set_error(stand, error, health)
+        else:
+            health.failures = 0
+            health.interval = min(max(health.interval * 2, self.interval), self.max_interval)
+            self._set_error(stand, None, health)
+        health.next_check = time.time() + health.interval
+
+    @gen.coroutine
+    def _startup_finished(self, stand, health):
+        """
+        Ищет сигнал готовности в логе контейнера, появившемся с прошлой проверки
+        """
+        since = health.logs_since
+        try:
+            output = yield self.executor.submit(self.sm.cli.logs, stand.container_id, tail='all', since=since)
+        except (errors.DockerException, errors.APIError) as e:
+            log.debug('Cannot read log of %s: %s', stand.name, e)
+            return False
+        # Окно перекрывается на секунду, чтобы не потерять строки на границе
+        health.logs_since = max(since, int(time.time()) - 1)
+        return READY_SIGNAL in output
+
+    @gen.coroutine
+    def _probe(self, stand):
+        """
+        :return: текст ошибки или None, если веб-интерфейс отвечает
+        """
+        try:
+            yield self.http.fetch(stand.url(), request_timeout=self.probe_timeout)
+        except (OSError, HTTPError) as e:
+            return str(e)
+        return None
+
+    def _set_error(self, stand, error, health):
+        reported, health.reported = health.reported, True
+        if stand.web_interface_error == error:
+            if not reported:
+                events.shared(self.config).publish(events.WEB_INTERFACE, stand.name, error=error)
+            return
+        if error:
+            log.info('Container %s is not available. Web interface error: %s', stand.name, error)
+        else:
+            log.info('Container %s is available', stand.name)
+        stand.web_interface_error = error
+        stand.save()
+        events.shared(self.config).publish(events.WEB_INTERFACE, stand.name, error=error)
@@ -0,0 +1,137 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from docker import errors
+from requests.exceptions import RequestException
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from daemon import task
+from daemon.config import DaemonConfig
+from daemon.exceptions import DaemonException
+from daemon.stand import is_paused_container
+
+log = logging.getLogger(__name__)
+
+
+class _Sample:
+    def __init__(self, at, net_bytes, cpu_ns):
+        self.at = at
+        self.net_bytes = net_bytes
+        self.cpu_ns = cpu_ns
+
+
+class IdleDetector:
+    """
+    Раз в idle_sample_seconds снимает статистику докера запущенных стендов. Стенд активен, если за интервал
+    через его сеть прошло больше idle_net_bytes или он занял больше idle_cpu_percent одного ядра.
+    Стенд, который был неактивен idle_stop_minutes, останавливается или замораживается
+    """
+
+    def __init__(self, sm, config: DaemonConfig, on_stop=None):
+        """
+        :param on_stop: вызывается после остановки простаивающего стенда
+        """
+        self.sm = sm
+        self.stop_after = config.idle_stop_minutes * 60
+        self.interval = config.idle_sample_seconds
+        self.net_threshold = config.idle_net_bytes
+        self.cpu_threshold = config.idle_cpu_percent
+        self.on_stop = on_stop
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self._samples = {}
+        # {стенд: время последней активности}
+        self.last_activity = {}
+
+    def start(self):
+        if self.stop_after <= 0:
+            log.info('Idle stands are not stopped')
+            return
+        IOLoop.current().spawn_callback(self._run)
+
+    def is_busy(self, name) -> bool:
+        """
+        Был ли стенд активен за последние idle_stop_minutes
+        """
+        last_activity = self.last_activity.get(name)
+        return last_activity is not None and time.time() - last_activity < self.stop_after
+
+    @gen.coroutine
+    def _run(self):
+        log.info('Start idle detector')
+        while 1:
+            yield gen.sleep(self.interval)
+            try:
+                yield self._check_all()
+            except Exception:
+                log.exception('Idle check failed')
+
+    @gen.coroutine
+    def _check_all(self):
+        containers = yield self.executor.submit(self.sm.cli.containers)
+        # Замороженные стенды не работают, их демотирует политика заморозки
+        running = {c['Id'] for c in containers if not is_paused_container(c)}
+
+        stands = []
+        for stand in list(self.sm.stands.values()):
+            if stand.container_id not in running:
+                self._samples.pop(stand.name, None)
+                self.last_activity.pop(stand.name, None)
+                continue
+            # Задачи сами останавливают и запускают стенды, их стенды не трогаем
+            if stand.active_task and stand.active_task['status'] != task.ERROR:
+                self.last_activity[stand.name] = time.time()
+                continue
+            stands.append(stand)
+
+        loop = IOLoop.current()
+        samples = yield [loop.run_in_executor(self.executor, self._sample, s) for s in stands]
+        for stand, sample in zip(stands, samples):
+            if sample:
+                yield self._check(stand, sample)
+
+    def _sample(self, stand) -> _Sample:
+        try:
+            stats = self.sm.cli.stats(stand.container_id, decode=True, stream=False)
+        except (errors.DockerException, errors.APIError, RequestException, DaemonException) as e:
+            # Ошибка одного стенда, в том числе занятый пул клиентов, не должна срывать проверку остальных
+            log.debug('Cannot get stats of %s: %s', stand.name, e)
+            return None
+        networks = stats.get('networks') or {'eth0': stats.get('network') or {}}
+        net_bytes = sum(n.get('rx_bytes', 0) + n.get('tx_bytes', 0) for n in networks.values())
+        cpu_ns = stats.get('cpu_stats', {}).get('cpu_usage', {}).get('total_usage', 0)
+        return _Sample(time.time(), net_bytes, cpu_ns)
+
+    @gen.coroutine
+    def _check(self, stand, sample):
+        previous = self._samples.get(stand.name)
+        self._samples[stand.name] = sample
+        if not previous:
+            # Отсчет простоя начинается с первого замера
+            self.last_activity.setdefault(stand.name, sample.at)
+            return
+
+        elapsed = sample.at - previous.at
+        net = sample.net_bytes - previous.net_bytes
+        cpu_percent = (sample.cpu_ns - previous.cpu_ns) / 1e9 / elapsed * 100 if elapsed > 0 else 0
+        if net > self.net_threshold or cpu_percent > self.cpu_threshold:
+            self.last_activity[stand.name] = sample.at
+            stand.last_access = sample.at
+            stand.save()
+            return
+
+        idle = sample.at - self.last_activity.get(stand.name, sample.at)
+        if idle < self.stop_after:
+            return
+
+        log.info('Stop stand %s idle for %s minutes', stand.name, int(idle // 60))
+        try:
+            yield self.executor.submit(self.sm.suspend, stand.name)
+        except DaemonException as e:
+            log.warning('Cannot stop idle stand %s: %s', stand.name, e)
+            return
+        self._samples.pop(stand.name, None)
+        self.last_activity.pop(stand.name, None)
+        if self.on_stop:
+            self.on_stop()
@@ -1,24 +1,40 @@
 import logging
 import os
 import shutil
-import time
 import zipfile
 
 import jenkinsapi
 import pytz
 
+from daemon import cancel, throttle
 from daemon.exceptions import DaemonException
 
 log = logging.getLogger(__name__)
 
 
 class Jenkins:
-    def __init__(self, url, user, password):
+    def __init__(self, url, user, password, config=None):
+        """
+        :param config: конфиг демона для ограничения скорости распаковки
+        """
+        self.config = config
         # https://jenkinsapi.readthedocs.io/en/latest/build.html
         self.server = jenkinsapi.jenkins.Jenkins(url,
                                                  username=user,
                                                  password=password)
 
+    @staticmethod
+    def _stop_build(job, build_number):
+        log.info('Stop build %s of project %s', build_number, job.name)
+        try:
+            job.get_build(build_number).stop()
+        except (KeyError, jenkinsapi.custom_exceptions.NotFound):
+            # Сборка еще не началась, убираем ее из очереди
+            try:
+                job.jenkins.get_queue().delete_item(job.get_queue_item())
+            except Exception as e:
+                log.warning('Cannot cancel queued build of project %s: %s', job.name, e)
+
     def version(self):
         """
         :return: Версия Jenkins
@@ -47,7 +63,11 @@ class Jenkins:
 
         # jenkinsapi не считает билд существующим пока не начнется его фактическая сборка, поэтому приходится писать так
         elapsed_time = 0
+        token = cancel.current()
         while 1:
+            if token.cancelled:
+                self._stop_build(job, build_number)
+                token.check()
             if elapsed_time > 1200:
                 raise DaemonException('Timeout while jenkins building')
             try:
@@ -57,13 +77,44 @@ class Jenkins:
                 pass
             log.debug('wait build')
             elapsed_time += 15
-            time.sleep(15)
+            token.wait(15)
 
         if not job.get_build(build_number).is_good():
             raise DaemonException('Last build is incorrect')
 
         return build_number
 
+    def resolve_build(self, project, build_number=None) -> int:
+        """
+        :param project: Название job в Jenkins
+        :param build_number: Номер сборки, по умолчанию последняя
+        :return: Номер сборки
+        """
+        if build_number:
+            return build_number
+        return self.server[project].get_last_build().get_number()
+
+    def _extract(self, zip_file, path):
+        """
+        Распаковка с ограничением скорости записи, чтобы не тормозить запущенные стенды
+        """
+        t = throttle.shared(self.config)
+        if not t.bytes_per_sec:
+            zip_file.extractall(path=path)
+            return
+
+        root = os.path.realpath(path)
+        for info in zip_file.infolist():
+            target = os.path.realpath(os.path.join(root, info.filename))
+            if not target.startswith(root + os.sep):
+                raise DaemonException('Wrong file path in build artifact: %s' % info.filename)
+            if info.filename.endswith('/'):
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with zip_file.open(info) as src, open(target, 'wb') as dst:
+                t.copy(src, dst)
+
     def get_build(self, project, dir_for_files, build_number=None):
         """
         Скачивает и распаковывает war файл
@@ -114,9 +165,8 @@ class Jenkins:
                 raise DaemonException('Cannot unpack build artifact. It is not zip file')
 
             log.debug('Unpack war')
-            f = zipfile.ZipFile(war_file)
-            f.extractall(path=dir_for_files)
-            f.close()
+            with zipfile.ZipFile(war_file) as f:
+                self._extract(f, dir_for_files)
 
             build_ts = build.get_timestamp()
             local_datetime_string = build_ts.replace(tzinfo=pytz.utc).astimezone(pytz.timezone('Asia/Yekaterinburg')) \
@@ -0,0 +1,96 @@
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from docker import errors
+from requests.exceptions import RequestException
+
+from daemon.config import DaemonConfig
+from daemon.exceptions import DaemonException
+
+log = logging.getLogger(__name__)
+
+MB = 2 ** 20
+
+_XMX_RE = re.compile(r'-Xmx(\d+)([kKmMgG]?)(?:\s|$)')
+_UNITS = {'': 1, 'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30}
+
+
+def jvm_heap(catalina_opt) -> int:
+    """
+    :return: максимальный размер кучи из -Xmx в байтах, None если не задан
+    """
+    matches = _XMX_RE.findall(catalina_opt or '')
+    if not matches:
+        return None
+    # Действует последний -Xmx
+    size, unit = matches[-1]
+    return int(size) * _UNITS[unit.lower()]
+
+
+def container_limit(catalina_opt, jvm_overhead) -> int:
+    """
+    :param jvm_overhead: память java сверх кучи в байтах
+    :return: ограничение памяти контейнера стенда в байтах, 0 - без ограничения
+    """
+    heap = jvm_heap(catalina_opt)
+    return heap + jvm_overhead if heap else 0
+
+
+def host_available() -> int:
+    """
+    :return: доступная память хоста (MemAvailable) в байтах
+    """
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError('MemAvailable is missed in /proc/meminfo')
+
+
+class MemoryAdmission:
+    """
+    Решает, хватит ли памяти хоста на запуск стенда. Стенду нужно -Xmx плюс memory_jvm_overhead_mb
+    на метаданные и потоки, базе pgdocker - memory_pgdocker_mb. Запущенные стенды, которые еще не дорасли
+    до своей оценки по статистике докера, вырастут, поэтому их недобор вычитается из доступной памяти
+    """
+
+    def __init__(self, cli, config: DaemonConfig):
+        self.cli = cli
+        self.jvm_overhead = config.memory_jvm_overhead_mb * MB
+        self.pgdocker_limit = config.memory_pgdocker_mb * MB
+        self.reserve = config.memory_reserve_mb * MB
+        self.default_heap = config.memory_default_heap_mb * MB
+
+    def estimate(self, stand, with_db=True) -> int:
+        """
+        :param with_db: учесть контейнер базы pgdocker
+        :return: сколько памяти стенд займет после запуска
+        """
+        size = container_limit(stand.catalina_opt, self.jvm_overhead) or self.default_heap + self.jvm_overhead
+        if with_db and stand.db_type == 'pgdocker':
+            size += self.pgdocker_limit
+        return size
+
+    def usage(self, container_id) -> int:
+        try:
+            stats = self.cli.stats(container_id, decode=True, stream=False)
+            return stats['memory_stats'].get('usage', 0)
+        except (errors.DockerException, errors.APIError, RequestException, DaemonException, KeyError) as e:
+            log.debug('Cannot get memory stats of %s: %s', container_id, e)
+            return 0
+
+    def admit(self, stand, running_stands) -> bool:
+        """
+        :param stand: стенд, который нужно запустить
+        :param running_stands: запущенные стенды
+        """
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            usages = list(executor.map(self.usage, [s.container_id for s in running_stands]))
+        growth = sum(max(self.estimate(s, with_db=False) - usage, 0) for s, usage in zip(running_stands, usages))
+
+        available = host_available() - self.reserve - growth
+        needed = self.estimate(stand)
+        log.info('Start of %s needs %s MB, available %s MB (running stands will grow by %s MB)',
+                 stand.name, needed // MB, available // MB, growth // MB)
+        return needed <= available
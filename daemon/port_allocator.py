@@ -0,0 +1,149 @@
+import heapq
+import logging
+import threading
+
+from daemon.exceptions import DaemonException
+
+log = logging.getLogger(__name__)
+
+# Владелец портов, занятых контейнерами докера, которые не относятся к стендам
+DOCKER_OWNER = 'docker'
+
+
+class PortRange:
+    """
+    Диапазон портов в виде битовой карты и кучи свободных портов. Выдача и возврат порта за O(log n).
+    Всегда выдается наименьший свободный порт, в том числе только что освобожденный
+    """
+
+    def __init__(self, name, start, count):
+        self.name = name
+        self.start = start
+        self.count = count
+        self._used = bytearray(count)
+        self._used_count = 0
+        # В куче могут лежать уже занятые порты, они пропускаются при выдаче
+        self._free = list(range(count))
+        self.owners = {}
+
+    def __contains__(self, port):
+        return self.start <= port < self.start + self.count
+
+    def free_count(self) -> int:
+        return self.count - self._used_count
+
+    def is_used(self, port) -> bool:
+        return bool(self._used[port - self.start])
+
+    def take(self, port, owner):
+        index = port - self.start
+        if not self._used[index]:
+            self._used[index] = 1
+            self._used_count += 1
+        self.owners[port] = owner
+
+    def take_free(self, owner) -> int:
+        while 1:
+            index = heapq.heappop(self._free)
+            if not self._used[index]:
+                port = self.start + index
+                self.take(port, owner)
+                return port
+
+    def put(self, port):
+        index = port - self.start
+        if self._used[index]:
+            self._used[index] = 0
+            self._used_count -= 1
+            heapq.heappush(self._free, index)
+        self.owners.pop(port, None)
+
+
+class PortAllocator:
+    """
+    Выдает порты томката, отладчика и pgdocker из диапазонов конфига. Выдача атомарна, занятые порты
+    сохраняются в хранилище состояния. При запуске сверяется со стендами и привязками портов в докере:
+    порты удаленных стендов возвращаются, порты чужих контейнеров не выдаются
+    """
+
+    def __init__(self, store, ranges):
+        """
+        :param store: хранилище состояния стендов
+        :param ranges: {название диапазона: (первый порт, количество портов)}
+        """
+        self.store = store
+        self._lock = threading.Lock()
+        self.ranges = {name: PortRange(name, start, count) for name, (start, count) in ranges.items()}
+        for range_name, port, owner in store.load_ports():
+            port_range = self.ranges.get(range_name)
+            if port_range and port in port_range:
+                port_range.take(port, owner)
+
+    def reserve(self, range_name, owner, count=1) -> list:
+        """
+        Занять count свободных портов диапазона для владельца
+        :return: список портов
+        """
+        port_range = self.ranges[range_name]
+        with self._lock:
+            if port_range.free_count() < count:
+                raise DaemonException('No free port')
+            ports = [port_range.take_free(owner) for _ in range(count)]
+            with self.store.batch():
+                for port in ports:
+                    self.store.save_port(range_name, port, owner)
+        log.debug('Reserved %s ports %s for %s', range_name, ports, owner)
+        return ports
+
+    def reserve_port(self, range_name, port, owner):
+        """
+        Занять конкретный порт, например указанный пользователем для существующей базы.
+        Порты вне диапазона не учитываются, порт другого владельца остается за ним
+        """
+        port_range = self.ranges[range_name]
+        if port not in port_range:
+            return
+        with self._lock:
+            if port_range.is_used(port):
+                return
+            port_range.take(port, owner)
+            self.store.save_port(range_name, port, owner)
+
+    def release(self, owner):
+        """
+        Вернуть все порты владельца
+        """
+        with self._lock, self.store.batch():
+            for port_range in self.ranges.values():
+                for port in [p for p, o in port_range.owners.items() if o == owner]:
+                    port_range.put(port)
+                    self.store.delete_port(port_range.name, port)
+        log.debug('Released ports of %s', owner)
+
+    def reconcile(self, stand_ports, docker_ports):
+        """
+        Привести занятые порты в соответствие с фактическими
+        :param stand_ports: {название диапазона: {порт: стенд}} по информации о стендах
+        :param docker_ports: порты, опубликованные контейнерами докера
+        """
+        with self._lock, self.store.batch():
+            for port_range in self.ranges.values():
+                actual = dict(stand_ports.get(port_range.name, {}))
+                for port in docker_ports:
+                    if port in port_range and port not in actual:
+                        actual[port] = DOCKER_OWNER
+
+                for port, owner in list(port_range.owners.items()):
+                    if port not in actual:
+                        log.warning('Reclaim %s port %s leaked by %s', port_range.name, port, owner)
+                        port_range.put(port)
+                        self.store.delete_port(port_range.name, port)
+
+                for port, owner in actual.items():
+                    if port in port_range and port_range.owners.get(port) != owner:
+                        port_range.take(port, owner)
+                        self.store.save_port(port_range.name, port, owner)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {name: {'total': r.count, 'free': r.free_count()} for name, r in self.ranges.items()}
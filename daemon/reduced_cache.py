@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from daemon.config import Shared
+
+log = logging.getLogger(__name__)
+
+# Расширения файлов кэша. Кэшируются только базы, бэкапы которых лежат на этом сервере
+CACHE_EXTENSIONS = {'postgres': 'backup',
+                    'pgdocker': 'tar'}
+
+
+class ReducedCache:
+    """
+    Кэш уже восстановленных и уменьшенных баз. Ключ - контрольная сумма исходного файла бэкапа,
+    значение - бэкап уменьшенной базы, из которого новый стенд восстанавливается без reduce.
+    Кэш больше reduced_cache_max_gb ужимается удалением давно не использованных баз.
+    Задачи берут кэш через shared(), чтобы запись индекса шла под одной блокировкой
+    """
+
+    def __init__(self, cache_dir, max_size=0):
+        """
+        :param max_size: максимальный размер кэша в байтах, 0 - без ограничения
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _read_index(self) -> dict:
+        if not os.path.isfile(self.index_path):
+            return {}
+        with open(self.index_path, 'rt') as f:
+            return json.loads(f.read())
+
+    def _write_index(self, index):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wt') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def checksum(self, backup_path) -> str:
+        """
+        sha1 файла бэкапа. Считается один раз для каждой пары размер-время изменения файла
+        """
+        stat = os.stat(backup_path)
+        file_key = '{}:{}:{}'.format(os.path.abspath(backup_path), stat.st_size, int(stat.st_mtime))
+
+        with self._lock:
+            known = self._read_index().get('checksums', {})
+        if file_key in known:
+            return known[file_key]
+
+        log.info('Calculate checksum of %s', backup_path)
+        sha1 = hashlib.sha1()
+        with open(backup_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+
+        with self._lock:
+            index = self._read_index()
+            index.setdefault('checksums', {})[file_key] = digest
+            self._write_index(index)
+        return digest
+
+    def supports(self, db_type, backup_path) -> bool:
+        return db_type in CACHE_EXTENSIONS and os.path.isfile(backup_path)
+
+    def _path(self, db_type, backup_path):
+        return os.path.join(self.cache_dir, '{}_{}.{}'.format(self.checksum(backup_path),
+                                                              db_type,
+                                                              CACHE_EXTENSIONS[db_type]))
+
+    def get(self, db_type, backup_path):
+        """
+        :return: путь к бэкапу уменьшенной базы или None если его нет в кэше
+        """
+        if not self.supports(db_type, backup_path):
+            return None
+        path = self._path(db_type, backup_path)
+        if os.path.isfile(path):
+            log.info('Found reduced copy of %s in cache: %s', backup_path, path)
+            os.utime(path)
+            return path
+        return None
+
+    def put(self, db, db_type, backup_path):
+        """
+        Сохранить уменьшенную базу стенда в кэш
+        :param db: StandDb уже уменьшенной базы
+        :param db_type: тип базы данных стенда
+        :param backup_path: исходный файл бэкапа, из которого была восстановлена база
+        """
+        if not self.supports(db_type, backup_path):
+            log.debug('Reduced cache does not support %s backup %s', db_type, backup_path)
+            return
+        path = self._path(db_type, backup_path)
+        tmp_path = path + '.tmp'
+        log.info('Put reduced copy of %s to cache: %s', backup_path, path)
+        try:
+            db.backup(backup_path=tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.prune(keep=path)
+
+    @staticmethod
+    def _is_actual(file_key) -> bool:
+        """
+        Файл бэкапа из ключа контрольной суммы все еще лежит на месте и не изменился
+        """
+        path, size, mtime = file_key.rsplit(':', 2)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return str(stat.st_size) == size and str(int(stat.st_mtime)) == mtime
+
+    def prune(self, keep=None):
+        """
+        Удалить контрольные суммы исчезнувших и измененных бэкапов и самые давно использованные базы,
+        пока кэш больше max_size
+        :param keep: файл кэша, который удалять нельзя
+        """
+        with self._lock:
+            index = self._read_index()
+            checksums = index.get('checksums', {})
+            actual = {key: digest for key, digest in checksums.items() if self._is_actual(key)}
+            if len(actual) != len(checksums):
+                log.info('Remove %s outdated checksums from reduced cache', len(checksums) - len(actual))
+                index['checksums'] = actual
+                self._write_index(index)
+
+        if self.max_size <= 0:
+            return
+        files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                 if name != 'index.json' and not name.endswith('.tmp')]
+        files = [path for path in files if os.path.isfile(path)]
+        total = sum(os.path.getsize(path) for path in files)
+        # get() обновляет время изменения файла, поэтому первыми уходят давно не использованные базы
+        for path in sorted(files, key=os.path.getmtime):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            log.info('Remove %s from reduced cache to fit in %s GB', path, self.max_size // 2 ** 30)
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+
+_shared = Shared(lambda config, cache_dir: ReducedCache(cache_dir, config.reduced_cache_max_gb * 2 ** 30))
+
+
+def shared(cache_dir, config=None) -> ReducedCache:
+    """
+    Общий кэш для директории. Директория хранится в параметрах задачи, поэтому кэшей может быть несколько
+    """
+    return _shared.get(config, cache_dir)
@@ -0,0 +1,146 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+STOP = 'stop'
+
+
+class _Entry:
+    __slots__ = ('deadline', 'seq', 'name', 'action', 'cancelled')
+
+    def __init__(self, deadline, seq, name, action):
+        self.deadline = deadline
+        self.seq = seq
+        self.name = name
+        self.action = action
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+
+class Scheduler:
+    """
+    Отложенные действия над стендами (остановка по таймауту и т.п.) на куче. Сроки хранятся в информации
+    о стенде (scheduled), поэтому переживают перезапуск демона. Постановка, продление и отмена - O(log n):
+    отмененные записи остаются в куче и пропускаются при извлечении
+    """
+
+    def __init__(self, stands):
+        """
+        :param stands: словарь стендов менеджера
+        """
+        self.stands = stands
+        self._heap = []
+        self._entries = {}
+        self._seq = itertools.count()
+        self._actions = {}
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=4)
+        self._started = False
+
+        for stand in stands.values():
+            for action, deadline in stand.scheduled.items():
+                self._push(stand.name, action, deadline)
+
+    def register(self, action, func):
+        """
+        :param func: func(имя стенда), выполняется в отдельном потоке
+        """
+        self._actions[action] = func
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        log.info('Start scheduler with %s actions', len(self._entries))
+        threading.Thread(target=self._run, name='scheduler', daemon=True).start()
+
+    def _push(self, name, action, deadline):
+        old = self._entries.get((name, action))
+        if old:
+            old.cancelled = True
+        entry = _Entry(deadline, next(self._seq), name, action)
+        self._entries[(name, action)] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _save(self, name, action, deadline):
+        stand = self.stands.get(name)
+        if not stand:
+            return
+        if deadline is None:
+            stand.scheduled.pop(action, None)
+        else:
+            stand.scheduled[action] = deadline
+        stand.save()
+
+    def schedule(self, name, action, deadline):
+        """
+        Запланировать действие на время deadline (time.time()), заменив прежний срок
+        """
+        with self._cond:
+            self._push(name, action, deadline)
+            self._save(name, action, deadline)
+            self._cond.notify()
+        log.info('%s of %s is scheduled at %s', action, name, time.ctime(deadline))
+
+    def extend(self, name, action, seconds) -> float:
+        """
+        Отодвинуть срок на seconds секунд. Если действие не запланировано, срок отсчитывается от текущего времени
+        :return: новый срок
+        """
+        with self._cond:
+            entry = self._entries.get((name, action))
+            deadline = max(entry.deadline if entry else 0, time.time()) + seconds
+            self.schedule(name, action, deadline)
+        return deadline
+
+    def cancel(self, name, action=None):
+        """
+        Отменить действие, или все действия стенда, если action не указан
+        """
+        with self._cond:
+            keys = [(name, action)] if action else [k for k in self._entries if k[0] == name]
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry:
+                    entry.cancelled = True
+                    self._save(name, key[1], None)
+                    log.info('%s of %s is cancelled', key[1], name)
+
+    def deadline(self, name, action) -> float:
+        entry = self._entries.get((name, action))
+        return entry.deadline if entry else None
+
+    def _run(self):
+        while 1:
+            with self._cond:
+                while self._heap and self._heap[0].cancelled:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0].deadline - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                entry = heapq.heappop(self._heap)
+                del self._entries[(entry.name, entry.action)]
+                self._save(entry.name, entry.action, None)
+            self._executor.submit(self._execute, entry)
+
+    def _execute(self, entry):
+        func = self._actions.get(entry.action)
+        if not func:
+            log.error('Unknown scheduled action %s of %s', entry.action, entry.name)
+            return
+        try:
+            func(entry.name)
+        except Exception:
+            log.exception('Scheduled %s of %s failed', entry.action, entry.name)
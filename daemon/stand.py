@@ -2,20 +2,39 @@ import json
 import logging
 import os
 import shutil
+import threading
 import time
 
-from docker import Client, errors
-from tornado import gen
-from tornado.httpclient import HTTPClient, AsyncHTTPClient, HTTPError
+from docker import errors
 
+from daemon import build_cache, cancel, docker_pool, events, memory
+from daemon.config import DaemonConfig
 from daemon.exceptions import DaemonException, InvalidStandInfo
 from daemon.stand_db import StandMssqlDb, StandPostgresDb, StandDockerPostgres
 
 log = logging.getLogger(__name__)
 
 
+DB_TYPES = ('postgres', 'mssql', 'pgdocker')
+
+
+def is_paused_container(container) -> bool:
+    """
+    :param container: элемент списка cli.containers()
+    """
+    return container.get('State') == 'paused' or '(Paused)' in container.get('Status', '')
+
+
 class Stand:
-    def __init__(self, **kwargs):
+    # Служебные атрибуты, которые не сохраняются в информацию о стенде. Также не сохраняются атрибуты с _
+    NOT_SAVED = ('cli', 'stand_info', 'store', 'config', 'started_at')
+
+    def __init__(self, store=None, cli=None, config=None, **kwargs):
+        """
+        :param store: хранилище состояния стендов, без него информация пишется в stand_info.json
+        :param cli: пул клиентов докера, по умолчанию общий пул демона
+        :param config: общий конфиг демона для баз данных стенда, иначе каждая база прочитает его сама
+        """
         log.debug('Initialize new stand container object')
         try:
             self.image = kwargs['image']
@@ -55,44 +74,78 @@ class Stand:
             self.jenkins_user = kwargs['jenkins_user']
             self.jenkins_pass = kwargs['jenkins_pass']
             self.version = kwargs['version']
+            # Сборка дженкинса, по ней стенды делят файлы в кэше сборок
+            self.build_id = kwargs['build_id']
 
             self.active_task = kwargs['active_task']
             self.web_interface_error = kwargs['web_interface_error']
+            # Время последнего обращения к стенду, по нему выбирается простаивающий стенд для остановки
+            self.last_access = kwargs['last_access']
+            # Отложенные действия {действие: время}, их выполняет планировщик менеджера стендов
+            self.scheduled = kwargs['scheduled']
         except KeyError:
             raise InvalidStandInfo()
 
-        self.cli = Client(base_url='unix://var/run/docker.sock')
+        if self.db_type not in DB_TYPES:
+            raise RuntimeError('Unsupported database type')
+
+        self.cli = cli or docker_pool.shared(config)
+        self.store = store
+        self.config = config
         self.stand_info = os.path.join(self.stand_dir, 'stand_info.json')
+        # Время последнего запуска контейнера демоном, по нему монитор стендов заново ждет готовности
+        self.started_at = None
 
-        if self.db_type == 'postgres':
-            self.db = StandPostgresDb(self.db_addr, self.db_name, self.db_user, self.db_pass, self.db_port)
-        elif self.db_type == 'mssql':
-            self.db = StandMssqlDb(self.db_addr, self.db_name, self.db_user, self.db_pass, self.db_port)
-        elif self.db_type == 'pgdocker':
-            self.db = StandDockerPostgres(self.db_addr, container_name=self.db_container, ssh_user=self.ssh_user,
-                                          ssh_password=self.ssh_pass, port=self.db_port)
-        else:
-            raise RuntimeError('Unsupported database type')
+        # База данных создается при первом обращении, при запуске демона она не нужна
+        self._db = None
+        self._db_lock = threading.Lock()
 
         if not os.path.isdir(self.stand_dir):
             os.mkdir(self.stand_dir)
 
-        if not os.path.exists(self.stand_info):
-            open(self.stand_info, 'x').close()
-
-        self.write_json()
+    @property
+    def db(self):
+        with self._db_lock:
+            if self._db is None:
+                if self.db_type == 'postgres':
+                    self._db = StandPostgresDb(self.db_addr, self.db_name, self.db_user, self.db_pass, self.db_port,
+                                               config=self.config)
+                elif self.db_type == 'mssql':
+                    self._db = StandMssqlDb(self.db_addr, self.db_name, self.db_user, self.db_pass, self.db_port,
+                                            config=self.config)
+                else:
+                    self._db = StandDockerPostgres(self.db_addr, container_name=self.db_container,
+                                                   ssh_user=self.ssh_user, ssh_password=self.ssh_pass,
+                                                   port=self.db_port, config=self.config, docker=self.cli)
+            return self._db
 
-    def write_json(self):
+    def info(self) -> dict:
         d = {}
         for key, val in self.__dict__.items():
-            if key in ('cli', 'stand_info', 'db'):
+            if key in self.NOT_SAVED or key.startswith('_'):
                 continue
             d[key] = val
+        return d
 
+    def save(self):
+        d = self.info()
         log.debug('dump stand info %s', d)
 
-        with open(self.stand_info, 'wt') as f:
+        if self.store:
+            self.store.save_stand(self.name, d)
+            return
+
+        # Пишем во временный файл и подменяем, чтобы падение посреди записи не испортило информацию о стенде
+        tmp_path = self.stand_info + '.tmp'
+        with open(tmp_path, 'wt') as f:
             json.dump(d, f)
+        os.replace(tmp_path, self.stand_info)
+
+    def url(self) -> str:
+        """
+        :return: адрес веб-интерфейса стенда на хосте демона
+        """
+        return 'http://localhost:{0}/'.format(self.ports[0])
 
     def _create_hibernate_properties(self, pattern):
         log.debug('Create hibernate file for %s', self.name)
@@ -118,23 +171,46 @@ class Stand:
     def create_container(self):
         log.info('Create container. Image: %s, dir: %s, ports: %s', self.image, self.stand_dir, self.ports)
         log.debug('%s use docker create_container', self.name)
+        host_config = {'binds': ['{0}:/usr/local/uni'.format(self.stand_dir)],
+                       'port_bindings': {8080: self.ports[0],
+                                         8180: self.ports[1]}}
+        volumes = ['/usr/local/uni']
+        config = self.config or DaemonConfig().load_default()
+        cache = build_cache.shared(config)
+        # Общие распакованные сборки, webapp стенда ссылается на одну из них
+        if cache.shared_builds:
+            os.makedirs(cache.cache_dir, exist_ok=True)
+            host_config['binds'].append('{0}:{1}:ro'.format(os.path.abspath(cache.cache_dir),
+                                                             build_cache.BUILDS_MOUNT))
+            volumes.append(build_cache.BUILDS_MOUNT)
+        # Скомпилированные JSP хранятся в директории стенда, туда их кладет кэш сборок
+        if cache.tomcat_work:
+            work_dir = os.path.join(self.stand_dir, build_cache.TOMCAT_WORK)
+            os.makedirs(work_dir, exist_ok=True)
+            host_config['binds'].append('{0}:{1}'.format(work_dir, build_cache.TOMCAT_WORK_MOUNT))
+            volumes.append(build_cache.TOMCAT_WORK_MOUNT)
+        # Ограничение памяти по -Xmx, чтобы разросшийся стенд не вытеснил остальные в своп
+        mem_limit = memory.container_limit(self.catalina_opt, config.memory_jvm_overhead_mb * memory.MB)
+        if mem_limit:
+            host_config['mem_limit'] = mem_limit
+            host_config['memswap_limit'] = mem_limit
+        catalina_opts = self.catalina_opt
+        if cache.appcds:
+            catalina_opts = '{} {}'.format(catalina_opts, build_cache.APPCDS_OPTS)
         try:
             container_id = self.cli.create_container(image=self.image,
                                                      name=self.name,
-                                                     volumes=['/usr/local/uni'],
+                                                     volumes=volumes,
                                                      ports=[8080, 8180],
-                                                     host_config=self.cli.create_host_config(
-                                                             binds=['{0}:/usr/local/uni'.format(self.stand_dir)],
-                                                             port_bindings={8080: self.ports[0],
-                                                                            8180: self.ports[1]}),
-                                                     environment={'CATALINA_OPTS': self.catalina_opt,
+                                                     host_config=self.cli.create_host_config(**host_config),
+                                                     environment={'CATALINA_OPTS': catalina_opts,
                                                                   'TZ': 'Asia/Yekaterinburg'},
                                                      )
         except (errors.DockerException, errors.APIError) as e:
             raise DaemonException(str(e))
 
         self.container_id = container_id['Id']
-        self.write_json()
+        self.save()
         return self.container_id
 
     def start(self, wait=True):
@@ -144,11 +220,16 @@ class Stand:
             raise DaemonException('Container is not exists')
         if self.db_type == 'pgdocker':
             self.db.start()
+        build_cache.shared(self.config).install(self)
+        cursor = events.shared(self.config).cursor
+        self.started_at = time.time()
         try:
             self.cli.start(self.container_id)
         except (errors.DockerException, errors.APIError) as e:
             raise DaemonException(str(e))
-        self._check_uni_iface(blocking=wait)
+        # Готовность веб-интерфейса отслеживает монитор стендов, ожидание только ловит его событие
+        if wait:
+            self._wait_web_interface(cursor)
 
     def is_running(self):
         if not self.container_id:
@@ -159,56 +240,95 @@ class Stand:
             except (errors.DockerException, errors.APIError):
                 return False
 
-    @gen.coroutine
-    def _check_uni_iface(self, blocking=True, timeout=900):
-        log.debug('Check connect to %s container', self.name)
-
-        # Томкат начинает слушать порт не сразу. Игнорируем ошибки пока не истек таймаут
-        # Если контейнер не запущен, то веб-интерфейс не будет доступен
-        deadline = time.time() + timeout
-        while 1:
-            if not self.is_running():
-                self.web_interface_error = 'Container has unexpectedly stopped'
-                break
-            try:
-                if blocking:
-                    cl = HTTPClient()
-                    cl.fetch('http://localhost:{0}/'.format(self.ports[0]), request_timeout=timeout)
-                else:
-                    cl = AsyncHTTPClient()
-                    yield cl.fetch('http://localhost:{0}/'.format(self.ports[0]), request_timeout=timeout)
-
-                self.web_interface_error = None
-                break
-            except (ConnectionError, HTTPError) as e:
-                if time.time() < deadline:
-                    if blocking:
-                        time.sleep(5)
-                    else:
-                        yield gen.sleep(5)
-                else:
-                    self.web_interface_error = str(e)
-                    break
-            finally:
-                cl.close()
-
-        if self.web_interface_error:
-            log.info('Container %s is not available. Web interface error: %s', self.name, self.web_interface_error)
+    def _wait_web_interface(self, cursor):
+        """
+        Дождаться события монитора стендов о готовности веб-интерфейса или об ошибке после запуска.
+        Ожидание прерывается отменой задачи
+        :param cursor: курсор шины событий до запуска контейнера
+        """
+        config = self.config or DaemonConfig().load_default()
+        bus = events.shared(config)
+        timeout = config.health_startup_timeout + config.health_max_interval
+
+        def match(event):
+            if event['stand'] != self.name:
+                return False
+            if event['type'] == events.CONTAINER:
+                return event.get('action') in ('stop', 'die')
+            return event['type'] == events.WEB_INTERFACE
+
+        token = cancel.current()
+        with token.on_cancel(bus.wake):
+            event = bus.wait_for(cursor, match, timeout, stop=lambda: token.cancelled)
+        token.check()
+
+        if event and event['type'] == events.WEB_INTERFACE:
+            # web_interface_error уже выставил монитор
+            return
+        if event:
+            error = 'Container has unexpectedly stopped'
         else:
-            log.info('Container %s is available', self.name)
+            error = 'Web interface was not started in {} seconds'.format(timeout)
+        log.info('Container %s is not available. Web interface error: %s', self.name, error)
+        if error != self.web_interface_error:
+            self.web_interface_error = error
+            self.save()
+            bus.publish(events.WEB_INTERFACE, self.name, error=error)
+
+    def has_mount(self, container_path) -> bool:
+        """
+        Смонтирована ли в контейнер стенда директория хоста по пути container_path
+        """
+        if not self.container_id:
+            return False
+        try:
+            binds = self.cli.inspect_container(self.container_id)['HostConfig']['Binds'] or []
+        except (errors.DockerException, errors.APIError, KeyError):
+            return False
+        return any(bind.split(':')[1] == container_path for bind in binds)
+
+    def is_paused(self):
+        if not self.container_id:
+            return False
+        try:
+            return self.cli.inspect_container(self.container_id)['State']['Paused']
+        except (errors.DockerException, errors.APIError):
+            return False
 
-        self.write_json()
+    def pause(self):
+        """
+        Заморозить процессы контейнера. Память остается занятой, зато продолжение работы мгновенное
+        """
+        log.info('Pause container %s', self.name)
+        if not self.container_id:
+            raise DaemonException('Container is not exists')
+        try:
+            self.cli.pause(self.container_id)
+        except (errors.DockerException, errors.APIError) as e:
+            raise DaemonException(str(e))
+
+    def unpause(self):
+        log.info('Unpause container %s', self.name)
+        try:
+            self.cli.unpause(self.container_id)
+        except (errors.DockerException, errors.APIError) as e:
+            raise DaemonException(str(e))
 
     def stop(self, wait=True):
         log.info('Stop container %s', self.name)
         if not self.container_id:
             raise DaemonException('Container is not exists')
         try:
+            # Замороженный контейнер не получит сигнал остановки
+            if self.is_paused():
+                self.cli.unpause(self.container_id)
             self.cli.stop(self.container_id, timeout=60)
         except (errors.DockerException, errors.APIError) as e:
             raise DaemonException(str(e))
         if wait:
             self.cli.wait(self.container_id)
+        # JVM записывает архив AppCDS при выходе, docker stop возвращается после остановки контейнера
+        build_cache.shared(self.config).collect(self)
 
     def remove(self):
         self.stop()
@@ -218,4 +338,4 @@ class Stand:
         except (errors.DockerException, errors.APIError) as e:
             raise DaemonException(str(e))
         self.container_id = None
-        self.write_json()
+        self.save()
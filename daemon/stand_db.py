@@ -1,19 +1,30 @@
 import logging
+import ntpath
 import os
 import pymssql
+import shutil
 import socket
 import subprocess
 import time
-from threading import Timer
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import magic
-from docker import Client
 
+from daemon import cancel, docker_pool, memory, throttle
 from daemon.config import DaemonConfig
 from daemon.exceptions import DaemonException
 
 log = logging.getLogger(__name__)
 
+# Пути частей бэкапа mssql в MEDIADESCRIPTION первого файла набора
+_STRIPES_PREFIX = 'stripes:'
+_STRIPES_SEPARATOR = '|'
+_MEDIA_DESCRIPTION_MAX = 255
+
+# Сколько пачек удаления файлов базы mssql подряд может упасть, прежде чем reduce прервется
+_PURGE_MAX_FAILURES = 5
+
 
 class StandDb(object):
     def __init__(self, addr, name, user, password, port=None, config=None):
@@ -29,6 +40,25 @@ class StandDb(object):
         self.restore_timeout = config.restore_timeout
         self.quick_operation_timeout = 120
         self.middle_operation_timeout = 1200
+        self.throttle = throttle.shared(config)
+
+        # Длительность шагов последнего reduce, [(шаг, секунды), ...]
+        self.reduce_timings = []
+
+    @contextmanager
+    def _reduce_step(self, step):
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            self.reduce_timings.append((step, elapsed))
+            log.info('Reduce database %s: %s took %.1f s', self.name, step, elapsed)
+
+    def _log_reduce_timings(self):
+        log.info('Reduce database %s finished in %.1f s: %s', self.name,
+                 sum(elapsed for step, elapsed in self.reduce_timings),
+                 ', '.join('{} {:.1f} s'.format(step, elapsed) for step, elapsed in self.reduce_timings))
 
     def create(self):
         raise NotImplementedError
@@ -48,6 +78,39 @@ class StandDb(object):
     def set_1_1(self):
         raise NotImplementedError
 
+    def size(self) -> int:
+        """
+        Размер базы данных в байтах
+        """
+        raise NotImplementedError
+
+    def backup_free_space(self, backup_path):
+        """
+        Свободное место в байтах там, куда будет записан бэкап. None, если узнать нельзя
+        """
+        directory = os.path.dirname(backup_path)
+        if os.path.isdir(directory):
+            return shutil.disk_usage(directory).free
+        return None
+
+    def restore_free_space(self):
+        """
+        Свободное место в байтах на диске с файлами базы данных. None, если узнать нельзя
+        """
+        return None
+
+    def restore_dir(self):
+        """
+        Локальная директория на диске с файлами базы данных. None, если база на другом сервере
+        """
+        return None
+
+    def restore_size(self, backup_path):
+        """
+        Сколько места займет база после восстановления, если это можно узнать из самого бэкапа
+        """
+        return None
+
     def customer_patch(self):
         """
         Костыль. Ищет в названии базы имя клиента и делает запросы помогающие нам запуститься на этой базе
@@ -61,6 +124,15 @@ class StandMssqlDb(StandDb):
         if not config:
             config = DaemonConfig().load_default()
         self.db_files_dir = config.mssql_db_dir
+        self.backup_stripes = max(config.mssql_backup_stripes, 1)
+        self.backup_stripe_dirs = [d.strip() for d in config.mssql_backup_stripe_dirs.split(',') if d.strip()]
+        self.buffer_count = config.mssql_buffer_count
+        self.max_transfer_size = config.mssql_max_transfer_size
+        self.reduce_batch_seconds = config.mssql_reduce_batch_seconds
+        self.reduce_max_log_percent = config.mssql_reduce_max_log_percent
+        self.ghost_wait_timeout = config.mssql_ghost_wait_timeout
+        # Пауза перед повтором упавшей пачки удаления файлов, удваивается с каждой ошибкой подряд
+        self.purge_retry_seconds = 2
 
     def _run_sql(self, sql, timeout, connect_to_current_db=True, non_query=True, ignore_errors=False):
         log.debug('Run sql. Server %s, timeout %s, query %s', self.addr, timeout, sql)
@@ -75,16 +147,26 @@ class StandMssqlDb(StandDb):
         if connect_to_current_db:
             kw['database'] = self.name
 
+        token = cancel.current()
+        token.check()
         with pymssql.connect(**kw) as conn:
             conn.autocommit(True)
             cursor = conn.cursor()
+            spid = None
+            if token is not cancel.NEVER:
+                # Запрос выполняется на сервере, прервать его можно только KILL сессии из другого соединения
+                cursor.execute('SELECT @@SPID')
+                spid = cursor.fetchone()[0]
             try:
-                cursor.execute(sql)
+                with token.on_cancel(lambda: self._kill_session(spid)):
+                    cursor.execute(sql)
             except pymssql.Error as e:
+                token.check()
                 if ignore_errors:
                     log.warning(str(e))
                 else:
                     raise e
+            token.check()
             if not non_query:
                 l = cursor.fetchall()
                 log.debug('Result: %s', l)
@@ -103,21 +185,121 @@ class StandMssqlDb(StandDb):
         self._run_sql('ALTER DATABASE {} SET ALLOW_SNAPSHOT_ISOLATION ON;'.format(self.name),
                       timeout=self.quick_operation_timeout)
 
+    def _kill_session(self, spid):
+        log.info('Kill session %s of database %s on server %s', spid, self.name, self.addr)
+        with cancel.activate(None):
+            self._run_sql('KILL {}'.format(int(spid)), timeout=self.quick_operation_timeout,
+                          connect_to_current_db=False, ignore_errors=True)
+
+    def _stripe_paths(self, backup_path, stripes):
+        """
+        Файлы бэкапа, разбитого на несколько частей. Первая часть всегда лежит по backup_path,
+        чтобы бэкапы с именами по умолчанию находились как раньше. Остальные части раскладываются
+        по mssql_backup_stripe_dirs по кругу
+        """
+        directory, file_name = ntpath.split(backup_path)
+        dirs = self.backup_stripe_dirs or [directory]
+        paths = [backup_path]
+        for i in range(2, stripes + 1):
+            paths.append(ntpath.join(dirs[(i - 1) % len(dirs)], '{}.{}'.format(file_name, i)))
+        return paths
+
+    @staticmethod
+    def _disks(paths):
+        return ', '.join('DISK = \'{}\''.format(path) for path in paths)
+
+    def _transfer_options(self):
+        options = []
+        if self.buffer_count > 0:
+            options.append('BUFFERCOUNT = {}'.format(self.buffer_count))
+        if self.max_transfer_size > 0:
+            options.append('MAXTRANSFERSIZE = {}'.format(self.max_transfer_size))
+        return options
+
+    @staticmethod
+    def _media_description(paths):
+        """
+        Пути остальных частей бэкапа для заголовка первого файла, None если не влезают в MEDIADESCRIPTION
+        """
+        description = _STRIPES_PREFIX + _STRIPES_SEPARATOR.join(paths[1:])
+        return description if len(description) <= _MEDIA_DESCRIPTION_MAX else None
+
+    def _backup_stripe_paths(self, backup_path):
+        """
+        Все части существующего бэкапа. Пути частей записаны в заголовке первого файла при бэкапе, поэтому
+        бэкап восстанавливается после смены mssql_backup_stripe_dirs и на другом хосте
+        """
+        label = self._run_sql('RESTORE LABELONLY FROM DISK = \'{}\''.format(backup_path),
+                              timeout=self.quick_operation_timeout, non_query=False, connect_to_current_db=False)
+        # FamilyCount - количество файлов в наборе, MediaDescription - описание набора
+        family_count, description = label[0][2], label[0][7]
+        if family_count > 1 and description and description.startswith(_STRIPES_PREFIX):
+            paths = [backup_path] + description[len(_STRIPES_PREFIX):].split(_STRIPES_SEPARATOR)
+            if len(paths) == family_count:
+                return paths
+        if family_count > 1:
+            # Бэкапы без путей в заголовке: старые или со слишком длинными путями
+            log.warning('Backup %s has no stripe paths in media description. Use mssql_backup_stripe_dirs',
+                        backup_path)
+        return self._stripe_paths(backup_path, family_count)
+
+    def _drive_free_space(self, path):
+        drive = ntpath.splitdrive(path)[0].rstrip(':').upper()
+        if len(drive) != 1:
+            # UNC путь, xp_fixeddrives про него не знает
+            return None
+        for row in self._run_sql('EXEC master..xp_fixeddrives', timeout=self.quick_operation_timeout,
+                                 non_query=False, connect_to_current_db=False):
+            if row[0].upper() == drive:
+                return row[1] * 2 ** 20  # MB free
+        return None
+
+    def size(self) -> int:
+        return self._run_sql('SELECT SUM(CAST(size AS BIGINT)) * 8192 FROM sys.database_files;',
+                             timeout=self.quick_operation_timeout, non_query=False)[0][0]
+
+    def backup_free_space(self, backup_path):
+        return self._drive_free_space(backup_path)
+
+    def restore_free_space(self):
+        return self._drive_free_space(self.db_files_dir)
+
+    def restore_size(self, backup_path):
+        file_list = self._run_sql('RESTORE FILELISTONLY FROM {}'.format(self._disks(self._backup_stripe_paths(
+                backup_path))), timeout=self.quick_operation_timeout, non_query=False, connect_to_current_db=False)
+        # Size - размер файла базы в байтах
+        return sum(elem[4] for elem in file_list)
+
     def backup(self, backup_path):
         log.info('Backup database %s on server %s', self.name, self.addr)
-        sql = 'BACKUP DATABASE {} TO DISK = \'{}\' WITH INIT'.format(self.name,
-                                                                     backup_path)
+        paths = self._stripe_paths(backup_path, self.backup_stripes)
+        # FORMAT нужен чтобы перезаписать файл, который раньше был частью набора с другим количеством частей
+        options = ['FORMAT', 'INIT'] + self._transfer_options()
+        description = self._media_description(paths)
+        if len(paths) > 1:
+            if description:
+                options.append('MEDIADESCRIPTION = \'{}\''.format(description.replace('\'', '\'\'')))
+            else:
+                log.warning('Stripe paths of %s are too long for media description. Restore needs the same '
+                            'mssql_backup_stripe_dirs', backup_path)
+        sql = 'BACKUP DATABASE {} TO {} WITH {}'.format(self.name,
+                                                        self._disks(paths),
+                                                        ', '.join(options))
         self._run_sql(sql, timeout=self.backup_timeout)
 
     def restore(self, backup_path):
         log.info('Restore database %s on server %s', self.name, self.addr)
+        paths = self._backup_stripe_paths(backup_path)
+        if len(paths) > 1:
+            log.info('Backup %s consists of %s files', backup_path, len(paths))
+
         # Сначала узнаем какие файлы содержит бэкапю Возвращает таблицу
-        sql = 'RESTORE FILELISTONLY FROM DISK = \'{}\''.format(backup_path)
+        sql = 'RESTORE FILELISTONLY FROM {}'.format(self._disks(paths))
         file_list = self._run_sql(sql, timeout=self.quick_operation_timeout, non_query=False,
                                   connect_to_current_db=False)
 
         # Формируем скл запрос, который содержит правильные пути до файлов базы данных
-        sql_part = []
+        sql_part = ['RECOVERY', 'REPLACE'] + self._transfer_options()
 
         for elem in file_list:
             new_filename = '{}\{}_{}.{}'.format(self.db_files_dir,
@@ -126,9 +308,9 @@ class StandMssqlDb(StandDb):
                                                 ('LDF' if elem[2] == 'L' else 'MDF'))  # L или D. Лог или данные
 
             sql_part.append('MOVE \'{}\' TO \'{}\''.format(elem[0], new_filename))  # логическое имя
-        sql = 'RESTORE DATABASE {} FROM DISK = \'{}\' WITH RECOVERY, REPLACE, {};' \
+        sql = 'RESTORE DATABASE {} FROM {} WITH {};' \
             .format(self.name,
-                    backup_path,
+                    self._disks(paths),
                     ', '.join(sql_part))
         self._run_sql(sql, self.restore_timeout, connect_to_current_db=False)
 
@@ -167,89 +349,140 @@ class StandMssqlDb(StandDb):
             .format(db=self.name, user=user, schema=schema)
         self._run_sql(sql, timeout=self.quick_operation_timeout, ignore_errors=True)
 
+    def _log_used_percent(self):
+        return self._run_sql('SELECT used_log_space_in_percent FROM sys.dm_db_log_space_usage;',
+                             timeout=self.quick_operation_timeout, non_query=False)[0][0]
+
+    def _purge_database_files(self):
+        """
+        Удаляет файлы, хранящиеся в базе данных, серией небольших транзакций. Размер пачки подбирается
+        по времени выполнения предыдущей пачки и заполненности лога транзакций: слишком большие пачки
+        раздувают лог, слишком маленькие ползут
+        """
+        min_batch, max_batch = 100, 50000
+        batch = 1000
+        deleted = 0
+        failures = 0
+        deadline = time.time() + self.restore_timeout
+        while time.time() < deadline:
+            cancel.current().check()
+            started = time.time()
+            rows = self._run_sql(
+                    'use {}; update top({}) databasefile_t set content_p = null where content_p is not null and '
+                    '(filename_p not in (\'platform-variables.less\', \'platform.css\', \'shared.css\') '
+                    'or filename_p is null);'.format(self.name, batch),
+                    timeout=self.middle_operation_timeout, ignore_errors=True, non_query=True)
+            elapsed = time.time() - started
+
+            if rows == 0:
+                log.info('Removed %s database files from %s', deleted, self.name)
+                return
+
+            if rows < 0:
+                # Ошибка, скорее всего таймаут или переполнение лога. Пробуем пачкой поменьше после паузы
+                failures += 1
+                if failures >= _PURGE_MAX_FAILURES:
+                    raise DaemonException('Cannot remove database files of {}: {} batches failed in a row'
+                                          .format(self.name, failures))
+                batch = max(batch // 2, min_batch)
+                cancel.current().sleep(min(self.purge_retry_seconds * 2 ** (failures - 1), 60))
+                continue
+
+            failures = 0
+            deleted += rows
+            log_used = self._log_used_percent()
+            if log_used >= self.reduce_max_log_percent:
+                # В режиме SIMPLE чекпоинт освобождает лог
+                self._run_sql('use {}; CHECKPOINT;'.format(self.name),
+                              timeout=self.middle_operation_timeout, ignore_errors=True)
+                batch = max(batch // 2, min_batch)
+            elif elapsed > self.reduce_batch_seconds:
+                batch = max(int(batch * self.reduce_batch_seconds / elapsed), min_batch)
+            elif elapsed < self.reduce_batch_seconds / 2:
+                batch = min(batch * 2, max_batch)
+            log.debug('Removed %s files in %.1f s, log used %s%%, next batch %s', rows, elapsed, log_used, batch)
+
+        log.error('Timeout while removing database files. Stop operation')
+
+    def _wait_ghost_cleanup(self):
+        """
+        Mssql пылесос блобов работает в фоне. Если начать шринкать до того как он закончит,
+        то пылесосить дальше он будет после шринка и база будет ужата не полностью.
+        Ждем пока в databasefile_t не останется ghost записей, но не дольше mssql_ghost_wait_timeout
+        """
+        deadline = time.time() + self.ghost_wait_timeout
+        while 1:
+            ghosts = self._run_sql('SELECT ISNULL(SUM(ghost_record_count), 0) '
+                                   'FROM sys.dm_db_index_physical_stats(DB_ID(), OBJECT_ID(\'databasefile_t\'), '
+                                   'NULL, NULL, \'SAMPLED\');',
+                                   timeout=self.middle_operation_timeout, non_query=False)[0][0]
+            if ghosts == 0:
+                return
+            if time.time() >= deadline:
+                log.warning('%s ghost records are still in databasefile_t of %s. Shrink anyway', ghosts, self.name)
+                return
+            log.debug('Wait ghost cleanup in %s, %s records left', self.name, ghosts)
+            cancel.current().sleep(5)
+
     def reduce(self):
         log.info('Reduce database %s on server %s', self.name, self.addr)
+        self.reduce_timings = []
+
         # Отключаем лог транзакций
         self._run_sql('ALTER DATABASE {} SET RECOVERY SIMPLE; '.format(self.name),
                       timeout=self.quick_operation_timeout, ignore_errors=False)
+        try:
+            self._reduce()
+        finally:
+            # Включаем полноценный лог транзакций, в том числе после отмены
+            with cancel.activate(None):
+                self._run_sql('ALTER DATABASE {} SET RECOVERY FULL; '.format(self.name),
+                              timeout=self.quick_operation_timeout, ignore_errors=False)
+        self._log_reduce_timings()
+
+    def _reduce(self):
+        with self._reduce_step('truncate logs'):
+            # Сразу уменьшим логи транзакций чтобы создать больше места
+            self._run_sql('use {name}; DBCC SHRINKFILE ({name}_log, 1);'.format(name=self.name),
+                          timeout=self.middle_operation_timeout, ignore_errors=True)
+
+            # Чистим логи uni. Констреинт будет создан автоматически платформой при запуске
+            self._run_sql('use {}; '
+                          'truncate table logeventproperty_t; '
+                          'alter table logeventproperty_t drop constraint fk_event_logeventproperty; '
+                          'truncate table logevent_t;'.format(self.name),
+                          timeout=self.quick_operation_timeout, ignore_errors=False)
 
-        # Сразу уменьшим логи транзакций чтобы создать больше места
-        self._run_sql('use {name}; DBCC SHRINKFILE ({name}_log, 1);'.format(name=self.name),
-                      timeout=self.middle_operation_timeout, ignore_errors=True)
-
-        # Чистим логи uni. Констреинт будет создан автоматически платформой при запуске
-        self._run_sql('use {}; '
-                      'truncate table logeventproperty_t; '
-                      'alter table logeventproperty_t drop constraint fk_event_logeventproperty; '
-                      'truncate table logevent_t;'.format(self.name),
-                      timeout=self.quick_operation_timeout, ignore_errors=False)
-
-        # Чистим логи nsi если они есть
-        self._run_sql('use {}; truncate table nsientitylog_t;'.format(self.name),
-                      timeout=self.quick_operation_timeout, ignore_errors=True)
+            # Чистим логи nsi если они есть
+            self._run_sql('use {}; truncate table nsientitylog_t;'.format(self.name),
+                          timeout=self.quick_operation_timeout, ignore_errors=True)
 
-        # Удаляем содержимое таблиц, хранящих печатные формы различных документов, если они есть
-        self._run_sql('use {}; truncate table STUDENTEXTRACTTEXTRELATION_T;'.format(self.name),
-                      timeout=self.quick_operation_timeout, ignore_errors=True)
-        self._run_sql('use {}; truncate table StudentOrderTextRelation_t;'.format(self.name),
-                      timeout=self.quick_operation_timeout, ignore_errors=True)
-        self._run_sql('use {}; truncate table stdntothrordrtxtrltn_t;'.format(self.name),
-                      timeout=self.quick_operation_timeout, ignore_errors=True)
-        self._run_sql('use {}; truncate table employeeordertextrelation_t;'.format(self.name),
-                      timeout=self.quick_operation_timeout, ignore_errors=True)
-        self._run_sql('use {}; truncate table employeeextracttextrelation_t;'.format(self.name),
-                      timeout=self.quick_operation_timeout, ignore_errors=True)
-        self._run_sql('use {}; truncate table session_doc_printform_t;'.format(self.name),
-                      timeout=self.quick_operation_timeout, ignore_errors=True)
-        self._run_sql('use {}; truncate table session_att_bull_printform_t;'.format(self.name),
-                      timeout=self.quick_operation_timeout, ignore_errors=True)
-
-        # Удаляем файлы, хранящиеся в базе данных. Mssql пылесос блобов работает в фоне,
-        # поэтому удаляем серией маленьких транзакций по 500 файлов
-
-        def timeout_err():
-            log.error('Timeout while removing database files. Stop operation')
-
-        t = Timer(self.restore_timeout, timeout_err)
-        t.start()
-        while not t.finished.is_set():
-            if self._run_sql(
-                    'use {}; update top(1000) databasefile_t set content_p = null where content_p is not null and '
-                    '(filename_p not in (\'platform-variables.less\', \'platform.css\', \'shared.css\') '
-                    'or filename_p is null);'.format(self.name),
-                    timeout=self.middle_operation_timeout, ignore_errors=True, non_query=True) == 0:
-                t.cancel()
-                break
+        with self._reduce_step('truncate print forms'):
+            # Удаляем содержимое таблиц, хранящих печатные формы различных документов, если они есть
+            for table in ('STUDENTEXTRACTTEXTRELATION_T', 'StudentOrderTextRelation_t', 'stdntothrordrtxtrltn_t',
+                          'employeeordertextrelation_t', 'employeeextracttextrelation_t', 'session_doc_printform_t',
+                          'session_att_bull_printform_t'):
+                self._run_sql('use {}; truncate table {};'.format(self.name, table),
+                              timeout=self.quick_operation_timeout, ignore_errors=True)
 
-        # Ждем пока пылесос подчистит оставшееся, если мы начнем шринкать до этого момента,
-        # то пылесосить дальше он будет после шринка, что приведет к тому что база будет ужата не полностью
-        size_before = 999999999
-        while 1:
-            table_row = self._run_sql('sp_spaceused DATABASEFILE_T;'.format(self.name),
-                                      ignore_errors=False, non_query=False, timeout=self.quick_operation_timeout)[0]
-            # третья строка содержит размер данных таблицы,в виде строки, убираю ' KB' чтобы получить число
-            size_at_moment = int(table_row[3][:-3])
-            if size_at_moment == size_before:
-                break
-            else:
-                size_before = size_at_moment
-                time.sleep(60)
+        with self._reduce_step('remove database files'):
+            self._purge_database_files()
 
-        # Еще раз удаляем лог транзакций после операции update
-        self._run_sql('use {name}; DBCC SHRINKFILE ({name}_log, 1);'.format(name=self.name),
-                      timeout=self.middle_operation_timeout, ignore_errors=True)
+        with self._reduce_step('wait ghost cleanup'):
+            self._wait_ghost_cleanup()
 
-        # Уменьшаем базу, освобождаем место на диске. Оставляем 5% свободного места
-        self._run_sql('DBCC SHRINKDATABASE ({}, 5);'.format(self.name),
-                      timeout=self.restore_timeout, ignore_errors=False)
+        with self._reduce_step('shrink'):
+            # Еще раз удаляем лог транзакций после операции update
+            self._run_sql('use {name}; DBCC SHRINKFILE ({name}_log, 1);'.format(name=self.name),
+                          timeout=self.middle_operation_timeout, ignore_errors=True)
 
-        # Еще раз удаляем лог транзакций последний операций
-        self._run_sql('use {name}; DBCC SHRINKFILE ({name}_log, 1);'.format(name=self.name),
-                      timeout=self.middle_operation_timeout, ignore_errors=True)
+            # Уменьшаем базу, освобождаем место на диске. Оставляем 5% свободного места
+            self._run_sql('DBCC SHRINKDATABASE ({}, 5);'.format(self.name),
+                          timeout=self.restore_timeout, ignore_errors=False)
 
-        # Включаем полноценный лог транзакций
-        self._run_sql('ALTER DATABASE {} SET RECOVERY FULL; '.format(self.name),
-                      timeout=self.quick_operation_timeout, ignore_errors=False)
+            # Еще раз удаляем лог транзакций последний операций
+            self._run_sql('use {name}; DBCC SHRINKFILE ({name}_log, 1);'.format(name=self.name),
+                          timeout=self.middle_operation_timeout, ignore_errors=True)
 
     def set_1_1(self):
         log.info('Set user and password 1:1 in database %s on server %s', self.name, self.addr)
@@ -268,8 +501,11 @@ class StandPostgresDb(StandDb):
         if not config:
             config = DaemonConfig().load_default()
         self.ignore_restore_errors = config.postgres_ignore_restore_errors
+        self.reduce_mode = config.postgres_reduce_mode
+        self.reduce_batch = config.postgres_reduce_batch
+        self.reduce_workers = config.postgres_reduce_workers
 
-    def _run_console_command(self, args, timeout, ignore_error=False, stdin=None):
+    def _run_console_command(self, args, timeout, ignore_error=False, stdin=None) -> str:
         common = [
             '--host', self.addr,
             '--username', self.user,
@@ -279,12 +515,18 @@ class StandPostgresDb(StandDb):
         common.reverse()
         for elem in common:
             args.insert(1, elem)
+        args = self.throttle.wrap_command(args)
 
         log.debug('Run process with command: %s', ' '.join(args))
-        os.putenv('PGPASSWORD', self.password)
-        process = subprocess.Popen(args=args,
+        # Пароль передаем через окружение процесса, а не демона: команды могут выполняться параллельно
+        env = dict(os.environ, PGPASSWORD=self.password)
+        token = cancel.current()
+        token.check()
+        process = subprocess.Popen(args=args, env=env,
                                    stderr=subprocess.PIPE, stdout=subprocess.PIPE, stdin=stdin)
-        out, err = process.communicate(timeout=timeout)
+        with token.on_cancel(process.kill):
+            out, err = process.communicate(timeout=timeout)
+        token.check()
         if process.returncode != 0:
             log.warning(' '.join(args))
             # Чтобы ошибки восстановления не засирали лог вывводим первые 1000 символов
@@ -295,6 +537,13 @@ class StandPostgresDb(StandDb):
                 log.warning('{} \n and another {} symbols'.format(error_text[-1000:], len(error_text) - 1000))
             if not ignore_error:
                 raise DaemonException('Console command for postgresql failed. See log for details')
+        return out.decode()
+
+    def size(self) -> int:
+        out = self._run_console_command(['psql', '--tuples-only', '--no-align',
+                                         '--command', 'select pg_database_size(\'{}\')'.format(self.name)],
+                                        timeout=self.quick_operation_timeout)
+        return int(out.strip())
 
     def create(self):
         log.info('Create database %s on server %s', self.name, self.addr)
@@ -364,57 +613,95 @@ class StandPostgresDb(StandDb):
                     ]
             self._run_console_command(args, timeout=self.quick_operation_timeout, ignore_error=True)
 
-    def reduce(self):
-        log.info('Reduce database %s on server %s', self.name, self.addr)
-
-        args = ['psql',
-                '--dbname', self.name,
-                '--command', 'truncate logevent_t cascade;',
-                ]
-        self._run_console_command(args, timeout=self.quick_operation_timeout)
-
-        args = ['psql',
-                '--dbname', self.name,
-                '--command', 'truncate nsientitylog_t;',
-                ]
-        self._run_console_command(args, timeout=self.quick_operation_timeout, ignore_error=True)
+    def _psql(self, sql, timeout, ignore_error=False):
+        return self._run_console_command(['psql', '--dbname', self.name, '--command', sql],
+                                         timeout=timeout, ignore_error=ignore_error)
 
+    def _truncate_tables(self, executor):
+        """
+        Чистит журналы и таблицы с печатными формами. Таблицы независимы, поэтому truncate идут параллельно
+        """
+        # Отмена задачи должна дойти до потоков executor
+        psql = cancel.bind(self._psql)
+        futures = [executor.submit(psql, 'truncate logevent_t cascade;', self.quick_operation_timeout)]
         # Удаляем содержимое таблиц, хранящих печатные формы различных документов, если они есть
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table STUDENTEXTRACTTEXTRELATION_T;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table StudentOrderTextRelation_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table stdntothrordrtxtrltn_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table employeeordertextrelation_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table employeeextracttextrelation_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table session_doc_printform_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table session_att_bull_printform_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
+        for table in ('nsientitylog_t', 'STUDENTEXTRACTTEXTRELATION_T', 'StudentOrderTextRelation_t',
+                      'stdntothrordrtxtrltn_t', 'employeeordertextrelation_t', 'employeeextracttextrelation_t',
+                      'session_doc_printform_t', 'session_att_bull_printform_t'):
+            futures.append(executor.submit(psql, 'truncate table {};'.format(table),
+                                           self.quick_operation_timeout, ignore_error=True))
+        return futures
+
+    def _purge_database_files(self):
+        """
+        Удаляет файлы, хранящиеся в базе данных, пачками по postgres_reduce_batch строк по возрастанию id.
+        Каждая пачка - отдельная транзакция, поэтому таблица не блокируется надолго. Закончили, когда после
+        последнего id строк не осталось. Ошибка пачки прерывает reduce, а не выдается за конец таблицы
+        """
+        deleted = 0
+        last_id = 0
+        deadline = time.time() + self.restore_timeout
+        while time.time() < deadline:
+            cancel.current().check()
+            out = self._run_console_command(
+                    ['psql', '--dbname', self.name, '--tuples-only', '--no-align', '--command',
+                     'with batch as (select id from databasefile_t where id > {last_id} order by id limit {limit}), '
+                     'purged as (update databasefile_t set content_p = null '
+                     'where id in (select id from batch) and content_p is not null and '
+                     '(filename_p is null '
+                     'or filename_p not in (\'platform-variables.less\', \'platform.css\', \'shared.css\')) '
+                     'returning 1) '
+                     'select (select max(id) from batch), (select count(*) from purged);'
+                     .format(last_id=last_id, limit=self.reduce_batch)],
+                    timeout=self.middle_operation_timeout)
+            batch_last_id, rows = out.strip().split('|')
+            if not batch_last_id:
+                log.info('Removed %s database files from %s', deleted, self.name)
+                return
+            last_id = int(batch_last_id)
+            deleted += int(rows)
+
+        raise DaemonException('Timeout while removing database files of {}'.format(self.name))
+
+    def _reduce_chunked(self):
+        with ThreadPoolExecutor(max_workers=self.reduce_workers) as executor:
+            with self._reduce_step('truncate tables and remove database files'):
+                futures = self._truncate_tables(executor)
+                futures.append(executor.submit(cancel.bind(self._purge_database_files)))
+                for f in futures:
+                    f.result()
+
+        # После truncate таблицы уже пустые, переписать надо только databasefile_t вместе с ее TOAST
+        with self._reduce_step('vacuum full databasefile_t'):
+            self._psql('vacuum (full, analyze) databasefile_t;', timeout=self.restore_timeout)
+
+    def _reduce_full(self):
+        with self._reduce_step('truncate tables'):
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                for f in self._truncate_tables(executor):
+                    f.result()
+
+        with self._reduce_step('remove database files'):
+            self._psql('update databasefile_t set content_p = null where content_p is not null and '
+                       '(filename_p is null '
+                       'or filename_p not in (\'platform-variables.less\', \'platform.css\', \'shared.css\'));',
+                       timeout=self.restore_timeout, ignore_error=True)
+
+        with self._reduce_step('vacuum full'):
+            self._psql('vacuum full;', timeout=self.restore_timeout)
 
-        args = ['psql',
-                '--dbname', self.name,
-                '--command', 'update databasefile_t set content_p = null where content_p is not null and '
-                             '(filename_p is null '
-                             'or filename_p not in (\'platform-variables.less\', \'platform.css\', \'shared.css\'));',
-                ]
-        self._run_console_command(args, timeout=self.restore_timeout, ignore_error=True)
+    def reduce(self):
+        log.info('Reduce database %s on server %s, mode %s', self.name, self.addr, self.reduce_mode)
+        self.reduce_timings = []
 
-        args = ['psql',
-                '--dbname', self.name,
-                '--command', 'vacuum full;',
-                ]
-        self._run_console_command(args, timeout=self.restore_timeout)
+        if self.reduce_mode == 'chunked':
+            self._reduce_chunked()
+        elif self.reduce_mode == 'full':
+            self._reduce_full()
+        else:
+            raise DaemonException('Unsupported postgres reduce mode')
+
+        self._log_reduce_timings()
 
     def set_1_1(self):
         log.info('Set user and password 1:1 in database %s on server %s', self.name, self.addr)
@@ -430,7 +717,7 @@ class StandPostgresDb(StandDb):
 
 
 class StandDockerPostgres(StandPostgresDb):
-    def __init__(self, addr, container_name, ssh_user, ssh_password, port, config=None):
+    def __init__(self, addr, container_name, ssh_user, ssh_password, port, config=None, docker=None):
         # База данных в контейнере всегда uni, юзер и пароль postgres, нет смысла менять
         super(StandDockerPostgres, self).__init__(addr, 'uni', 'postgres', 'postgres', port, config)
 
@@ -439,18 +726,24 @@ class StandDockerPostgres(StandPostgresDb):
         self.ssh_pass = ssh_password
         if not config:
             config = DaemonConfig().load_default()
+        self.mem_limit = config.memory_pgdocker_mb * memory.MB
         if config.pgdocker_use_ssh:
             raise NotImplementedError
         else:
-            self.docker = Client(base_url='unix://var/run/docker.sock')
+            self.docker = docker or docker_pool.shared(config)
 
     def _create_container(self):
+        host_config = {'port_bindings': {5432: self.port}}
+        if self.throttle.blkio_weight:
+            host_config['blkio_weight'] = self.throttle.blkio_weight
+        if self.mem_limit:
+            host_config['mem_limit'] = self.mem_limit
+            host_config['memswap_limit'] = self.mem_limit
         self.docker.create_container(image='postgres:9.4',
                                      name=self.container_name,
                                      detach=True,
                                      ports=[5432],
-                                     host_config=self.docker.create_host_config(
-                                             port_bindings={5432: self.port}),
+                                     host_config=self.docker.create_host_config(**host_config),
                                      environment={'POSTGRES_PASSWORD': 'postgres',
                                                   'TZ': 'Asia/Yekaterinburg'},
                                      )
@@ -483,6 +776,50 @@ class StandDockerPostgres(StandPostgresDb):
                 if c == 9:
                     raise e
 
+    def restore_dir(self):
+        # Тома контейнеров лежат в корне докера на этом же сервере
+        return self.docker.info()['DockerRootDir']
+
+    def restore_free_space(self):
+        return shutil.disk_usage(self.restore_dir()).free
+
+    def _apply_blkio_weight(self):
+        # Вес мог поменяться на лету после создания контейнера
+        if self.throttle.blkio_weight:
+            self.docker.update_container(self.container_name, blkio_weight=self.throttle.blkio_weight)
+
+    def _docker_cp(self, args, src, dst, timeout):
+        """
+        docker cp через pipe с ограничением скорости копирования
+        """
+        deadline = time.time() + timeout
+        args = self.throttle.wrap_command(['docker', 'cp'] + args)
+        log.debug('Run command %s', ' '.join(args))
+        if src is None:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE)
+            src = process.stdout
+        else:
+            process = subprocess.Popen(args, stdin=subprocess.PIPE)
+            dst = process.stdin
+        token = cancel.current()
+        with throttle.kill_after(process, timeout) as expired:
+            try:
+                with token.on_cancel(process.kill):
+                    self.throttle.copy(src, dst, deadline=deadline)
+            except Exception:
+                process.kill()
+                token.check()
+                if expired.is_set():
+                    raise DaemonException('docker cp was not finished in {} s'.format(timeout))
+                raise
+            finally:
+                (process.stdin or process.stdout).close()
+        if expired.is_set():
+            process.wait()
+            raise DaemonException('docker cp was not finished in {} s'.format(timeout))
+        if process.wait(timeout=max(deadline - time.time(), 1)) != 0:
+            raise DaemonException('docker cp failed with code {}'.format(process.returncode))
+
     def backup(self, backup_path):
         log.info('Backup database container %s on server %s', self.container_name, self.addr)
         # https://www.postgresql.org/docs/9.4/static/backup-file.html
@@ -490,10 +827,10 @@ class StandDockerPostgres(StandPostgresDb):
         self.docker.stop(self.container_name, timeout=60)
         self.docker.wait(self.container_name)
         # Я использую subprocess, чтобы бэкапы не гонялись по сети.
-        command = 'docker cp {}:/var/lib/postgresql/data/. - > {}'.format(self.container_name, backup_path)
-        log.debug('Run command %s', command)
         try:
-            subprocess.check_call(command, shell=True, timeout=self.backup_timeout)
+            with open(backup_path, 'wb') as f:
+                self._docker_cp(['{}:/var/lib/postgresql/data/.'.format(self.container_name), '-'],
+                                None, f, timeout=self.backup_timeout)
         finally:
             self.start()
 
@@ -508,8 +845,10 @@ class StandDockerPostgres(StandPostgresDb):
             # Контейнер не остановлен, используем флаг force
             self.docker.remove_container(self.container_name, v=True, force=True)
             self._create_container()
-            command = 'docker cp - {}:/var/lib/postgresql/data < {}'.format(self.container_name, backup_path)
-            subprocess.check_call(command, timeout=self.restore_timeout, shell=True)
+            with open(backup_path, 'rb') as f:
+                self._docker_cp(['-', '{}:/var/lib/postgresql/data'.format(self.container_name)],
+                                f, None, timeout=self.restore_timeout)
             self.start()
         else:
+            self._apply_blkio_weight()
             super(StandDockerPostgres, self).restore(backup_path)
@@ -1,15 +1,17 @@
 import datetime
-import json
 import logging
 import os
 import socket
+import threading
+import time
 
-from docker import Client
-
-from daemon import task
+from daemon import build_cache, docker_pool, scheduler, task
 from daemon.config import DaemonConfig
 from daemon.exceptions import DaemonException
+from daemon.memory import MemoryAdmission
+from daemon.port_allocator import PortAllocator
 from daemon.stand import Stand
+from daemon.state_store import StateStore
 
 log = logging.getLogger(__name__)
 
@@ -17,6 +19,7 @@ log = logging.getLogger(__name__)
 class StandManager:
     def __init__(self, config: DaemonConfig):
         log.info('Start stand manager')
+        self.config = config
 
         self.max_active_stands = config.max_active_stands
         self.work_dir = config.work_dir
@@ -26,6 +29,8 @@ class StandManager:
         self.start_port = config.start_port
         self.ports = config.ports
         self.stop_by_timeout = config.stop_by_timeout
+        self.memory_admission = config.memory_admission
+        self.pause_recent_minutes = config.pause_recent_minutes
 
         self.image = config.image
         self.catalina_opt = config.catalina_opt
@@ -54,8 +59,11 @@ class StandManager:
         self.jenkins_user = config.jenkins_user
         self.jenkins_pass = config.jenkins_pass
 
+        self.reduced_cache_dir = config.reduced_cache_dir
+
         self.stands_dir = os.path.join(self.work_dir, 'stands')
-        self.cli = Client(base_url='unix://var/run/docker.sock')
+        self.cli = docker_pool.shared(config)
+        self.memory = MemoryAdmission(self.cli, config)
 
         # валидация рабочей директории
         if not os.path.isdir(self.work_dir):
@@ -68,32 +76,78 @@ class StandManager:
         # создание объектов-контейнеров для имеющихся стендов
         """:type : dict[Stand]"""
         self.stands = {}
-        #  Хранит футуры,которые должны выключить стенды
-        self.stands_futures = {}
         # Собирает незавершенные таски найденные во время запуска
         self.uncompleted_tasks = []
-
-        for stand_dir in os.listdir(self.stands_dir):
-            stand_info_path = os.path.join(self.stands_dir, stand_dir, 'stand_info.json')
-            if os.path.isfile(stand_info_path):
-                self._init_stand(stand_info_path)
+        # Последняя задача каждого стенда, в нее сливаются одинаковые задачи, пока она ждет в очереди
+        self._tasks = {}
+        # Проверка стенда и создание задачи выполняются атомарно, иначе два запроса создадут две задачи
+        self._task_lock = threading.RLock()
+
+        self.store = StateStore(os.path.join(self.work_dir, 'state.db'))
+        if self.store.is_empty():
+            self.store.import_stand_files(self.stands_dir)
+        self.port_allocator = PortAllocator(self.store, {'stand': (self.start_port, self.ports),
+                                                         'pgdocker': (self.pgdocker_start_port, self.pgdocker_ports)})
+
+        with self.store.batch():
+            for stand_info in self.store.load_stands():
+                self.stands[stand_info['name']] = Stand(store=self.store, cli=self.cli, config=config, **stand_info)
+            self._reconcile_containers()
+            for name in self.store.stands_with_task():
+                self._resume_task(self.stands[name])
+
+        for t in self.uncompleted_tasks:
+            self._tasks[t.stand.name] = t
 
         log.info('Found containers: %s', ', '.join(self.stands.keys()))
+        cache = build_cache.shared(config)
+        cache.used_builds = self._used_builds
+        cache.prune(self._used_builds())
 
-    def _init_stand(self, stand_info_path):
-        with open(stand_info_path, 'rt') as f:
-            stand_info = json.loads(f.read())
-        stand = Stand(**stand_info)
-        self.stands[stand_info['name']] = stand
+        # Планировщик загружает сроки из информации о стендах, запускается демоном
+        self.scheduler = scheduler.Scheduler(self.stands)
+        self.scheduler.register(scheduler.STOP, self._scheduled_stop)
+        # Функция имя стенда -> работают ли со стендом. Активный стенд не останавливается по таймауту
+        self.is_busy = None
 
-        active_task = stand_info['active_task']
+    def _reconcile_containers(self):
+        """
+        Сверяет стенды с контейнерами докера одним запросом. Стенды, контейнеры которых удалены в обход демона,
+        становятся несозданными. Порты удаленных стендов возвращаются в диапазоны, порты чужих контейнеров
+        помечаются занятыми
+        """
+        containers = {c['Id']: c for c in self.cli.containers(all=True)}
+        docker_ports = {p['PublicPort'] for c in containers.values()
+                        for p in c.get('Ports') or () if 'PublicPort' in p}
+        stand_ports = {'stand': {}, 'pgdocker': {}}
+        running = []
+        for stand in self.stands.values():
+            for port in stand.ports:
+                stand_ports['stand'][port] = stand.name
+            if stand.db_type == 'pgdocker':
+                stand_ports['pgdocker'][stand.db_port] = stand.name
+
+            if not stand.container_id:
+                continue
+            container = containers.get(stand.container_id)
+            if not container:
+                log.warning('Container of stand %s was removed outside of daemon', stand.name)
+                stand.container_id = None
+                stand.save()
+            elif container['State'] == 'running':
+                running.append(stand.name)
+        log.info('Running containers: %s', ', '.join(running))
+        self.port_allocator.reconcile(stand_ports, docker_ports)
+
+    def _resume_task(self, stand):
+        active_task = stand.active_task
         if active_task:
-            log.info('Uncompleted task %s in %s', active_task, stand_info_path)
+            log.info('Uncompleted task %s of stand %s', active_task, stand.name)
 
             # задачи которые успели дойти до тестового запуска продолжать нет смысла
             if active_task['status'] == task.TEST_RUN:
                 stand.active_task = None
-                stand.write_json()
+                stand.save()
                 return
 
             # если задача закончилась с ошибкой, то ничего не делаем. инфа должна остаться
@@ -106,6 +160,12 @@ class StandManager:
                 self.uncompleted_tasks.append(t)
                 return
 
+            # ожидание места на диске происходит до начала бэкапа или восстановления
+            if active_task['status'] == task.WAIT_DISK_SPACE and active_task['do'] != task.DO_ADD_NEW:
+                t = task.Task(do=active_task['do'], stand=stand, **active_task['task_params'])
+                self.uncompleted_tasks.append(t)
+                return
+
             # задачи в статусе бидла эквиваленты обновлению
             if active_task['status'] == task.BUILD_AND_UPLOAD:
                 t = task.Task(do=task.DO_UPDATE, stand=stand, **active_task['task_params'])
@@ -136,39 +196,22 @@ class StandManager:
 
             raise RuntimeError('Oops, what I should do with stand %s and task %s ?' % (stand.name, active_task))
 
-    def _get_ports(self):
-        used_ports = []
-        for stand in self.stands.values():
-            used_ports += stand.ports
-
-        ports = []
-        for port in range(self.start_port, self.start_port + self.ports):
-            if len(ports) == 2:
-                return ports
-
-            if port not in used_ports:
-                ports.append(port)
-
-        raise DaemonException('No free port')
-
-    def _get_pgdocker_port(self):
-        used_ports = []
-        for stand in self.stands.values():
-            if stand.db_type == 'pgdocker':
-                used_ports.append(stand.db_port)
-
-        for port in range(self.pgdocker_start_port,
-                          self.pgdocker_start_port + self.pgdocker_ports):
-            if port not in used_ports:
-                return port
-
-        raise DaemonException('No free port')
-
-    def free_resources(self) -> bool:
+    def free_resources(self, name=None) -> bool:
         """
-        Можно ли запустить еще один стенд
+        Можно ли запустить еще один стенд. Если включен memory_admission и известен стенд,
+        решает доступная память хоста, иначе количество запущенных стендов
+        :param name: стенд, который нужно запустить
         """
-        if len(self.cli.containers(all=False)) >= self.max_active_stands:
+        containers = self.cli.containers(all=False)
+        if self.memory_admission and name in self.stands:
+            running_ids = {c['Id'] for c in containers}
+            running = [s for s in self.stands.values() if s.container_id in running_ids]
+            if not self.memory.admit(self.stands[name], running):
+                log.info('No memory for %s', name)
+                return False
+            return True
+
+        if len(containers) >= self.max_active_stands:
             log.info('No resources')
             return False
 
@@ -290,9 +333,6 @@ class StandManager:
         :return: Задача
         """
         log.debug('Add new task ADD for stand %s', name)
-        if name in self.stands.keys():
-            raise DaemonException('Stand with the same name is already exists')
-
         if existed_db and uni_schema:
             raise DaemonException('Cannot apply uni schema in existed database. '
                                   'Use specific database name or default name')
@@ -309,8 +349,23 @@ class StandManager:
         if db_container and db_type != 'pgdocker':
             raise DaemonException('You can use db_container only for pgdocker db_type')
 
-        ports = self._get_ports()
+        with self._task_lock:
+            if name in self.stands.keys():
+                raise DaemonException('Stand with the same name is already exists')
 
+            # Порты занимаются сразу, чтобы параллельное создание стенда не получило те же порты
+            ports = self.port_allocator.reserve('stand', name, count=2)
+            try:
+                return self._add_new(name, db_type, jenkins_project, ports, db_addr, db_port, db_name, db_user,
+                                     db_pass, db_container, description, jenkins_version, validate_entity_code,
+                                     do_build, existed_db, backup_file, reduce, uni_schema)
+            except Exception:
+                self.port_allocator.release(name)
+                raise
+
+    def _add_new(self, name, db_type, jenkins_project, ports, db_addr, db_port, db_name, db_user, db_pass,
+                 db_container, description, jenkins_version, validate_entity_code, do_build,
+                 existed_db, backup_file, reduce, uni_schema) -> task.Task:
         stand_dir = os.path.join(self.stands_dir, name)
 
         if not db_name:
@@ -349,8 +404,10 @@ class StandManager:
         elif db_type == 'pgdocker':
             if not db_addr:
                 db_addr = self.pgdocker_addr
-            if not db_port:
-                db_port = self._get_pgdocker_port()
+            if db_port:
+                self.port_allocator.reserve_port('pgdocker', int(db_port), name)
+            else:
+                db_port = self.port_allocator.reserve('pgdocker', name)[0]
             if not db_container:
                 db_container = db_name
             db_name = 'uni'
@@ -398,12 +455,16 @@ class StandManager:
                          'jenkins_user': self.jenkins_user,
                          'jenkins_pass': self.jenkins_pass,
                          'version': None,
+                         'build_id': None,
 
                          'active_task': None,
                          'web_interface_error': None,
+                         'last_access': None,
+                         'scheduled': {},
                          }
 
-        stand = Stand(**stand_details)
+        stand = Stand(store=self.store, cli=self.cli, config=self.config, **stand_details)
+        stand.save()
         self.stands[name] = stand
 
         if backup_file:
@@ -411,17 +472,53 @@ class StandManager:
         else:
             backup_path = None
 
-        return task.Task(do=task.DO_ADD_NEW,
-                         stand=stand,
-                         config_dir=self.config_dir,
-                         pattern=pattern,
-                         existed_db=existed_db,
-                         backup_path=backup_path,
-                         reduce=reduce,
-                         do_build=do_build,
-                         )
-
-    def _stand_with_validate(self, name, for_task=True):
+        return self._task(stand, task.DO_ADD_NEW,
+                          config_dir=self.config_dir,
+                          pattern=pattern,
+                          existed_db=existed_db,
+                          backup_path=backup_path,
+                          reduce=reduce,
+                          do_build=do_build,
+                          reduced_cache_dir=self.reduced_cache_dir or None,
+                          )
+
+    def _used_builds(self) -> set:
+        return {s.build_id for s in list(self.stands.values()) if s.build_id}
+
+    def pending_task(self, name) -> task.Task:
+        """
+        :return: задача стенда, которая ждет в очереди и еще не начала выполняться
+        """
+        t = self._tasks.get(name)
+        if t and not t.started and not t.finished and t.status == task.WAIT:
+            return t
+        return None
+
+    def _task(self, stand, do, priority=None, preemptible=False, **task_params) -> task.Task:
+        """
+        Новая задача стенда. Если у стенда ждет в очереди такая же задача или задача, которую новая заменяет,
+        возвращается ожидающая задача. Вызывать под self._task_lock после _stand_with_validate
+        :param priority: класс приоритета, по умолчанию класс действия
+        """
+        if not priority:
+            priority = task.DEFAULT_PRIORITY.get(do, task.PRIORITY_NORMAL)
+        pending = self.pending_task(stand.name)
+        if pending:
+            if pending.coalesce(do, task_params, priority, preemptible):
+                return pending
+            raise DaemonException('Stand has task already. Wait for task complete')
+
+        t = task.Task(do=do, stand=stand, **task_params)
+        t.priority = priority
+        t.preemptible = preemptible
+        self._tasks[stand.name] = t
+        return t
+
+    def _stand_with_validate(self, name, for_task=True, coalesce=False):
+        """
+        :param for_task: стенд для новой задачи, а не для запуска или остановки
+        :param coalesce: новую задачу может принять ожидающая задача стенда, решает _task
+        """
         try:
             stand = self.stands[name]
         except KeyError:
@@ -431,7 +528,8 @@ class StandManager:
         if not stand.container_id:
             raise DaemonException('Stand is not created')
 
-        if for_task and stand.active_task and stand.active_task['status'] != task.ERROR:
+        if for_task and stand.active_task and stand.active_task['status'] != task.ERROR \
+                and not (coalesce and self.pending_task(name)):
             raise DaemonException('Stand has task already. Wait for task complete')
 
         if not for_task and stand.active_task and stand.active_task['status'] not in (task.ERROR, task.WAIT):
@@ -449,24 +547,28 @@ class StandManager:
         except KeyError:
             raise DaemonException('Stand is not exists')
 
-    def update(self, name, change_branch=None) -> task.Task:
+    def update(self, name, change_branch=None, priority=None) -> task.Task:
         """
         Задача на обновление стенда
+        :param priority: класс приоритета, по умолчанию класс действия
         :param change_branch: изменить бранч из которого будет собираться сборка
         :param name: название стенда
         :return: Задача
         """
-        s = self._stand_with_validate(name)
-        if change_branch:
-            if change_branch == 'last':
-                change_branch = None
+        with self._task_lock:
+            s = self._stand_with_validate(name, coalesce=True)
+            log.debug('Add new task UPDATE for stand %s', name)
+            t = self._task(s, task.DO_UPDATE, priority=priority, do_build=True)
 
-            log.info('Change jenkins version of stand %s, to version %s', name, change_branch)
-            s.jenkins_version = change_branch
-            s.write_json()
+            # Бранч читается при сборке, поэтому ожидающее обновление соберет новый бранч
+            if change_branch:
+                if change_branch == 'last':
+                    change_branch = None
 
-        log.debug('Add new task UPDATE for stand %s', name)
-        return task.Task(do=task.DO_UPDATE, stand=s, do_build=True)
+                log.info('Change jenkins version of stand %s, to version %s', name, change_branch)
+                s.jenkins_version = change_branch
+                s.save()
+            return t
 
     @staticmethod
     def _backup_path(stand, file_name=None, prefix=None, no_join_path=False):
@@ -507,17 +609,22 @@ class StandManager:
         else:
             return file_name
 
-    def backup_db(self, name, file=None, prefix=None) -> task.Task:
+    def backup_db(self, name, file=None, prefix=None, preemptible=False, priority=None) -> task.Task:
         """
         Задача на создание резервной копии базы данных с названием по умолчанию
+        :param priority: класс приоритета, по умолчанию класс действия
+        :param preemptible: фоновый бэкап, который уступает очередь обычным задачам и идет с пакетным приоритетом
         :param prefix: создать бэкап с использованием префикса
         :param file: файл бэкапа в директории бэкапов стенда
         :param name: название стенда
         :return: Задача
         """
         log.debug('Add new task BACKUP for stand %s', name)
+        with self._task_lock:
+            return self._backup_db(name, file, prefix, preemptible, priority)
 
-        s = self._stand_with_validate(name)
+    def _backup_db(self, name, file, prefix, preemptible, priority) -> task.Task:
+        s = self._stand_with_validate(name, coalesce=True)
 
         if s.web_interface_error:
             raise DaemonException('Stand has web interface error. Use specific filename for backup')
@@ -532,35 +639,63 @@ class StandManager:
         if inspect_info['State']['ExitCode'] not in (0, 130, 143) and not file:
             raise DaemonException('Exit code of container is incorrect. Maybe stand is down now? Use specific filename')
 
-        return task.Task(do=task.DO_BACKUP, stand=s,
-                         backup_path=self._backup_path(stand=s, file_name=file, prefix=prefix))
+        return self._task(s, task.DO_BACKUP,
+                          priority=priority or (task.PRIORITY_BATCH if preemptible else None),
+                          preemptible=preemptible,
+                          backup_path=self._backup_path(stand=s, file_name=file, prefix=prefix))
 
-    def restore_db(self, name, file=None) -> task.Task:
+    def restore_db(self, name, file=None, priority=None) -> task.Task:
         """
         Задача на восстановление бд стенда из бэкапа с названием по умолчанию
+        :param priority: класс приоритета, по умолчанию класс действия
         :param file: файл бэкапа в директории бэкапов стенда
         :param name: название стенда
         :return: Задача
         """
         log.debug('Add new task RESTORE for stand %s', name)
-        s = self._stand_with_validate(name)
-        return task.Task(do=task.DO_RESTORE, stand=s,
-                         backup_path=self._backup_path(stand=s, file_name=file))
+        with self._task_lock:
+            s = self._stand_with_validate(name, coalesce=True)
+            return self._task(s, task.DO_RESTORE, priority=priority,
+                              backup_path=self._backup_path(stand=s, file_name=file))
 
-    def reduce(self, name) -> task.Task:
+    def reduce(self, name, priority=None) -> task.Task:
         log.debug('Add new task REDUCE for stand %s', name)
-        s = self._stand_with_validate(name)
-        return task.Task(do=task.DO_REDUCE, stand=s)
+        with self._task_lock:
+            s = self._stand_with_validate(name, coalesce=True)
+            return self._task(s, task.DO_REDUCE, priority=priority)
 
-    def start(self, name, wait=True):
+    def validate_start(self, name) -> Stand:
+        """
+        Проверить, что стенд можно запустить
+        """
+        return self._stand_with_validate(name, for_task=False)
+
+    def touch(self, name):
+        """
+        Запомнить обращение к стенду
+        """
+        try:
+            stand = self.stands[name]
+        except KeyError:
+            raise DaemonException('Stand is not exists')
+        stand.last_access = time.time()
+        stand.save()
+
+    def start(self, name, wait=True, check_resources=True):
         """
         Запустить стенд
         :param wait: подождать запуска стенда
         :param name: название стенда
+        :param check_resources: отказать, если запущено max_active_stands стендов. Очередь запусков проверяет сама
         """
-        if not self.free_resources():
+        if self.resume(name):
+            return
+        if check_resources and not self.free_resources(name):
+            if self.memory_admission:
+                raise DaemonException('Not enough memory to start stand')
             raise DaemonException('Мax number of stands are running')
-        self._stand_with_validate(name, for_task=False).start(wait=wait)
+        self.validate_start(name).start(wait=wait)
+        self.touch(name)
 
     def stop(self, name, wait=True):
         """
@@ -569,6 +704,63 @@ class StandManager:
         :param name: название стенда
         """
         self._stand_with_validate(name, for_task=False).stop(wait=wait)
+        self.scheduler.cancel(name, scheduler.STOP)
+
+    def pause(self, name):
+        """
+        Заморозить стенд. Запуск замороженного стенда занимает меньше секунды
+        """
+        self._stand_with_validate(name, for_task=False).pause()
+        self.scheduler.cancel(name, scheduler.STOP)
+
+    def resume(self, name) -> bool:
+        """
+        Разморозить стенд, если он заморожен
+        :return: был ли стенд заморожен
+        """
+        stand = self._stand_with_validate(name, for_task=False)
+        if not stand.is_paused():
+            return False
+        stand.unpause()
+        self.touch(name)
+        return True
+
+    def suspend(self, name):
+        """
+        Освободить стенд, когда он больше не нужен. Стенд, с которым работали в последние pause_recent_minutes,
+        замораживается, остальные останавливаются
+        """
+        stand = self._stand_with_validate(name, for_task=False)
+        if self.pause_recent_minutes > 0 and stand.last_access \
+                and time.time() - stand.last_access < self.pause_recent_minutes * 60:
+            self.pause(name)
+        else:
+            self.stop(name)
+
+    def _scheduled_stop(self, name):
+        if self.is_busy and self.is_busy(name):
+            log.info('Stand %s is busy, stop by timeout skipped', name)
+            return
+        log.info('Stop %s by timeout', name)
+        self.suspend(name)
+
+    def schedule_stop(self, name, minutes):
+        """
+        Остановить стенд через minutes минут
+        """
+        self.scheduler.schedule(name, scheduler.STOP, time.time() + minutes * 60)
+
+    def extend(self, name, minutes) -> str:
+        """
+        Отодвинуть остановку стенда по таймауту на minutes минут, 0 - отменить остановку по таймауту
+        :return: время остановки
+        """
+        self._stand_with_validate(name, for_task=False)
+        if not minutes:
+            self.scheduler.cancel(name, scheduler.STOP)
+            return 'Stop by timeout is cancelled'
+        deadline = self.scheduler.extend(name, scheduler.STOP, minutes * 60)
+        return 'Stand will be stopped at {}'.format(time.ctime(deadline))
 
     def catalina_out(self, name, tail=150):
         """
@@ -615,7 +807,7 @@ class StandManager:
 
             log.info('Try to create backup for %s', stand.name)
             try:
-                self.backup_db(stand.name).run()
+                self.backup_db(stand.name, preemptible=True).run()
             except DaemonException as e:
                 log.warning(str(e))
 
@@ -691,8 +883,16 @@ class StandManager:
                 task_list = [self.backup_db(name), task_add]
             except DaemonException as e:
                 del self.stands[new_name]
+                self._tasks.pop(new_name, None)
+                self.store.delete_stand(new_name)
+                self.port_allocator.release(new_name)
                 raise e
         else:
             task_list = [task_add]
 
+        # Копии стендов создаются пачками, они не должны задерживать обновления.
+        # Бэкап, слитый с уже стоящей в очереди задачей, сохраняет ее приоритет
+        for t in task_list:
+            if t.id is None:
+                t.priority = task.PRIORITY_BATCH
         return task_list
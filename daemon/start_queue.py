@@ -0,0 +1,223 @@
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from daemon import task
+from daemon.config import DaemonConfig
+from daemon.exceptions import DaemonException
+from daemon.stand import is_paused_container
+
+log = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+STARTED = 'started'
+ERROR = 'error'
+
+EVICT_NONE = 'none'
+EVICT_LRU = 'lru'
+
+# Как часто очередь перепроверяет свободные ресурсы, если ее не разбудили раньше
+RECHECK_INTERVAL = 30
+# Сколько хранить завершенные билеты
+TICKET_TTL = 3600
+
+
+class StartTicket:
+    """
+    Заявка на запуск стенда. Можно опрашивать по id или ждать завершения
+    """
+
+    def __init__(self, ticket_id, name, deadline):
+        self.id = ticket_id
+        self.name = name
+        self.status = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.deadline = deadline
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def _finish(self, status, error=None):
+        with self._lock:
+            self.status = status
+            self.error = error
+            self.finished = time.time()
+            self._event.set()
+        for callback in self._callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.exception('Start ticket callback failed')
+
+    def add_done_callback(self, callback):
+        """
+        Вызвать callback(ticket) после завершения заявки, сразу если она уже завершена
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None) -> bool:
+        return self._event.wait(timeout)
+
+    def as_dict(self, position=None) -> dict:
+        d = {'id': self.id,
+             'name': self.name,
+             'status': self.status,
+             'error': self.error,
+             'created': self.created,
+             'finished': self.finished}
+        if position is not None:
+            d['position'] = position
+        return d
+
+
+class StartQueue:
+    """
+    Очередь запусков стендов. Если ресурсов на запуск нет, запуск ждет освобождения места
+    не дольше start_queue_timeout. С политикой lru очередь сама останавливает стенд, к которому дольше всех
+    не обращались, если к нему не обращались start_evict_idle_minutes и у него нет задачи
+    """
+
+    def __init__(self, sm, config: DaemonConfig):
+        self.sm = sm
+        self.policy = config.start_evict_policy
+        self.idle_seconds = config.start_evict_idle_minutes * 60
+        self.timeout = config.start_queue_timeout
+        if self.policy not in (EVICT_NONE, EVICT_LRU):
+            raise RuntimeError('Unsupported start_evict_policy {}'.format(self.policy))
+
+        self._ids = itertools.count(1)
+        self._queue = deque()
+        self._tickets = {}
+        self._cond = threading.Condition()
+        # Проверка ресурсов и запуск идут под одной блокировкой, чтобы два запуска не заняли одно место
+        self._start_lock = threading.Lock()
+        threading.Thread(target=self._run, name='start_queue', daemon=True).start()
+
+    def submit(self, name) -> StartTicket:
+        """
+        Заявка на запуск. Если очередь пуста и ресурсы есть, стенд запускается сразу в текущем потоке
+        """
+        self.sm.validate_start(name)
+        with self._cond:
+            self._prune()
+            for queued in self._queue:
+                if queued.name == name:
+                    return queued
+            ticket = StartTicket(next(self._ids), name, time.time() + self.timeout)
+            self._tickets[ticket.id] = ticket
+            queue_empty = not self._queue
+
+        # Замороженный стенд уже занимает ресурсы, размораживаем без очереди
+        if self.sm.resume(name):
+            ticket._finish(STARTED)
+            return ticket
+
+        if queue_empty:
+            with self._start_lock:
+                if self.sm.free_resources(name):
+                    self._start(ticket)
+                    return ticket
+
+        with self._cond:
+            self._queue.append(ticket)
+            self._cond.notify()
+        log.info('Start of %s is queued, ticket %s', name, ticket.id)
+        return ticket
+
+    def get(self, ticket_id) -> StartTicket:
+        try:
+            return self._tickets[ticket_id]
+        except KeyError:
+            raise DaemonException('Ticket is not exists')
+
+    def position(self, ticket) -> int:
+        """
+        :return: номер заявки в очереди начиная с 1, None если заявка не в очереди
+        """
+        with self._cond:
+            for i, queued in enumerate(self._queue, 1):
+                if queued is ticket:
+                    return i
+        return None
+
+    def notify(self):
+        """
+        Разбудить очередь, например после остановки стенда
+        """
+        with self._cond:
+            self._cond.notify()
+
+    def _prune(self):
+        expired = time.time() - TICKET_TTL
+        for ticket_id in [i for i, t in self._tickets.items() if t.finished and t.finished < expired]:
+            del self._tickets[ticket_id]
+
+    def _start(self, ticket):
+        try:
+            self.sm.start(ticket.name, wait=False, check_resources=False)
+        except DaemonException as e:
+            log.info('Start of %s failed: %s', ticket.name, e)
+            ticket._finish(ERROR, str(e))
+        else:
+            ticket._finish(STARTED)
+
+    def _run(self):
+        while 1:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                ticket = self._queue[0]
+            with self._start_lock:
+                try:
+                    admitted = self.sm.free_resources(ticket.name) or self._evict(ticket.name)
+                except Exception:
+                    log.exception('Cannot check resources for %s', ticket.name)
+                    admitted = False
+                if admitted:
+                    self._start(ticket)
+
+            with self._cond:
+                if not admitted and time.time() <= ticket.deadline:
+                    self._cond.wait(RECHECK_INTERVAL)
+                    continue
+                self._queue.popleft()
+
+            if not admitted:
+                ticket._finish(ERROR, 'No free resources in {} seconds'.format(self.timeout))
+
+    def _evict(self, for_name) -> bool:
+        """
+        Остановить стенд, к которому дольше всех не обращались, согласно политике
+        :return: удалось ли освободить место
+        """
+        if self.policy == EVICT_NONE:
+            return False
+
+        containers = self.sm.cli.containers()
+        running = {c['Id'] for c in containers}
+        paused = {c['Id'] for c in containers if is_paused_container(c)}
+        idle_since = time.time() - self.idle_seconds
+        candidates = [s for s in self.sm.stands.values()
+                      if s.name != for_name and s.container_id in running
+                      and (not s.active_task or s.active_task['status'] == task.ERROR)
+                      and (s.container_id in paused or (s.last_access or 0) < idle_since)]
+        if not candidates:
+            return False
+
+        # Первыми останавливаются замороженные стенды
+        stand = min(candidates, key=lambda s: (s.container_id not in paused, s.last_access or 0))
+        log.info('Stop idle stand %s to start %s', stand.name, for_name)
+        try:
+            self.sm.stop(stand.name, wait=True)
+        except DaemonException as e:
+            log.warning('Cannot stop idle stand %s: %s', stand.name, e)
+            return False
+        return True
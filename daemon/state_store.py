@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+class StateStore:
+    """
+    Состояние стендов и их задач в sqlite в режиме WAL. Запись состояния стенда - обновление одной строки,
+    которое дописывается в журнал, а не перезапись файла. Падение посреди записи не портит состояние
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS stands ('
+                               'name TEXT PRIMARY KEY, '
+                               'info TEXT NOT NULL, '
+                               'task_status TEXT, '
+                               'updated REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS stands_task_status ON stands (task_status)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS ports ('
+                               'range TEXT NOT NULL, '
+                               'port INTEGER NOT NULL, '
+                               'owner TEXT NOT NULL, '
+                               'PRIMARY KEY (range, port))')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def batch(self):
+        """
+        Объединить несколько записей в одну транзакцию. Вложенные batch присоединяются к внешнему
+        """
+        with self._lock:
+            if self._batch_depth == 0:
+                self._conn.execute('BEGIN')
+            self._batch_depth += 1
+            try:
+                yield self
+            except Exception:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._conn.execute('ROLLBACK')
+                raise
+            else:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._conn.execute('COMMIT')
+
+    def save_stand(self, name, info: dict):
+        active_task = info.get('active_task')
+        task_status = active_task['status'] if active_task else None
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO stands (name, info, task_status, updated) VALUES (?, ?, ?, ?)',
+                               (name, json.dumps(info), task_status, time.time()))
+
+    def delete_stand(self, name):
+        with self._lock:
+            self._conn.execute('DELETE FROM stands WHERE name = ?', (name,))
+
+    def load_stands(self) -> list:
+        """
+        :return: информация обо всех стендах за один запрос
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT info FROM stands ORDER BY name').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def stands_with_task(self) -> list:
+        """
+        :return: названия стендов, у которых есть активная задача или ошибка задачи
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT name FROM stands WHERE task_status IS NOT NULL').fetchall()
+        return [row[0] for row in rows]
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM stands').fetchone()[0] == 0
+
+    def save_port(self, range_name, port, owner):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO ports (range, port, owner) VALUES (?, ?, ?)',
+                               (range_name, port, owner))
+
+    def delete_port(self, range_name, port):
+        with self._lock:
+            self._conn.execute('DELETE FROM ports WHERE range = ? AND port = ?', (range_name, port))
+
+    def load_ports(self) -> list:
+        """
+        :return: занятые порты [(диапазон, порт, владелец)]
+        """
+        with self._lock:
+            return self._conn.execute('SELECT range, port, owner FROM ports').fetchall()
+
+    def import_stand_files(self, stands_dir):
+        """
+        Перенести stand_info.json из директорий стендов в хранилище. Файлы остаются как резервная копия
+        """
+        def read(stand_dir):
+            stand_info_path = os.path.join(stands_dir, stand_dir, 'stand_info.json')
+            if not os.path.isfile(stand_info_path):
+                return None
+            with open(stand_info_path, 'rt') as f:
+                return json.loads(f.read())
+
+        # Файлы читаются параллельно, запись одной транзакцией
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            stand_info_list = [i for i in executor.map(read, os.listdir(stands_dir)) if i]
+        with self.batch():
+            for stand_info in stand_info_list:
+                self.save_stand(stand_info['name'], stand_info)
+        log.info('Imported %s stand info files to %s', len(stand_info_list), self.path)
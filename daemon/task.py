@@ -1,13 +1,19 @@
 import datetime
 import logging
 import os
+import shutil
+import threading
+import time
 
+from daemon import build_cache, cancel, disk_space, events, reduced_cache
+from daemon.exceptions import TaskCancelled
 from daemon.jenkins import Jenkins
 from daemon.stand import Stand
 
 log = logging.getLogger(__name__)
 
 WAIT = 'WAIT'
+WAIT_DISK_SPACE = 'WAIT_DISK_SPACE'
 RESTORE_DB = 'RESTORE_DB'
 BACKUP_DB = 'BACKUP_DB'
 REDUCE = 'REDUCE'
@@ -17,6 +23,12 @@ CREATE_CONTAINER = 'CREATE_CONTAINER'
 BUILD_AND_UPLOAD = 'BUILD_AND_UPLOAD'
 TEST_RUN = 'TEST_RUN'
 ERROR = 'ERROR'
+# Результаты завершенной задачи
+DONE = 'DONE'
+CANCELLED = 'CANCELLED'
+
+# Через сколько секунд отложенная задача снова проверяет место на диске
+DISK_SPACE_RETRY = 60
 
 DO_ADD_NEW = 'ADD_NEW'
 DO_UPDATE = 'UPDATE'
@@ -24,6 +36,19 @@ DO_BACKUP = 'BACKUP'
 DO_RESTORE = 'RESTORE'
 DO_REDUCE = 'REDUCE'
 
+# Классы приоритета задач в очереди, от высшего к низшему
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_BATCH = 'batch'
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BATCH)
+
+# Приоритет по умолчанию: обновление ждет разработчик, reduce никто не ждет
+DEFAULT_PRIORITY = {DO_UPDATE: PRIORITY_INTERACTIVE,
+                    DO_RESTORE: PRIORITY_NORMAL,
+                    DO_BACKUP: PRIORITY_NORMAL,
+                    DO_ADD_NEW: PRIORITY_NORMAL,
+                    DO_REDUCE: PRIORITY_BATCH}
+
 BACKUP_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
 
@@ -37,11 +62,46 @@ class Task:
 
         self.status = None
         self.error = None
-
-        self.jenkins = Jenkins(self.stand.jenkins_url, self.stand.jenkins_user, self.stand.jenkins_pass)
+        # Размер базы перед бэкапом, для истории отношения размеров бэкапа и базы
+        self.db_size = None
+
+        # Номер задачи выдает очередь задач
+        self.id = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._done = threading.Event()
+        self._done_lock = threading.Lock()
+        self._callbacks = []
+        # Начало выполнения и слияние с новой задачей стенда не должны пересекаться
+        self._start_lock = threading.Lock()
+
+        self.cancel_token = cancel.CancelToken()
+        self.priority = DEFAULT_PRIORITY.get(do, PRIORITY_NORMAL)
+        # Фоновую задачу вытесняет из очереди любая обычная задача
+        self.preemptible = False
+        # Вытесненная задача после отката возвращается в очередь, а не завершается
+        self._requeue = False
+        self.cancelled = False
+        # Можно ли после отмены вернуть стенд в прежнее состояние
+        self._consistent = True
+        # Задачу из очереди можно отложить, пока на диске нет места. Очередь выполнит ее снова после retry_at
+        self.deferrable = False
+        self.retry_at = None
+        self._no_space_since = None
+
+        self._jenkins = None
 
         self.set_status(WAIT)
 
+    @property
+    def jenkins(self):
+        # jenkinsapi обращается к серверу при создании, а задача может быть создана задолго до выполнения
+        if self._jenkins is None:
+            self._jenkins = Jenkins(self.stand.jenkins_url, self.stand.jenkins_user, self.stand.jenkins_pass,
+                                    config=self.stand.config)
+        return self._jenkins
+
     def set_status(self, new_status):
         log.info('Task %s of stand %s has status %s', self.do, self.stand.name, new_status)
 
@@ -53,8 +113,60 @@ class Task:
             self.stand.active_task = d
         else:
             self.stand.active_task = {'do': self.do, 'status': new_status, 'task_params': self.task_params}
+        previous_status = self.status
         self.status = new_status
-        self.stand.write_json()
+        self.stand.save()
+        events.shared(self.stand.config).publish(events.TASK, self.stand.name, task_id=self.id, do=self.do,
+                                                 status=new_status, previous=previous_status, error=self.error)
+
+    @property
+    def result(self) -> str:
+        """
+        :return: None пока задача не завершена, затем DONE, ERROR или CANCELLED
+        """
+        if not self._done.is_set():
+            return None
+        if self.status == ERROR:
+            return ERROR
+        return CANCELLED if self.cancelled else DONE
+
+    def add_done_callback(self, callback):
+        """
+        Вызвать callback(task) после завершения задачи, сразу если она уже завершена
+        """
+        with self._done_lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None) -> bool:
+        return self._done.wait(timeout)
+
+    def _finish(self):
+        with self._done_lock:
+            self.finished = time.time()
+            self._done.set()
+        for callback in self._callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.exception('Task callback failed')
+
+    def as_dict(self, position=None) -> dict:
+        d = {'id': self.id,
+             'do': self.do,
+             'stand': self.stand.name,
+             'status': self.status,
+             'error': self.error,
+             'result': self.result,
+             'priority': self.priority,
+             'created': self.created,
+             'started': self.started,
+             'finished': self.finished}
+        if position is not None:
+            d['position'] = position
+        return d
 
     def write_version_file(self):
         log.debug('Write version file')
@@ -65,6 +177,73 @@ class Task:
                                                                               self.stand.version),
                           ])
 
+    def _get_build(self, build_number):
+        """
+        Загрузить сборку в webapp стенда. Контейнер с общими сборками получает ссылку на дерево сборки в кэше,
+        остальные - свою распакованную копию
+        :param build_number: номер сборки, по умолчанию последняя
+        """
+        cache = build_cache.shared(self.stand.config)
+        webapp_dir = os.path.join(self.stand.stand_dir, 'webapp')
+        previous_build = self.stand.build_id
+        build_number = self.jenkins.resolve_build(self.stand.jenkins_project, build_number)
+
+        if cache.shared_builds and self.stand.has_mount(build_cache.BUILDS_MOUNT):
+            self.stand.version = cache.get_build(self.jenkins, self.stand.jenkins_project, build_number, webapp_dir)
+        else:
+            if os.path.islink(webapp_dir):
+                os.remove(webapp_dir)
+            self.stand.version = self.jenkins.get_build(self.stand.jenkins_project, webapp_dir, build_number)
+
+        # Файлы прежней сборки из кэша сборок стенду больше не подходят
+        self.stand.build_id = build_cache.build_id(self.stand.jenkins_project, build_number)
+        self.stand.save()
+        cache.invalidate(self.stand)
+        # Задачи выполняются по одной, поэтому прежнюю сборку не может в это время брать другой стенд
+        if previous_build != self.stand.build_id:
+            cache.release(previous_build)
+
+    def _ensure_backup_space(self, backup_path):
+        """
+        Проверить до начала бэкапа, что на диске хватит места. Иначе упасть сразу, а не через несколько часов
+        """
+        db = self.stand.db
+        guard = disk_space.shared(self.stand.config)
+        try:
+            self.db_size = db.size()
+        except Exception as e:
+            log.warning('Cannot get size of database of stand %s: %s', self.stand.name, e)
+            return
+        local_dir = os.path.dirname(backup_path)
+        local_dir = local_dir if os.path.isdir(local_dir) else None
+        guard.ensure('backup of {}'.format(self.stand.name),
+                     guard.backup_estimate(self.stand.db_type, self.db_size),
+                     lambda: db.backup_free_space(backup_path),
+                     evict_dir=local_dir, target_dir=local_dir)
+
+    def _ensure_restore_space(self, backup_path):
+        db = self.stand.db
+        guard = disk_space.shared(self.stand.config)
+        local_dir = os.path.dirname(backup_path)
+        # Восстанавливаемый бэкап лежит в той же директории, его удалять нельзя
+        guard.ensure('restore of {}'.format(self.stand.name),
+                     guard.restore_estimate(db, self.stand.db_type, backup_path),
+                     db.restore_free_space,
+                     evict_dir=local_dir if os.path.isdir(local_dir) else None,
+                     target_dir=db.restore_dir(),
+                     keep=backup_path)
+
+    def _record_backup_ratio(self, backup_path):
+        if self.db_size and os.path.isfile(backup_path):
+            disk_space.shared(self.stand.config).record(self.stand.db_type, 'backup',
+                                                        os.path.getsize(backup_path) / self.db_size)
+
+    def _record_restore_ratio(self, backup_path):
+        # Для mssql размер базы известен из самого бэкапа, история не нужна
+        if os.path.isfile(backup_path) and self.stand.db.restore_size(backup_path) is None:
+            disk_space.shared(self.stand.config).record(self.stand.db_type, 'restore',
+                                                        self.stand.db.size() / os.path.getsize(backup_path))
+
     def _add_new(self):
         try:
             config_dir = self.task_params['config_dir']
@@ -76,28 +255,50 @@ class Task:
         except KeyError:
             raise RuntimeError('Missing parameter of task')
 
+        # Параметра нет у задач, сохраненных до появления кэша уменьшенных баз
+        reduced_cache_dir = self.task_params.get('reduced_cache_dir')
+        cache = reduced_cache.shared(reduced_cache_dir, self.stand.config) \
+            if reduced_cache_dir and backup_path and reduce else None
+        cached_path = cache.get(self.stand.db_type, backup_path) if cache else None
+
+        # Место проверяется до создания базы, чтобы отложенная задача могла начать заново
+        if backup_path:
+            self._ensure_restore_space(cached_path or backup_path)
+
+        # Недосозданный стенд остается с ошибкой, его надо удалить
+        self._consistent = False
+
         if not existed_db:
             self.set_status(CREATE_DB)
             self.stand.db.create()
 
         if backup_path:
             self.set_status(RESTORE_DB)
-            self.stand.db.restore(backup_path=backup_path)
+            self.stand.db.restore(backup_path=cached_path or backup_path)
+            self._record_restore_ratio(cached_path or backup_path)
 
             if self.stand.db_type == 'mssql' and self.stand.uni_schema:
                 self.stand.db.map_user_schema(self.stand.uni_schema['user'], 'uni')
                 self.stand.db_user = self.stand.uni_schema['user']
                 self.stand.db_pass = self.stand.uni_schema['pass']
-                self.stand.write_json()
+                self.stand.save()
                 self.stand.db.user = self.stand.uni_schema['user']
                 self.stand.db.password = self.stand.uni_schema['pass']
 
             self.stand.db.customer_patch()
             self.stand.db.set_1_1()
 
-        if reduce:
+        if reduce and not cached_path:
             self.set_status(REDUCE)
             self.stand.db.reduce()
+            if cache:
+                # База уже уменьшена, неудачное сохранение в кэш не должно ронять создание стенда
+                try:
+                    cache.put(self.stand.db, self.stand.db_type, backup_path)
+                except TaskCancelled:
+                    raise
+                except Exception as e:
+                    log.warning('Cannot put reduced database of %s to cache: %s', self.stand.name, e)
 
         # создать структуру директорий стенда и конфиги
         self.set_status(CREATE_DIR)
@@ -113,15 +314,14 @@ class Task:
             build = self.jenkins.build_project(self.stand.jenkins_project, self.stand.jenkins_version)
         else:
             build = None
-        self.stand.version = self.jenkins.get_build(self.stand.jenkins_project,
-                                                    os.path.join(self.stand.stand_dir, 'webapp'),
-                                                    build)
+        self._get_build(build)
         self.write_version_file()
 
         self._test_run()
 
     def _test_run(self):
         self.set_status(TEST_RUN)
+        # Запуск ждет события монитора стендов о готовности веб-интерфейса, сам поток очереди стенд не опрашивает
         self.stand.start()
         self.set_status(None)
 
@@ -139,14 +339,13 @@ class Task:
 
         self.stand.stop(wait=True)
         self.set_status(BUILD_AND_UPLOAD)
-        webapp_dir = os.path.join(self.stand.stand_dir, 'webapp')
         if do_build:
             build = self.jenkins.build_project(self.stand.jenkins_project, self.stand.jenkins_version)
         else:
             build = None
-        self.stand.version = self.jenkins.get_build(self.stand.jenkins_project,
-                                                    webapp_dir,
-                                                    build)
+        # Пока webapp не тронут, стенд остается на прежней сборке
+        self._consistent = False
+        self._get_build(build)
         self.write_version_file()
 
         self._test_run()
@@ -157,10 +356,13 @@ class Task:
         except KeyError:
             raise RuntimeError('Missing parameter of task')
 
+        self._ensure_restore_space(backup_path)
         self.stand.stop(wait=True)
 
         self.set_status(RESTORE_DB)
+        self._consistent = False
         self.stand.db.restore(backup_path=backup_path)
+        self._record_restore_ratio(backup_path)
         self.set_status(None)
 
     def _backup_db(self):
@@ -169,45 +371,178 @@ class Task:
         except KeyError:
             raise RuntimeError('Missing parameter of task')
 
+        self._ensure_backup_space(backup_path)
         self.stand.stop(wait=True)
 
         self.set_status(BACKUP_DB)
-        self.stand.db.backup(backup_path=backup_path)
+        try:
+            self.stand.db.backup(backup_path=backup_path)
+        except TaskCancelled:
+            self._remove_partial_backup(backup_path)
+            raise
+        self._record_backup_ratio(backup_path)
         self.stand.last_backup = datetime.datetime.utcnow().strftime(BACKUP_DATE_FORMAT)
         self.set_status(None)
 
+    @staticmethod
+    def _remove_partial_backup(backup_path):
+        # Бэкап mssql пишется на сервере базы, его файлы демону недоступны
+        if os.path.isdir(backup_path):
+            shutil.rmtree(backup_path, ignore_errors=True)
+        elif os.path.isfile(backup_path):
+            os.remove(backup_path)
+        else:
+            return
+        log.info('Partial backup %s is removed', backup_path)
+
+    def cancel(self, reason='Task is cancelled'):
+        """
+        Попросить задачу остановиться. Задача проверяет отмену между шагами и прерывает текущую операцию:
+        процесс pg_restore/psql, запрос mssql, ожидание сборки дженкинса
+        """
+        self._requeue = False
+        self.cancel_token.cancel(reason)
+
+    def preempt(self, reason):
+        """
+        Прервать задачу, чтобы она выполнилась заново позже: задача откатывается и снова ждет в очереди
+        с тем же номером, как отложенная задача
+        """
+        self._requeue = True
+        self.cancel_token.cancel(reason)
+
+    def _on_cancelled(self, e, available):
+        """
+        Вернуть стенд в состояние до задачи. Если задача успела испортить стенд, оставить ошибку
+        """
+        log.info('Task %s of stand %s is cancelled: %s', self.do, self.stand.name, e)
+        self.cancelled = True
+        with cancel.activate(None):
+            if not self._consistent:
+                self.error = 'Cancelled while {}: {}'.format(self.status, e)
+                self.set_status(ERROR)
+                return
+            self.set_status(None)
+            if available:
+                self.stand.start(wait=False)
+        if self._requeue and self.deferrable:
+            # Задача снова ждет в очереди и принимает новые задачи стенда, как до начала выполнения
+            log.info('Task %s of stand %s is queued again', self.do, self.stand.name)
+            self.cancel_token = cancel.CancelToken()
+            self.cancelled = False
+            self._requeue = False
+            with self._start_lock:
+                self.started = None
+            self.retry_at = time.time()
+            self.set_status(WAIT)
+
+    def coalesce(self, do, task_params, priority, preemptible) -> bool:
+        """
+        Принять новую задачу стенда, пока эта задача ждет в очереди. Одинаковая задача просто не нужна,
+        новое восстановление заменяет ожидающее, два обновления - одно обновление со сборкой, если ее просил
+        хотя бы один запрос. Задача получает высший из двух приоритетов
+        :return: True, если новая задача выполнится в составе этой
+        """
+        with self._start_lock:
+            if self.started or self.cancel_token.cancelled or do != self.do:
+                return False
+            if do == DO_RESTORE:
+                merged = dict(self.task_params, **task_params)
+            elif do == DO_UPDATE:
+                merged = dict(self.task_params,
+                              do_build=self.task_params.get('do_build') or task_params.get('do_build'))
+            elif task_params == self.task_params:
+                merged = self.task_params
+            else:
+                return False
+            log.info('Task %s %s of stand %s takes over the same new task', self.id, self.do, self.stand.name)
+            if PRIORITIES.index(priority) < PRIORITIES.index(self.priority):
+                self.priority = priority
+            self.preemptible = self.preemptible and preemptible
+            if merged != self.task_params:
+                # Сохраняем новые параметры в активной задаче стенда
+                self.task_params = merged
+                self.set_status(WAIT)
+        return True
+
+    def _defer(self, e) -> bool:
+        """
+        Отложить задачу, пока на диске нет места: поток очереди не должен ждать внутри задачи
+        :return: True, если задача отложена, иначе нехватка места - ошибка задачи
+        """
+        now = time.time()
+        if self._no_space_since is None:
+            self._no_space_since = now
+        wait_timeout = disk_space.shared(self.stand.config).wait_timeout
+        if not self.deferrable or now - self._no_space_since >= wait_timeout:
+            return False
+        log.info('Task %s of stand %s is deferred: %s', self.do, self.stand.name, e)
+        self.retry_at = now + DISK_SPACE_RETRY
+        self.set_status(WAIT_DISK_SPACE)
+        return True
+
+    def _set_error(self, e):
+        self.error = str(e)
+        self.set_status(ERROR)
+        log.exception(e)
+
     def run(self, no_exceptions=True):
+        with self._start_lock:
+            self.started = time.time()
+        self.retry_at = None
+        available = False
         try:
-            available = self.stand.is_running()
+            with cancel.activate(self.cancel_token):
+                self.cancel_token.check()
+                available = self.stand.is_running()
+                self._run(no_exceptions)
 
-            if self.do == DO_ADD_NEW:
-                self._add_new()
+            if available:
+                self.stand.start(wait=False)
 
-            elif self.do == DO_UPDATE:
-                self._update()
+        except TaskCancelled as e:
+            try:
+                self._on_cancelled(e, available)
+            except Exception as rollback_error:
+                log.exception(rollback_error)
+            if not no_exceptions:
+                raise e
 
-            elif self.do == DO_BACKUP:
-                self._backup_db()
+        except disk_space.NoDiskSpace as e:
+            if self._defer(e):
+                return
+            if not no_exceptions:
+                raise e
+            self._set_error(e)
 
-            elif self.do == DO_RESTORE:
-                self._restore_db()
+        except Exception as e:
+            if not no_exceptions:
+                raise e
+            self._set_error(e)
 
-            elif self.do == DO_REDUCE:
-                self._reduce()
+        finally:
+            # Отложенная задача еще не завершена
+            if self.retry_at is None:
+                self._finish()
 
-            else:
-                log.error('Unsupported task "do"')
-                if not no_exceptions:
-                    raise RuntimeError('Unsupported task "do"')
+    def _run(self, no_exceptions):
+        if self.do == DO_ADD_NEW:
+            self._add_new()
 
-            if available:
-                self.stand.start(wait=False)
+        elif self.do == DO_UPDATE:
+            self._update()
 
-        except Exception as e:
+        elif self.do == DO_BACKUP:
+            self._backup_db()
+
+        elif self.do == DO_RESTORE:
+            self._restore_db()
+
+        elif self.do == DO_REDUCE:
+            self._reduce()
+
+        else:
+            log.error('Unsupported task "do"')
             if not no_exceptions:
-                raise e
+                raise RuntimeError('Unsupported task "do"')
 
-            self.error = str(e)
-            self.set_status(ERROR)
-            log.exception(e)
-            return
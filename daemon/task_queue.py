@@ -0,0 +1,178 @@
+import itertools
+import logging
+import threading
+import time
+
+from daemon.config import DaemonConfig
+from daemon.exceptions import DaemonException
+from daemon.task import PRIORITIES, Task
+
+log = logging.getLogger(__name__)
+
+# Сколько хранить завершенные задачи
+TASK_TTL = 24 * 3600
+
+
+class TaskQueue:
+    """
+    Очередь длинных задач стендов. Задачи выполняются по одной: длинные задачи не должны грузить сервер.
+    Первой выполняется задача высшего класса приоритета, внутри класса - в порядке постановки. Каждые
+    task_aging_minutes ожидания поднимают задачу на класс, поэтому пакетные задачи не ждут бесконечно.
+    Каждая задача получает номер, по нему задачу можно найти, дождаться ее завершения или отменить.
+    Обычная задача вытесняет выполняемую фоновую: фоновая откатывается и ждет в очереди с тем же номером,
+    пока в очереди есть обычные задачи.
+    Задача, которой не хватило места на диске, остается в очереди и выполняется снова не раньше retry_at
+    """
+
+    def __init__(self, config: DaemonConfig = None):
+        if not config:
+            config = DaemonConfig().load_default()
+        self.aging = config.task_aging_minutes * 60
+        self._ids = itertools.count(1)
+        self._queue = []
+        self._tasks = {}
+        self._running = None
+        # Номера вытесненных задач до их завершения: они не вытесняются второй раз и пропускают вперед
+        # обычные задачи
+        self._preempted = set()
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name='task_queue', daemon=True).start()
+
+    def submit(self, t: Task, priority=None) -> Task:
+        """
+        :param priority: класс приоритета вместо класса по умолчанию для действия задачи
+        """
+        if priority and priority not in PRIORITIES:
+            raise DaemonException('Incorrect priority, use: {}'.format(', '.join(PRIORITIES)))
+        with self._cond:
+            if t.id is not None:
+                # Задача, в которую слилась новая задача стенда, уже в очереди. Ее приоритет выбрал coalesce
+                return t
+            if priority:
+                t.priority = priority
+            self._prune()
+            t.id = next(self._ids)
+            t.deferrable = True
+            self._tasks[t.id] = t
+            self._queue.append(t)
+            self._cond.notify()
+            running = self._running
+            preempt = running and running.preemptible and not t.preemptible and running.id not in self._preempted
+            if preempt:
+                self._preempted.add(running.id)
+        log.info('Task %s %s of stand %s is queued with priority %s', t.id, t.do, t.stand.name, t.priority)
+        if preempt:
+            log.info('Task %s preempts background task %s', t.id, running.id)
+            running.preempt('Preempted by task {}'.format(t.id))
+        return t
+
+    def cancel(self, task_id) -> Task:
+        """
+        Отменить задачу. Задача из очереди просто удаляется, выполняемая задача прерывается и откатывается
+        """
+        t = self.get(task_id)
+        with self._cond:
+            queued = t in self._queue
+            if queued:
+                self._queue.remove(t)
+                self._preempted.discard(t.id)
+        if t.finished:
+            raise DaemonException('Task is finished already')
+        log.info('Cancel task %s %s of stand %s', t.id, t.do, t.stand.name)
+        t.cancel()
+        if queued:
+            # Отмененная задача сразу завершается и снимает активную задачу стенда
+            t.run()
+        return t
+
+    def get(self, task_id) -> Task:
+        try:
+            return self._tasks[task_id]
+        except KeyError:
+            raise DaemonException('Task is not exists')
+
+    def _rank(self, t, now) -> tuple:
+        """
+        :return: ключ порядка выполнения: класс приоритета с учетом ожидания, затем номер задачи
+        """
+        rank = PRIORITIES.index(t.priority)
+        if self.aging > 0:
+            rank -= int((now - t.created) // self.aging)
+        return max(rank, 0), t.id
+
+    def _ordered(self) -> list:
+        """
+        :return: очередь в порядке выполнения. Вызывать под self._cond
+        """
+        now = time.time()
+        return sorted(self._queue, key=lambda t: self._rank(t, now))
+
+    def position(self, t) -> int:
+        """
+        :return: номер задачи в очереди начиная с 1, 0 для выполняемой задачи, None для завершенной.
+        Место может измениться, если позже встанет задача выше классом
+        """
+        with self._cond:
+            if t is self._running:
+                return 0
+            for i, queued in enumerate(self._ordered(), 1):
+                if queued is t:
+                    return i
+        return None
+
+    def as_list(self, with_finished=False) -> list:
+        """
+        :param with_finished: добавить завершенные задачи
+        :return: выполняемая задача и очередь по порядку
+        """
+        with self._cond:
+            result = []
+            if self._running:
+                result.append(self._running.as_dict(position=0))
+            result += [t.as_dict(position=i) for i, t in enumerate(self._ordered(), 1)]
+            if with_finished:
+                result += [t.as_dict() for t in sorted(self._tasks.values(), key=lambda t: t.id) if t.finished]
+        return result
+
+    def _prune(self):
+        expired = time.time() - TASK_TTL
+        for task_id in [i for i, t in self._tasks.items() if t.finished and t.finished < expired]:
+            del self._tasks[task_id]
+
+    def _next(self) -> Task:
+        """
+        Дождаться задачи, готовой к выполнению: отложенные задачи ждут своего retry_at, вытесненные - пока
+        не выполнятся готовые обычные задачи. Вызывать под self._cond
+        """
+        while 1:
+            now = time.time()
+            ready = [t for t in self._ordered() if not t.retry_at or t.retry_at <= now]
+            urgent = any(not t.preemptible and t.id not in self._preempted for t in ready)
+            for t in ready:
+                if not (urgent and t.id in self._preempted):
+                    return t
+            retries = [t.retry_at for t in self._queue]
+            self._cond.wait(timeout=min(retries) - now if retries else None)
+
+    def _run(self):
+        while 1:
+            with self._cond:
+                t = self._running = self._next()
+                self._queue.remove(t)
+            log.info('Run task %s %s of stand %s', t.id, t.do, t.stand.name)
+            try:
+                t.run()
+            except Exception:
+                log.exception('Task %s failed', t.id)
+            finally:
+                with self._cond:
+                    self._running = None
+                    if t.retry_at:
+                        # Отложенная или откатившаяся вытесненная задача снова ждет в очереди. Отмененная
+                        # за это время задача завершается сразу, а не через DISK_SPACE_RETRY
+                        if t.cancel_token.cancelled:
+                            t.retry_at = None
+                        self._queue.append(t)
+                        self._cond.notify()
+                    else:
+                        self._preempted.discard(t.id)
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from daemon.config import DaemonConfig, Shared
+from daemon.exceptions import DaemonException
+
+log = logging.getLogger(__name__)
+
+IO_CLASS_NONE = 0
+IO_CLASS_BEST_EFFORT = 2
+IO_CLASS_IDLE = 3
+
+COPY_CHUNK = 1024 * 1024
+
+
+@contextmanager
+def kill_after(process, timeout):
+    """
+    Убить процесс, если блок не завершится за timeout секунд. Чтение из pipe убитого процесса
+    сразу заканчивается, поэтому зависший процесс не держит копирование
+    :return: Event, который установлен, если процесс убит по таймауту
+    """
+    expired = threading.Event()
+
+    def kill():
+        expired.set()
+        log.warning('Kill process %s after %s s', process.pid, timeout)
+        process.kill()
+
+    watchdog = threading.Timer(timeout, kill)
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        yield expired
+    finally:
+        watchdog.cancel()
+
+
+class Throttle:
+    """
+    Ограничение ввода-вывода и процессора для долгих операций (бэкап, восстановление, reduce, распаковка сборки),
+    чтобы запущенные стенды не тормозили. Настройки можно менять на лету, они применяются к следующей
+    команде и к следующему блоку копируемых данных
+    """
+
+    def __init__(self, config: DaemonConfig):
+        self._lock = threading.Lock()
+        self.io_class = IO_CLASS_NONE
+        self.io_level = 0
+        self.cpu_nice = 0
+        self.blkio_weight = 0
+        self.bytes_per_sec = 0
+        self.update(io_class=config.throttle_io_class,
+                    io_level=config.throttle_io_level,
+                    cpu_nice=config.throttle_cpu_nice,
+                    blkio_weight=config.throttle_blkio_weight,
+                    bytes_per_sec=config.throttle_bytes_per_sec)
+
+    def update(self, io_class=None, io_level=None, cpu_nice=None, blkio_weight=None, bytes_per_sec=None):
+        """
+        Изменить настройки. None - оставить как есть
+        :param io_class: класс ionice: 0 - не ограничивать, 2 - best-effort, 3 - idle
+        :param io_level: приоритет внутри класса best-effort, 0-7
+        :param cpu_nice: nice для процессов, 0-19
+        :param blkio_weight: вес ввода-вывода контейнеров pgdocker, 10-1000, 0 - по умолчанию
+        :param bytes_per_sec: скорость потокового копирования, 0 - без ограничений
+        """
+        if io_class is not None and io_class not in (IO_CLASS_NONE, IO_CLASS_BEST_EFFORT, IO_CLASS_IDLE):
+            raise DaemonException('io_class should be 0, 2 or 3')
+        if io_level is not None and not 0 <= io_level <= 7:
+            raise DaemonException('io_level should be between 0 and 7')
+        if cpu_nice is not None and not 0 <= cpu_nice <= 19:
+            raise DaemonException('cpu_nice should be between 0 and 19')
+        if blkio_weight is not None and blkio_weight != 0 and not 10 <= blkio_weight <= 1000:
+            raise DaemonException('blkio_weight should be 0 or between 10 and 1000')
+        if bytes_per_sec is not None and bytes_per_sec < 0:
+            raise DaemonException('bytes_per_sec should not be negative')
+
+        with self._lock:
+            for key, val in (('io_class', io_class), ('io_level', io_level), ('cpu_nice', cpu_nice),
+                             ('blkio_weight', blkio_weight), ('bytes_per_sec', bytes_per_sec)):
+                if val is not None:
+                    setattr(self, key, val)
+        log.info('Throttle settings: %s', self.as_dict())
+
+    def as_dict(self) -> dict:
+        return {'io_class': self.io_class,
+                'io_level': self.io_level,
+                'cpu_nice': self.cpu_nice,
+                'blkio_weight': self.blkio_weight,
+                'bytes_per_sec': self.bytes_per_sec}
+
+    def wrap_command(self, args) -> list:
+        """
+        Добавляет к команде ionice и nice согласно текущим настройкам
+        """
+        prefix = []
+        with self._lock:
+            if self.io_class == IO_CLASS_BEST_EFFORT:
+                prefix += ['ionice', '-c', str(self.io_class), '-n', str(self.io_level)]
+            elif self.io_class == IO_CLASS_IDLE:
+                prefix += ['ionice', '-c', str(self.io_class)]
+            if self.cpu_nice:
+                prefix += ['nice', '-n', str(self.cpu_nice)]
+        return prefix + args
+
+    def copy(self, src, dst, deadline=None):
+        """
+        Копирует поток src в dst не быстрее bytes_per_sec. Дедлайн проверяется между блоками, блок от зависшего
+        процесса он не прервет, для процессов нужен еще kill_after
+        :param deadline: time.time(), после которого копирование прерывается с TimeoutError
+        :return: количество скопированных байт
+        """
+        copied = 0
+        # Скорость считается от начала окна. Окно сбрасывается пока ограничения нет,
+        # чтобы включенное на лету ограничение не учитывало уже скопированное
+        window_start, window_bytes = time.time(), 0
+        while 1:
+            chunk = src.read(COPY_CHUNK)
+            if not chunk:
+                return copied
+            dst.write(chunk)
+            copied += len(chunk)
+            window_bytes += len(chunk)
+
+            now = time.time()
+            if deadline and now > deadline:
+                raise TimeoutError('Copy was not finished in time')
+
+            bytes_per_sec = self.bytes_per_sec
+            if bytes_per_sec:
+                delay = window_start + window_bytes / bytes_per_sec - now
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                window_start, window_bytes = now, 0
+
+
+_shared = Shared(Throttle)
+
+
+def shared(config=None) -> Throttle:
+    """
+    Общие для всего демона настройки ограничений
+    """
+    return _shared.get(config)
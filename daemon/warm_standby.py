@@ -0,0 +1,84 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from daemon import memory
+from daemon.config import DaemonConfig
+from daemon.exceptions import DaemonException
+from daemon.stand import is_paused_container
+
+log = logging.getLogger(__name__)
+
+
+class WarmStandby:
+    """
+    Политика замороженных стендов. Замороженный стенд держит память, поэтому останавливается по-настоящему
+    через pause_max_minutes или, начиная с давно не используемых, пока доступной памяти хоста меньше
+    pause_min_free_mb
+    """
+
+    def __init__(self, sm, config: DaemonConfig, on_stop=None):
+        """
+        :param on_stop: вызывается после остановки замороженного стенда
+        """
+        self.sm = sm
+        self.max_paused = config.pause_max_minutes * 60
+        self.min_free = config.pause_min_free_mb * memory.MB
+        self.interval = config.pause_check_seconds
+        self.on_stop = on_stop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # {стенд: когда замечена заморозка}
+        self.paused_since = {}
+
+    def start(self):
+        if self.sm.pause_recent_minutes <= 0:
+            log.info('Stands are not paused')
+            return
+        IOLoop.current().spawn_callback(self._run)
+
+    @gen.coroutine
+    def _run(self):
+        log.info('Start warm standby policy')
+        while 1:
+            yield gen.sleep(self.interval)
+            try:
+                yield self._check_all()
+            except Exception:
+                log.exception('Paused stands check failed')
+
+    @gen.coroutine
+    def _check_all(self):
+        containers = yield self.executor.submit(self.sm.cli.containers)
+        paused_ids = {c['Id'] for c in containers if is_paused_container(c)}
+
+        now = time.time()
+        paused = [s for s in self.sm.stands.values() if s.container_id in paused_ids]
+        for name in set(self.paused_since) - {s.name for s in paused}:
+            del self.paused_since[name]
+        for stand in paused:
+            self.paused_since.setdefault(stand.name, now)
+
+        for stand in [s for s in paused if now - self.paused_since[s.name] >= self.max_paused]:
+            log.info('Stand %s is paused for %s minutes', stand.name, self.max_paused // 60)
+            yield self._demote(stand)
+            paused.remove(stand)
+
+        paused.sort(key=lambda s: s.last_access or 0)
+        while paused and memory.host_available() < self.min_free:
+            stand = paused.pop(0)
+            log.info('Low memory, stop paused stand %s', stand.name)
+            yield self._demote(stand)
+
+    @gen.coroutine
+    def _demote(self, stand):
+        try:
+            yield self.executor.submit(self.sm.stop, stand.name)
+        except DaemonException as e:
+            log.warning('Cannot stop paused stand %s: %s', stand.name, e)
+            return
+        self.paused_since.pop(stand.name, None)
+        if self.on_stop:
+            self.on_stop()
@@ -2,37 +2,68 @@
 
 import logging
 import logging.config
+import re
 from concurrent.futures import ThreadPoolExecutor
 
 from tornado.ioloop import IOLoop
 from tornado.web import Application
 
 import web_handlers
+from daemon import build_cache, disk_space, docker_pool, events, throttle
 from daemon.config import DaemonConfig
+from daemon.health_monitor import HealthMonitor
+from daemon.idle_detector import IdleDetector
+from daemon.start_queue import StartQueue
 from daemon.stand_manager import StandManager
+from daemon.task_queue import TaskQueue
+from daemon.warm_standby import WarmStandby
 
 
 def main():
     conf = DaemonConfig().load_default()
     logging.config.dictConfig(conf.default_logging())
+    throttle.shared(conf)
+    docker_pool.shared(conf)
+    disk_space.shared(conf)
+    build_cache.shared(conf)
 
     application = Application([
         (r'/stand/([a-z,0-9,\-,_]+)/*([a-z]*)', web_handlers.StandHandler),
         (r'/s/([a-z,0-9,\-,_]+)/*([a-z]*)', web_handlers.StandHandler),
         (r'/list/*', web_handlers.ListHandler),
+        (r'/start/([0-9]+)/*', web_handlers.StartTicketHandler),
+        (r'/task/([0-9]+)/*([a-z]*)', web_handlers.TaskHandler),
+        (r'/tasks/*', web_handlers.TasksHandler),
+        (r'/throttle/*', web_handlers.ThrottleHandler),
+        (r'/metrics/*', web_handlers.MetricsHandler),
+        (r'/events/*', web_handlers.EventsHandler),
+        (r'/p/([a-z,0-9,\-,_]+)(/.*)?', web_handlers.ProxyHandler),
         (r'/.*', web_handlers.HelpHandler),
     ])
+    if conf.proxy_domain:
+        application.add_handlers(r'[a-z0-9\-_]+\.{}$'.format(re.escape(conf.proxy_domain)),
+                                 [(r'.*', web_handlers.ProxyHandler)])
 
-    # tpe для коротких и длинных тасков. Длинные таски не должны весить сервер, потому выполняются по одному.
+    # tpe для коротких тасков. Длинные таски не должны весить сервер, потому выполняются по одному в очереди задач.
     # кроме того, не тестировалась параллельная сборка на дженкинсе
     application.fast_task_tpe = ThreadPoolExecutor(max_workers=8)
-    application.long_task_tpe = ThreadPoolExecutor(max_workers=1)
+    application.task_queue = TaskQueue(conf)
     application.conf = conf
 
     sm = StandManager(conf)
     for t in sm.uncompleted_tasks:
-        application.long_task_tpe.submit(t.run)
+        application.task_queue.submit(t)
     application.sm = sm
+    events.ContainerEvents(sm, events.shared(conf)).start()
+    application.start_queue = StartQueue(sm, conf)
+    application.idle_detector = IdleDetector(sm, conf, on_stop=application.start_queue.notify)
+    application.idle_detector.start()
+    sm.is_busy = application.idle_detector.is_busy
+    application.warm_standby = WarmStandby(sm, conf, on_stop=application.start_queue.notify)
+    application.warm_standby.start()
+    sm.scheduler.start()
+    application.health_monitor = HealthMonitor(sm, conf)
+    application.health_monitor.start()
 
     application.listen(conf.uni_docker_port)
     IOLoop.instance().start()
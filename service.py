@@ -6,11 +6,16 @@ import logging
 import logging.config
 import os
 import shutil
+import threading
 
-from daemon import task
+from tornado.ioloop import IOLoop
+
+from daemon import events, task
 from daemon.config import DaemonConfig
 from daemon.exceptions import DaemonException
+from daemon.health_monitor import HealthMonitor
 from daemon.stand_manager import StandManager
+from daemon.state_store import StateStore
 
 log = logging.getLogger('service')
 
@@ -18,7 +23,7 @@ log = logging.getLogger('service')
 def _init_args():
     parser = argparse.ArgumentParser(prog='Обновление конфигурации стендов')
     parser.add_argument('--stand-info', action='store_true',
-                        help='Модифицировать stand_info.json (правило должно быть добавлено в код)')
+                        help='Модифицировать информацию о стендах в хранилище (правило должно быть добавлено в код)')
     parser.add_argument('--containers', action='store_true',
                         help='Пересоздать все контейнеры с параметрами из конфиг файла')
     parser.add_argument('--configs', action='store_true',
@@ -40,6 +45,19 @@ def _init_args():
     return args
 
 
+def _start_health_monitor(sm, conf):
+    """
+    Задачи ждут запуска стенда по событиям монитора стендов, поэтому без демона монитор работает в своем потоке
+    """
+    def run():
+        loop = IOLoop()
+        loop.add_callback(lambda: HealthMonitor(sm, conf).start())
+        loop.start()
+
+    events.ContainerEvents(sm, events.shared(conf)).start()
+    threading.Thread(target=run, name='health_monitor', daemon=True).start()
+
+
 def main():
     args = _init_args()
 
@@ -48,68 +66,76 @@ def main():
 
     if args.stand_info:
         log.info('Modify stand info')
-        stands_dir = os.path.join(conf.work_dir, 'stands')
-
-        stand_info_all = {}
-
-        for stand_dir in os.listdir(stands_dir):
-            stand_info_path = os.path.join(stands_dir, stand_dir, 'stand_info.json')
-            if os.path.isfile(stand_info_path):
-                with open(stand_info_path, 'rt') as f:
-                    stand_info_all[stand_info_path] = json.loads(f.read())
-
-        for stand_info_path, stand_info in stand_info_all.items():
-            # Добавить правило для исправления stand_info сюда
-            if 'ports' not in stand_info:
-                stand_info['ports'] = [stand_info['port'], stand_info['port'] + 10]
-                del stand_info['port']
-                log.info('Исправлены порты в %s', stand_info_path)
-
-            if 'validate_entity_code' not in stand_info:
-                stand_info['validate_entity_code'] = True
-                log.info('Добавлено validate_entity_code=True в %s', stand_info_path)
-
-            if 'uni_schema' not in stand_info:
-                stand_info['uni_schema'] = None
-                log.info('Добавлено uni_schema=None в %s', stand_info_path)
-
-            if 'last_backup' not in stand_info:
-                stand_info['last_backup'] = None
-                log.info('Добавлено last_backup=None в %s', stand_info_path)
-
-            if 'db_container' not in stand_info:
-                stand_info['db_container'] = None
-                stand_info['ssh_user'] = None
-                stand_info['ssh_pass'] = None
-                log.info('Добавлены db_container ssh_user ssh_pass  в %s', stand_info_path)
-
-            if 'web_interface_error' not in stand_info:
-                stand_info['web_interface_error'] = None
-                log.info('Добавлен web_interface_error в %s', stand_info_path)
-
-            if 'backup_dir' not in stand_info:
-                if stand_info['db_type'] == 'postgres':
-                    backup_dir = conf.postgres_backup_dir
-                elif stand_info['db_type'] == 'mssql':
-                    backup_dir = conf.mssql_backup_dir
-                elif stand_info['db_type'] == 'pgdocker':
-                    backup_dir = conf.pgdocker_backup_dir
-                else:
-                    raise RuntimeError
-                stand_info['backup_dir'] = backup_dir
-                log.info('Добавлен backup_dir=%s в %s', backup_dir, stand_info_path)
-
-            with open(stand_info_path, 'wt') as f:
-                json.dump(stand_info, f)
+        store = StateStore(os.path.join(conf.work_dir, 'state.db'))
+        if store.is_empty():
+            store.import_stand_files(os.path.join(conf.work_dir, 'stands'))
+
+        with store.batch():
+            for stand_info in store.load_stands():
+                name = stand_info['name']
+                # Добавить правило для исправления stand_info сюда
+                if 'ports' not in stand_info:
+                    stand_info['ports'] = [stand_info['port'], stand_info['port'] + 10]
+                    del stand_info['port']
+                    log.info('Исправлены порты в %s', name)
+
+                if 'validate_entity_code' not in stand_info:
+                    stand_info['validate_entity_code'] = True
+                    log.info('Добавлено validate_entity_code=True в %s', name)
+
+                if 'uni_schema' not in stand_info:
+                    stand_info['uni_schema'] = None
+                    log.info('Добавлено uni_schema=None в %s', name)
+
+                if 'last_backup' not in stand_info:
+                    stand_info['last_backup'] = None
+                    log.info('Добавлено last_backup=None в %s', name)
+
+                if 'db_container' not in stand_info:
+                    stand_info['db_container'] = None
+                    stand_info['ssh_user'] = None
+                    stand_info['ssh_pass'] = None
+                    log.info('Добавлены db_container ssh_user ssh_pass  в %s', name)
+
+                if 'web_interface_error' not in stand_info:
+                    stand_info['web_interface_error'] = None
+                    log.info('Добавлен web_interface_error в %s', name)
+
+                if 'last_access' not in stand_info:
+                    stand_info['last_access'] = None
+                    log.info('Добавлен last_access=None в %s', name)
+
+                if 'scheduled' not in stand_info:
+                    stand_info['scheduled'] = {}
+                    log.info('Добавлен scheduled={} в %s', name)
+
+                if 'build_id' not in stand_info:
+                    stand_info['build_id'] = None
+                    log.info('Добавлен build_id=None в %s', name)
+
+                if 'backup_dir' not in stand_info:
+                    if stand_info['db_type'] == 'postgres':
+                        backup_dir = conf.postgres_backup_dir
+                    elif stand_info['db_type'] == 'mssql':
+                        backup_dir = conf.mssql_backup_dir
+                    elif stand_info['db_type'] == 'pgdocker':
+                        backup_dir = conf.pgdocker_backup_dir
+                    else:
+                        raise RuntimeError
+                    stand_info['backup_dir'] = backup_dir
+                    log.info('Добавлен backup_dir=%s в %s', backup_dir, name)
+
+                store.save_stand(name, stand_info)
 
     sm = StandManager(conf)
+    _start_health_monitor(sm, conf)
 
     if args.containers:
         log.info('Recreate containers')
         for stand in sm.stands.values():
             stand.image = conf.image
             stand.catalina_opt = conf.catalina_opt
-            stand.write_json()
+            stand.save()
 
         for name, stand in sm.stands.items():
             try:
@@ -1,20 +1,109 @@
+import datetime
 import logging
 import logging.config
+import io
 import os
+import subprocess
+import threading
 import time
 import unittest
 
 from docker import Client
+from tornado import gen, locks
+from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
 
-from daemon import jenkins, stand, stand_manager
-from daemon.config import DaemonConfig
-from daemon.exceptions import DaemonException
+import web_handlers
+from daemon import build_cache, cancel, disk_space, docker_pool, events, health_monitor, idle_detector, jenkins, \
+    memory, port_allocator, reduced_cache, stand, stand_manager, start_queue, state_store, task, task_queue, \
+    throttle, warm_standby
+from daemon.config import DaemonConfig, Shared
+from daemon.exceptions import DaemonException, TaskCancelled
 from daemon.stand_db import StandPostgresDb, StandMssqlDb, StandDockerPostgres
 
 log = logging.getLogger(__name__)
 
 
 class DaemonTests(unittest.TestCase):
+    class FakeStand:
+        """
+        Стенд для тестов без докера. Контейнер стенда называется как стенд
+        """
+
+        def __init__(self, name, last_access=0, active_task=None, paused=False):
+            self.name = name
+            self.container_id = name
+            self.last_access = last_access
+            self.active_task = active_task
+            self.paused = paused
+            self.catalina_opt = None
+            self.db_type = 'postgres'
+            self.web_interface_error = None
+            self.started_at = None
+
+        def save(self):
+            pass
+
+        def url(self):
+            return 'http://{}/'.format(self.name)
+
+    class FakeDocker:
+        """
+        Клиент докера для тестов: запущены контейнеры всех неостановленных стендов, статистика контейнеров
+        выдается по очереди из samples, лог любого контейнера - output
+        """
+
+        def __init__(self, sm):
+            self.sm = sm
+            self.samples = []
+            self.output = b''
+
+        def containers(self, all=False):
+            return [{'Id': s.container_id, 'Status': 'Up (Paused)' if s.paused else 'Up'}
+                    for s in self.sm.stands.values() if s.name not in self.sm.stopped]
+
+        def stats(self, container, decode=None, stream=True):
+            return self.samples.pop(0)
+
+        def logs(self, container, tail='all', since=None):
+            return self.output
+
+    class FakeStandManager:
+        """
+        Менеджер стендов для тестов: запоминает запуски и остановки, клиент докера FakeDocker стоит за пулом
+        """
+
+        def __init__(self, *stands):
+            self.stands = {s.name: s for s in stands}
+            self.free = True
+            self.started = []
+            self.stopped = []
+            self.docker = DaemonTests.FakeDocker(self)
+            self.cli = docker_pool.DockerPool(size=1, timeout=1, base_url='tcp://127.0.0.1:1')
+            self.cli._clients.put(self.docker)
+            self.cli._created = 1
+
+        def validate_start(self, name):
+            pass
+
+        def resume(self, name):
+            return False
+
+        def free_resources(self, name=None):
+            return self.free
+
+        def start(self, name, wait=True, check_resources=True):
+            self.started.append(name)
+
+        def stop(self, name, wait=True):
+            self.stopped.append(name)
+            self.free = True
+
+        suspend = stop
+
     def setUp(self):
         config = DaemonConfig().load_default()
         test_id = str(time.time())
@@ -77,9 +166,12 @@ class DaemonTests(unittest.TestCase):
                                       'jenkins_user': config.jenkins_user,
                                       'jenkins_pass': config.jenkins_pass,
                                       'version': None,
+                                      'build_id': None,
 
                                       'active_task': None,
                                       'web_interface_error': None,
+                                      'last_access': None,
+                                      'scheduled': {},
                                       }
         self.SECOND_CONTAINER = 'unittest2'
         self.PGDOCKER_NAME = 'pg_unittest'
@@ -143,6 +235,7 @@ class DaemonTests(unittest.TestCase):
         Отказ в запуске стенда при исчерпании ресурсов
         """
         self.config.max_active_stands = 1
+        self.config.memory_admission = False
         sm = stand_manager.StandManager(self.config)
 
         self.assertTrue(sm.free_resources())
@@ -244,6 +337,32 @@ class DaemonTests(unittest.TestCase):
         with self.assertRaises(DaemonException):
             sm.add_new('3', 'postgres', '3', '3')
 
+    def test_7_ports_reclaim(self):
+        """
+        Порты удаленного в обход демона стенда возвращаются при запуске, порты чужих контейнеров не выдаются
+        """
+        self.config.ports = 5
+        sm = stand_manager.StandManager(self.config)
+        sm.add_new('1', 'postgres', '1', '1')
+        sm.store.delete_stand('1')
+        sm.port_allocator.reconcile({}, {self.config.start_port + 2})
+        t = sm.add_new('2', 'postgres', '2', '2')
+        self.assertEqual([self.config.start_port, self.config.start_port + 1], t.stand.ports)
+        t = sm.add_new('3', 'postgres', '3', '3')
+        self.assertEqual([self.config.start_port + 3, self.config.start_port + 4], t.stand.ports)
+
+    def test_7_port_range_lowest_free(self):
+        """
+        Диапазон выдает наименьший свободный порт, освобожденный порт выдается раньше старших
+        """
+        port_range = port_allocator.PortRange('tomcat', 100, 5)
+        port_range.take(102, port_allocator.DOCKER_OWNER)
+        self.assertEqual([100, 101, 103], [port_range.take_free('1') for _ in range(3)])
+        port_range.put(101)
+        port_range.put(102)
+        self.assertEqual([101, 102, 104], [port_range.take_free('2') for _ in range(3)])
+        self.assertEqual(0, port_range.free_count())
+
     def test_8_stands_from_json(self):
         """
         Создание объектов-контейнеров имеющихся стендов при запуске
@@ -258,6 +377,719 @@ class DaemonTests(unittest.TestCase):
         for pair in expected.items():
             self.assertIn(pair, actual['name'].items())
 
+    def test_9_scheduled_stop(self):
+        """
+        Срок остановки по таймауту сохраняется в информации о стенде и загружается при запуске
+        """
+        sm = stand_manager.StandManager(self.config)
+        sm.add_new('name', 'postgres', 'jenkins_project')
+        sm.schedule_stop('name', 30)
+        deadline = sm.scheduler.deadline('name', 'stop')
+        self.assertIsNotNone(deadline)
+
+        sm2 = stand_manager.StandManager(self.config)
+        self.assertEqual(deadline, sm2.scheduler.deadline('name', 'stop'))
+        sm2.scheduler.cancel('name')
+        self.assertIsNone(stand_manager.StandManager(self.config).scheduler.deadline('name', 'stop'))
+
+    def test_9_build_cache_appcds(self):
+        """
+        Архив AppCDS, созданный стендом, достается другому стенду той же сборки и обновляется из кэша
+        """
+        self.config.build_cache_dir = os.path.join(self.test_dir, 'builds')
+        self.config.appcds = True
+        cache = build_cache.BuildCache(self.config)
+        first = stand.Stand(config=self.config, **dict(self.EXISTED_STAND_DETAILS,
+                                                       stand_dir=os.path.join(self.test_dir, 'first'),
+                                                       build_id=build_cache.build_id('product/uni', 7)))
+        second = stand.Stand(config=self.config, **dict(self.EXISTED_STAND_DETAILS,
+                                                        stand_dir=os.path.join(self.test_dir, 'second'),
+                                                        build_id=first.build_id))
+        self.assertEqual('product_uni_7', first.build_id)
+
+        cache.install(first)
+        os.makedirs(os.path.join(first.stand_dir, 'cds'), exist_ok=True)
+        with open(os.path.join(first.stand_dir, 'cds', build_cache.APPCDS_ARCHIVE), 'wt') as f:
+            f.write('archive')
+        cache.collect(first)
+
+        cache.install(second)
+        with open(os.path.join(second.stand_dir, 'cds', build_cache.APPCDS_ARCHIVE), 'rt') as f:
+            self.assertEqual('archive', f.read())
+
+        cache.prune(set())
+        self.assertFalse(os.path.exists(os.path.join(self.config.build_cache_dir, first.build_id)))
+
+    def test_9_build_cache_tomcat_work(self):
+        """
+        Скомпилированные JSP стенда достаются стенду той же сборки без сессий и удаляются при смене сборки
+        """
+        self.config.build_cache_dir = os.path.join(self.test_dir, 'builds')
+        self.config.tomcat_work_cache = True
+        cache = build_cache.BuildCache(self.config)
+        first = stand.Stand(config=self.config, **dict(self.EXISTED_STAND_DETAILS,
+                                                       stand_dir=os.path.join(self.test_dir, 'first'),
+                                                       build_id='product_uni_7'))
+        second = stand.Stand(config=self.config, **dict(self.EXISTED_STAND_DETAILS,
+                                                        stand_dir=os.path.join(self.test_dir, 'second'),
+                                                        build_id=first.build_id))
+        for s in (first, second):
+            os.mkdir(os.path.join(s.stand_dir, build_cache.TOMCAT_WORK))
+
+        cache.install(first)
+        jsp_dir = os.path.join(first.stand_dir, build_cache.TOMCAT_WORK, 'Catalina', 'localhost', 'ROOT')
+        os.makedirs(jsp_dir)
+        for file_name in ('index_jsp.class', 'SESSIONS.ser'):
+            with open(os.path.join(jsp_dir, file_name), 'wt') as f:
+                f.write(file_name)
+        cache.collect(first)
+
+        cache.install(second)
+        second_jsp_dir = os.path.join(second.stand_dir, build_cache.TOMCAT_WORK, 'Catalina', 'localhost', 'ROOT')
+        self.assertEqual(['index_jsp.class'], os.listdir(second_jsp_dir))
+
+        second.build_id = 'product_uni_8'
+        cache.install(second)
+        self.assertFalse(os.path.exists(second_jsp_dir))
+
+    def test_9_build_cache_shared_builds(self):
+        """
+        Стенд со смонтированным кэшем сборок получает ссылку на сборку в кэше, смена сборки подменяет ссылку
+        и удаляет прежнюю сборку, если на ней не осталось стендов. Стенд без монтирования получает свою копию
+        """
+        self.config.build_cache_dir = os.path.join(self.test_dir, 'builds')
+        self.config.shared_builds = True
+        cache = build_cache.BuildCache(self.config)
+
+        class FakeJenkins:
+            @staticmethod
+            def resolve_build(project, build_number):
+                return build_number
+
+            @staticmethod
+            def get_build(project, path, build_number):
+                os.makedirs(path)
+                with open(os.path.join(path, 'index.html'), 'wt') as f:
+                    f.write(str(build_number))
+                return 'build {}'.format(build_number)
+
+        class Docker:
+            binds = ['{}:{}:ro'.format(self.config.build_cache_dir, build_cache.BUILDS_MOUNT)]
+
+            def inspect_container(self, container_id):
+                return {'HostConfig': {'Binds': self.binds}}
+
+        docker = Docker()
+        s = stand.Stand(config=self.config, cli=docker, **dict(self.EXISTED_STAND_DETAILS, container_id='shared',
+                                                               stand_dir=os.path.join(self.test_dir, 'shared')))
+        other = stand.Stand(config=self.config, cli=docker, **dict(self.EXISTED_STAND_DETAILS,
+                                                                   stand_dir=os.path.join(self.test_dir, 'other')))
+        cache.used_builds = lambda: {st.build_id for st in (s, other) if st.build_id}
+        builds = [build_cache.build_id(self.PROJECT, number) for number in range(4)]
+        webapp_dir = os.path.join(s.stand_dir, 'webapp')
+        t = task.Task(task.DO_UPDATE, s)
+        t._jenkins = FakeJenkins()
+
+        shared = build_cache.shared
+        build_cache.shared = lambda config=None: cache
+        try:
+            t._get_build(1)
+            self.assertEqual('/'.join((build_cache.BUILDS_MOUNT, builds[1], build_cache.BUILD_TREE)),
+                             os.readlink(webapp_dir))
+            self.assertEqual('build 1', s.version)
+
+            # Сборка, на которой есть другой стенд, остается в кэше
+            other.build_id = builds[1]
+            t._get_build(2)
+            self.assertEqual('/'.join((build_cache.BUILDS_MOUNT, builds[2], build_cache.BUILD_TREE)),
+                             os.readlink(webapp_dir))
+            self.assertTrue(os.path.isdir(os.path.join(cache.cache_dir, builds[1])))
+
+            docker.binds = []
+            t._get_build(3)
+            self.assertFalse(os.path.islink(webapp_dir))
+            with open(os.path.join(webapp_dir, 'index.html')) as f:
+                self.assertEqual('3', f.read())
+            self.assertEqual(builds[3], s.build_id)
+            self.assertEqual([builds[1]], os.listdir(cache.cache_dir))
+        finally:
+            build_cache.shared = shared
+
+    def test_9_events_cursor(self):
+        """
+        События после курсора, из буфера вытесняются старые события
+        """
+        bus = events.EventBus(3)
+        for status in ('WAIT', 'BUILD_AND_UPLOAD', 'TEST_RUN', None):
+            bus.publish(events.TASK, self.NAME, status=status)
+        self.assertEqual(4, bus.cursor)
+        self.assertEqual([2, 3, 4], [e['id'] for e in bus.since(0)])
+        self.assertEqual([None], [e['status'] for e in bus.since(3)])
+        self.assertTrue(bus.wait(3).done())
+        self.assertFalse(bus.wait(4).done())
+
+    def test_9_cancel_token(self):
+        """
+        Отмена прерывает ожидание и вызывает обработчики, вне задачи и в откате отмены нет
+        """
+        token = cancel.CancelToken()
+        killed = []
+        with cancel.activate(token):
+            self.assertIs(token, cancel.current())
+            with token.on_cancel(lambda: killed.append(1)):
+                token.cancel('test')
+            self.assertEqual([1], killed)
+            self.assertRaises(TaskCancelled, cancel.current().sleep, 60)
+            with cancel.activate(None):
+                cancel.current().check()
+        self.assertIs(cancel.NEVER, cancel.current())
+        self.assertRaises(RuntimeError, cancel.current().cancel)
+
+    def test_9_task_priority_aging(self):
+        """
+        Задача высшего класса выполняется первой, долго ждущая пакетная задача поднимается выше
+        """
+        self.config.task_aging_minutes = 10
+        queue = task_queue.TaskQueue(self.config)
+        s = stand.Stand(config=self.config, **dict(self.EXISTED_STAND_DETAILS, stand_dir=self.test_dir))
+        reduce = task.Task(task.DO_REDUCE, s)
+        update = task.Task(task.DO_UPDATE, s)
+        reduce.id, update.id = 1, 2
+        now = time.time()
+        self.assertEqual([update, reduce], sorted((reduce, update), key=lambda t: queue._rank(t, now)))
+        reduce.created = now - 2 * queue.aging
+        self.assertEqual([reduce, update], sorted((reduce, update), key=lambda t: queue._rank(t, now)))
+        self.assertRaises(DaemonException, queue.submit, update, priority='urgent')
+        # Задача уже в очереди, ее приоритет не меняется
+        self.assertIs(update, queue.submit(update, priority=task.PRIORITY_BATCH))
+        self.assertEqual(task.PRIORITY_INTERACTIVE, update.priority)
+
+    def test_9_task_coalesce(self):
+        """
+        Ожидающая задача принимает такую же задачу, новое восстановление заменяет ожидающее
+        """
+        s = stand.Stand(config=self.config, **dict(self.EXISTED_STAND_DETAILS, stand_dir=self.test_dir))
+        restore = task.Task(task.DO_RESTORE, s, backup_path='old.backup')
+        self.assertTrue(restore.coalesce(task.DO_RESTORE, {'backup_path': 'new.backup'},
+                                         task.PRIORITY_INTERACTIVE, False))
+        self.assertEqual('new.backup', restore.task_params['backup_path'])
+        self.assertEqual(task.PRIORITY_INTERACTIVE, restore.priority)
+        self.assertEqual('new.backup', s.active_task['task_params']['backup_path'])
+        self.assertFalse(restore.coalesce(task.DO_BACKUP, {'backup_path': 'new.backup'}, task.PRIORITY_NORMAL, False))
+
+        backup = task.Task(task.DO_BACKUP, s, backup_path='first.backup')
+        self.assertFalse(backup.coalesce(task.DO_BACKUP, {'backup_path': 'second.backup'}, task.PRIORITY_NORMAL, False))
+        self.assertTrue(backup.coalesce(task.DO_BACKUP, {'backup_path': 'first.backup'}, task.PRIORITY_BATCH, True))
+        self.assertFalse(backup.preemptible)
+        backup.started = time.time()
+        self.assertFalse(backup.coalesce(task.DO_BACKUP, {'backup_path': 'first.backup'}, task.PRIORITY_NORMAL, False))
+
+    def test_9_shared_objects(self):
+        """
+        Общий объект модуля создается один раз на ключ по конфигу первого обращения
+        """
+        shared = Shared(lambda config, cache_dir: (config, cache_dir))
+        first = shared.get(self.config, 'a')
+        self.assertIs(first, shared.get(None, 'a'))
+        self.assertIs(self.config, first[0])
+        self.assertEqual('b', shared.get(self.config, 'b')[1])
+
+    def test_9_reduced_cache_prune(self):
+        """
+        Кэш уменьшенных баз удаляет давно не использованные базы сверх лимита и суммы исчезнувших бэкапов
+        """
+        cache = reduced_cache.ReducedCache(os.path.join(self.test_dir, 'reduced'), max_size=10)
+
+        class Db:
+            @staticmethod
+            def backup(backup_path):
+                with open(backup_path, 'wt') as f:
+                    f.write('reduced')
+
+        backups = []
+        for i in range(2):
+            backups.append(os.path.join(self.test_dir, 'backup{}.backup'.format(i)))
+            with open(backups[-1], 'wt') as f:
+                f.write(str(i))
+            cache.put(Db, 'postgres', backups[-1])
+        self.assertIsNone(cache.get('postgres', backups[0]))
+        self.assertIsNotNone(cache.get('postgres', backups[1]))
+
+        os.remove(backups[0])
+        cache.prune()
+        self.assertEqual(1, len(cache._read_index()['checksums']))
+
+    def test_9_disk_space_evict(self):
+        """
+        Нехватка места не ждет, а сразу падает. Удаляются старые бэкапы на проверяемом диске, кроме нужного операции
+        """
+        self.config.disk_backup_retention_days = 1
+        self.config.reduced_cache_dir = ''
+        guard = disk_space.DiskSpaceGuard(self.config)
+        backups_dir = os.path.join(self.test_dir, 'backups')
+        os.makedirs(backups_dir, exist_ok=True)
+        old = time.time() - 3 * 24 * 3600
+        paths = []
+        for name in ('old.backup', 'restored.backup'):
+            paths.append(os.path.join(backups_dir, name))
+            with open(paths[-1], 'wt') as f:
+                f.write('0' * 100)
+            os.utime(paths[-1], (old, old))
+
+        started = time.time()
+        self.assertRaises(disk_space.NoDiskSpace, guard.ensure, 'restore', 1000, lambda: 0, evict_dir=backups_dir)
+        self.assertLess(time.time() - started, 5)
+        self.assertTrue(all(os.path.isfile(p) for p in paths))
+
+        self.assertRaises(disk_space.NoDiskSpace, guard.ensure, 'restore', 1000, lambda: 0,
+                          evict_dir=backups_dir, target_dir=self.test_dir, keep=paths[1])
+        self.assertFalse(os.path.isfile(paths[0]))
+        self.assertTrue(os.path.isfile(paths[1]))
+
+    def test_9_docker_pool_exhausted(self):
+        """
+        Пул отдает не больше size клиентов, при исчерпании ждет timeout и падает с DaemonException
+        """
+        pool = docker_pool.DockerPool(size=1, timeout=0.5, base_url='tcp://127.0.0.1:1')
+        with pool.client() as cli:
+            self.assertRaises(DaemonException, pool._acquire, 0.5)
+            dedicated = pool.dedicated()
+            self.assertIsNot(cli, dedicated)
+            dedicated.close()
+        with pool.client() as again:
+            self.assertIs(cli, again)
+        self.assertEqual(1, pool._created)
+
+    def test_9_throttle_copy(self):
+        """
+        Копирование не быстрее bytes_per_sec, зависший процесс убивается по таймауту
+        """
+        self.config.throttle_bytes_per_sec = 2 * throttle.COPY_CHUNK
+        t = throttle.Throttle(self.config)
+        started = time.time()
+        self.assertEqual(4 * throttle.COPY_CHUNK, t.copy(io.BytesIO(b'0' * 4 * throttle.COPY_CHUNK), io.BytesIO()))
+        self.assertGreaterEqual(time.time() - started, 1.5)
+
+        process = subprocess.Popen(['sleep', '60'], stdout=subprocess.PIPE)
+        started = time.time()
+        with throttle.kill_after(process, 0.5) as expired:
+            t.copy(process.stdout, io.BytesIO(), deadline=time.time() + 0.5)
+        self.assertTrue(expired.is_set())
+        self.assertLess(time.time() - started, 10)
+        process.wait()
+
+    def test_9_mssql_purge_gives_up(self):
+        """
+        Удаление файлов базы mssql уменьшает пачку после ошибки и прерывается после нескольких ошибок подряд
+        """
+        db = StandMssqlDb(addr=self.MSSQL, name='purge', user='user', password='pass', config=self.config)
+        db.purge_retry_seconds = 0
+        batches = []
+
+        def run_sql(sql, **kwargs):
+            batches.append(int(sql.split('top(')[1].split(')')[0]))
+            return -1
+
+        db._run_sql = run_sql
+        self.assertRaises(DaemonException, db._purge_database_files)
+        self.assertEqual([1000, 500, 250, 125, 100], batches)
+
+    def test_9_postgres_purge_pages_by_id(self):
+        """
+        Удаление файлов базы postgres идет пачками по id до пустой пачки, ошибка пачки не выдается за конец
+        """
+        self.config.postgres_reduce_batch = 2
+        db = StandPostgresDb(addr=self.DB_IP, name='purge', user='user', password='pass', config=self.config)
+        pages = iter(['7|2\n', '12|1\n', '|0\n'])
+        queries = []
+
+        def run_console_command(args, timeout, ignore_error=False, stdin=None):
+            self.assertFalse(ignore_error)
+            queries.append(args[-1])
+            return next(pages)
+
+        db._run_console_command = run_console_command
+        db._purge_database_files()
+        self.assertEqual(3, len(queries))
+        self.assertIn('id > 0 order by id limit 2', queries[0])
+        self.assertIn('id > 12 order by id limit 2', queries[2])
+
+        def failed(args, timeout, ignore_error=False, stdin=None):
+            raise DaemonException('Console command for postgresql failed. See log for details')
+
+        db._run_console_command = failed
+        self.assertRaises(DaemonException, db._purge_database_files)
+
+    def test_9_health_monitor_reports_startup(self):
+        """
+        Монитор ждет строки о запуске в логе, затем проверяет веб-интерфейс и сообщает о готовности событием,
+        даже если ошибки не было. Ошибки проверок копятся до health_failures, перезапуск стенда сбрасывает готовность
+        """
+        self.config.health_failures = 2
+        s = self.FakeStand('web')
+        sm = self.FakeStandManager(s)
+        probes = []
+
+        class FakeHTTPClient:
+            @gen.coroutine
+            def fetch(self, url, request_timeout=None):
+                error = probes.pop(0)
+                if error:
+                    raise HTTPError(599, error)
+
+        monitor = health_monitor.HealthMonitor(sm, self.config)
+        monitor.http = FakeHTTPClient()
+        monitor._first_check = False
+        bus = events.shared(self.config)
+        loop = IOLoop()
+        try:
+
+            def check():
+                for health in monitor.health.values():
+                    health.next_check = 0
+                loop.run_sync(monitor._check_all)
+
+            s.started_at = time.time()
+            cursor = bus.cursor
+            check()
+            self.assertFalse(monitor.is_ready('web'))
+            self.assertIsNone(bus.wait_for(cursor, lambda e: e['stand'] == 'web', 0))
+
+            sm.docker.output = b'INFO: Server startup in 25000 ms'
+            probes.append(None)
+            check()
+            self.assertTrue(monitor.is_ready('web'))
+            event = bus.wait_for(cursor, lambda e: e['stand'] == 'web', 0)
+            self.assertEqual((events.WEB_INTERFACE, None), (event['type'], event['error']))
+
+            probes.extend(['Timeout', 'Timeout'])
+            check()
+            self.assertIsNone(s.web_interface_error)
+            self.assertFalse(monitor.is_ready('web'))
+            check()
+            self.assertIn('Timeout', s.web_interface_error)
+
+            s.started_at = time.time() + 1
+            sm.docker.output = b''
+            check()
+            self.assertFalse(monitor.health['web'].ready)
+        finally:
+            loop.close()
+
+    def test_9_proxy_streams_response(self):
+        """
+        Прокси передает тело ответа стенда по частям, переписывает Location на путь прокси
+        и не пропускает заголовки соединения ни в запросе, ни в ответе
+        """
+        released = locks.Event()
+
+        class Upstream(RequestHandler):
+            @gen.coroutine
+            def get(self, path):
+                if path == 'redirect':
+                    self.redirect('/target')
+                    return
+                self.set_header('Keep-Alive', 'timeout=5')
+                self.set_header('X-Stand', 'web')
+                self.write('{},{};'.format(self.request.headers.get('X-Secret', '-'),
+                                           self.request.headers.get('X-Forwarded-Host')))
+                yield self.flush()
+                # Вторая часть уходит только после того, как клиент получил первую
+                yield released.wait(timeout=datetime.timedelta(seconds=5))
+                self.write('done')
+
+        s = self.FakeStand('web', last_access=time.time())
+        sm = stand_manager.StandManager.__new__(stand_manager.StandManager)
+        sm.stands = {s.name: s}
+        monitor = health_monitor.HealthMonitor(self.FakeStandManager(s), self.config)
+        monitor.health[s.name] = health_monitor._StandHealth(0, ready=True)
+        proxy = Application([(r'/p/([a-z,0-9,\-,_]+)(/.*)?', web_handlers.ProxyHandler)])
+        proxy.sm = sm
+        proxy.health_monitor = monitor
+        proxy.conf = self.config
+
+        @gen.coroutine
+        def run():
+            upstream_socket, upstream_port = bind_unused_port()
+            s.ports = [upstream_port]
+            upstream_server = HTTPServer(Application([(r'/(.*)', Upstream)]))
+            upstream_server.add_sockets([upstream_socket])
+            proxy_socket, proxy_port = bind_unused_port()
+            proxy_server = HTTPServer(proxy)
+            proxy_server.add_sockets([proxy_socket])
+            client = AsyncHTTPClient()
+            url = 'http://127.0.0.1:{}/p/web/'.format(proxy_port)
+            try:
+                redirect = yield client.fetch(url + 'redirect', follow_redirects=False, raise_error=False)
+                chunks = []
+
+                def on_chunk(chunk):
+                    chunks.append(chunk)
+                    released.set()
+
+                response = yield client.fetch(url + 'stream', headers={'Connection': 'X-Secret', 'X-Secret': '1'},
+                                              streaming_callback=on_chunk, request_timeout=10)
+                return redirect, response, chunks, proxy_port
+            finally:
+                upstream_server.stop()
+                proxy_server.stop()
+
+        loop = IOLoop()
+        try:
+            redirect, response, chunks, proxy_port = loop.run_sync(run, timeout=15)
+        finally:
+            loop.close()
+        self.assertEqual(302, redirect.code)
+        self.assertEqual('/p/web/target', redirect.headers['Location'])
+        self.assertEqual(['-,127.0.0.1:{};'.format(proxy_port).encode(), b'done'], chunks)
+        self.assertEqual('web', response.headers['X-Stand'])
+        self.assertNotIn('Keep-Alive', response.headers)
+
+    def test_9_state_store(self):
+        """
+        Хранилище состояния возвращает сохраненные стенды и порты, откатывает неудачный batch и импортирует
+        stand_info.json из директорий стендов
+        """
+        store = state_store.StateStore(os.path.join(self.test_dir, 'state_store.db'))
+        try:
+            store.save_stand('a', {'name': 'a', 'active_task': {'status': task.WAIT}})
+            store.save_stand('b', {'name': 'b', 'active_task': None})
+            self.assertEqual(['a', 'b'], [i['name'] for i in store.load_stands()])
+            self.assertEqual(['a'], store.stands_with_task())
+
+            with self.assertRaises(RuntimeError):
+                with store.batch():
+                    store.delete_stand('a')
+                    store.save_port('tomcat', 8000, 'b')
+                    raise RuntimeError
+            self.assertEqual(2, len(store.load_stands()))
+            self.assertEqual([], store.load_ports())
+
+            with store.batch():
+                store.save_port('tomcat', 8000, 'b')
+                store.save_port('tomcat', 8001, 'b')
+            store.delete_port('tomcat', 8001)
+            self.assertEqual([('tomcat', 8000, 'b')], store.load_ports())
+
+            stand_dir = os.path.join(self.test_dir, 'stands', 'c')
+            os.makedirs(stand_dir, exist_ok=True)
+            with open(os.path.join(stand_dir, 'stand_info.json'), 'wt') as f:
+                f.write('{"name": "c"}')
+            store.import_stand_files(os.path.dirname(stand_dir))
+            self.assertEqual(['a', 'b', 'c'], [i['name'] for i in store.load_stands()])
+        finally:
+            store.close()
+
+    def test_9_stand_shares_config_and_client(self):
+        """
+        Стенд использует общий конфиг и клиент докера, база и клиент дженкинса создаются при первом обращении,
+        создание объекта стенда ничего не пишет
+        """
+        self.config.backup_timeout = 12345
+        cli = Client(base_url='tcp://127.0.0.1:1')
+        stand_dir = os.path.join(self.test_dir, 'shared')
+        s = stand.Stand(cli=cli, config=self.config, **dict(self.EXISTED_STAND_DETAILS, stand_dir=stand_dir))
+        self.assertIs(cli, s.cli)
+        self.assertFalse(os.path.isfile(s.stand_info))
+        self.assertIsNone(s._db)
+        self.assertEqual(12345, s.db.backup_timeout)
+        self.assertIs(s.db, s.db)
+        for key in ('cli', 'config', 'store', '_db'):
+            self.assertNotIn(key, s.info())
+
+        t = task.Task(task.DO_UPDATE, s, do_build=False)
+        self.assertIsNone(t._jenkins)
+
+    def test_9_start_queue(self):
+        """
+        Запуск при свободных ресурсах сразу, иначе заявка ждет в очереди. Повторная заявка того же стенда
+        не создается, политика lru останавливает давно не используемый стенд без задачи
+        """
+        sm = self.FakeStandManager(self.FakeStand('idle', time.time() - 7200),
+                                   self.FakeStand('recent', time.time()),
+                                   self.FakeStand('task', active_task={'status': task.BACKUP_DB}))
+        self.config.start_evict_policy = start_queue.EVICT_NONE
+        queue = start_queue.StartQueue(sm, self.config)
+        self.assertEqual(start_queue.STARTED, queue.submit('first').status)
+
+        sm.free = False
+        ticket = queue.submit('second')
+        self.assertIs(ticket, queue.submit('second'))
+        self.assertEqual(1, queue.position(ticket))
+        self.assertFalse(ticket.wait(0.5))
+        sm.free = True
+        queue.notify()
+        self.assertTrue(ticket.wait(5))
+        self.assertEqual(start_queue.STARTED, ticket.status)
+        self.assertIs(ticket, queue.get(ticket.id))
+
+        sm.free = False
+        self.config.start_evict_policy = start_queue.EVICT_LRU
+        queue = start_queue.StartQueue(sm, self.config)
+        ticket = queue.submit('third')
+        self.assertTrue(ticket.wait(5))
+        self.assertEqual(start_queue.STARTED, ticket.status)
+        self.assertEqual(['idle'], sm.stopped)
+        self.assertEqual(['first', 'second', 'third'], sm.started)
+
+    def test_9_memory_admission_through_pool(self):
+        """
+        Допуск по памяти получает статистику контейнеров через пул клиентов докера
+        """
+        running = self.FakeStand('running')
+        sm = self.FakeStandManager(running)
+        sm.docker.samples = [{'memory_stats': {'usage': 100 * memory.MB}}] * 3
+
+        self.config.memory_reserve_mb = -100 * 1024
+        admission = memory.MemoryAdmission(sm.cli, self.config)
+        self.assertEqual(100 * memory.MB, admission.usage('running'))
+        self.assertTrue(admission.admit(self.FakeStand('new'), [running]))
+        self.config.memory_reserve_mb = memory.host_available() // memory.MB
+        self.assertFalse(memory.MemoryAdmission(sm.cli, self.config).admit(self.FakeStand('new'), [running]))
+        self.assertEqual(3, sm.cli.metrics()['requests']['stats']['count'])
+
+    def test_9_idle_detector_stops_idle(self):
+        """
+        Простой определяется по статистике докера через пул: активный стенд не трогается, простаивающий дольше
+        idle_stop_minutes останавливается
+        """
+        sm = self.FakeStandManager(self.FakeStand('idle'))
+        sm.docker.samples = [{'networks': {'eth0': {'rx_bytes': rx, 'tx_bytes': tx}}}
+                             for rx, tx in ((0, 0), (10 ** 6, 0), (10 ** 6, 100))]
+        detector = idle_detector.IdleDetector(sm, self.config)
+        loop = IOLoop()
+        try:
+            loop.run_sync(detector._check_all)
+            detector.last_activity['idle'] -= detector.stop_after
+            loop.run_sync(detector._check_all)
+            self.assertTrue(detector.is_busy('idle'))
+            self.assertEqual([], sm.stopped)
+
+            detector.last_activity['idle'] -= detector.stop_after
+            loop.run_sync(detector._check_all)
+            self.assertEqual(['idle'], sm.stopped)
+            self.assertFalse(detector.is_busy('idle'))
+        finally:
+            loop.close()
+
+    def test_9_warm_standby_demotion(self):
+        """
+        Замороженный стенд останавливается через pause_max_minutes, при нехватке памяти - все замороженные,
+        начиная с давно не используемых
+        """
+        sm = self.FakeStandManager(self.FakeStand('old', 3, paused=True), self.FakeStand('fresh', 2, paused=True),
+                                   self.FakeStand('recent', 1, paused=True), self.FakeStand('running'))
+        stops = []
+        self.config.pause_min_free_mb = 0
+        standby = warm_standby.WarmStandby(sm, self.config, on_stop=lambda: stops.append(1))
+        loop = IOLoop()
+        try:
+            loop.run_sync(standby._check_all)
+            self.assertEqual({'old', 'fresh', 'recent'}, set(standby.paused_since))
+            standby.paused_since['old'] -= standby.max_paused
+            loop.run_sync(standby._check_all)
+            self.assertEqual(['old'], sm.stopped)
+
+            standby.min_free = memory.host_available() * 2
+            loop.run_sync(standby._check_all)
+            self.assertEqual(['old', 'recent', 'fresh'], sm.stopped)
+            self.assertEqual(3, len(stops))
+            self.assertEqual({}, standby.paused_since)
+        finally:
+            loop.close()
+
+    def test_9_task_queue_run_order(self):
+        """
+        Очередь выполняет задачи по классам приоритета, задачу можно найти по номеру и дождаться.
+        Отмененная в очереди задача не выполняется, выполняемая прерывается. Задача без места на диске
+        откладывается и не держит очередь. Вытесненная фоновая задача выполняется после вытеснившей
+        """
+        ran = []
+        release = threading.Event()
+        hold = threading.Event()
+        no_space = [True]
+
+        class FakeTask(task.Task):
+            def _step(self):
+                if self.task_params.get('block'):
+                    while not release.is_set():
+                        cancel.current().sleep(0.05)
+                if self.task_params.get('hold'):
+                    hold.wait(5)
+                if self.task_params.get('no_space') and no_space[0]:
+                    no_space[0] = False
+                    raise disk_space.NoDiskSpace('No space')
+                ran.append(self.task_params['label'])
+
+            _update = _reduce = _backup_db = _step
+
+        def new_task(do, label, **params):
+            name = 'queue_{}'.format(label)
+            s = stand.Stand(config=self.config, **dict(self.EXISTED_STAND_DETAILS, name=name,
+                                                       stand_dir=os.path.join(self.test_dir, name)))
+            return FakeTask(do, s, label=label, **params)
+
+        retry = task.DISK_SPACE_RETRY
+        task.DISK_SPACE_RETRY = 0.5
+        try:
+            queue = task_queue.TaskQueue(self.config)
+            blocker = queue.submit(new_task(task.DO_UPDATE, 'blocker', block=True))
+            while not blocker.started:
+                time.sleep(0.05)
+            deferred = queue.submit(new_task(task.DO_BACKUP, 'deferred', no_space=True), task.PRIORITY_INTERACTIVE)
+            reduce = queue.submit(new_task(task.DO_REDUCE, 'reduce'))
+            cancelled = queue.submit(new_task(task.DO_UPDATE, 'cancelled'))
+            update = queue.submit(new_task(task.DO_UPDATE, 'update'))
+            self.assertEqual(['blocker', 'deferred', 'cancelled', 'update', 'reduce'],
+                             [t['stand'][len('queue_'):] for t in queue.as_list()])
+
+            self.assertIs(cancelled, queue.cancel(cancelled.id))
+            self.assertEqual(task.CANCELLED, cancelled.result)
+            release.set()
+            self.assertTrue(reduce.wait(5))
+            self.assertTrue(deferred.wait(5))
+            self.assertEqual(['blocker', 'update', 'reduce', 'deferred'], ran)
+            self.assertEqual(task.DONE, deferred.result)
+            self.assertIsNone(queue.position(update))
+            self.assertIs(update, queue.get(update.id))
+
+            release.clear()
+            running = queue.submit(new_task(task.DO_UPDATE, 'running', block=True))
+            while not running.started:
+                time.sleep(0.05)
+            queue.cancel(running.id)
+            self.assertTrue(running.wait(5))
+            self.assertEqual(task.CANCELLED, running.result)
+            self.assertRaises(DaemonException, queue.cancel, running.id)
+
+            release.clear()
+            background = new_task(task.DO_BACKUP, 'background', block=True)
+            background.preemptible = True
+            queue.submit(background)
+            while not background.started:
+                time.sleep(0.05)
+            urgent = queue.submit(new_task(task.DO_REDUCE, 'urgent', hold=True))
+            while not urgent.started:
+                time.sleep(0.05)
+            # Вытесненная задача ждет в очереди с тем же номером и снова принимает задачи стенда
+            self.assertEqual(1, queue.position(background))
+            self.assertEqual(task.WAIT, background.status)
+            self.assertIsNone(background.result)
+            self.assertTrue(background.coalesce(task.DO_BACKUP, dict(background.task_params), task.PRIORITY_BATCH,
+                                                True))
+            hold.set()
+            release.set()
+            self.assertTrue(urgent.wait(5))
+            self.assertTrue(background.wait(5))
+            self.assertEqual(task.DONE, background.result)
+            self.assertEqual(['urgent', 'background'], ran[-2:])
+            self.assertEqual([background.id], [t['id'] for t in queue.as_list(with_finished=True)
+                                               if t['stand'] == 'queue_background'])
+        finally:
+            task.DISK_SPACE_RETRY = retry
+            release.set()
+            hold.set()
+
     def test_10_db_postgres(self):
         """
         Cоздание, бэкап и восстановление баз данных Postgres
@@ -299,6 +1131,28 @@ class DaemonTests(unittest.TestCase):
         db.backup(backup_path)
         db.restore(backup_path)
 
+    def test_11_db_mssql_striped(self):
+        """
+        Бэкап MSSQL в несколько файлов и восстановление из них
+        """
+        self.config.mssql_backup_stripes = 3
+        self.config.mssql_buffer_count = 16
+        self.config.mssql_max_transfer_size = 4194304
+        backup_path = '{}\\test_striped.bak'.format(self.config.mssql_backup_dir)
+        db = StandMssqlDb(addr=self.MSSQL,
+                          name='test{}'.format(time.time()).replace('.', ''),
+                          user=self.config.mssql_user,
+                          password=self.config.mssql_pass,
+                          config=self.config)
+        self.assertEqual([backup_path, backup_path + '.2', backup_path + '.3'],
+                         db._stripe_paths(backup_path, 3))
+        db.create()
+        db.backup(backup_path)
+        # Пути частей берутся из заголовка бэкапа, а не из текущих настроек
+        db.backup_stripe_dirs = ['C:\\missing']
+        self.assertEqual([backup_path, backup_path + '.2', backup_path + '.3'], db._backup_stripe_paths(backup_path))
+        db.restore(backup_path)
+
     def _stand_and_new_db(self, db_type, db_container=None):
         sm = stand_manager.StandManager(self.config)
         t = sm.add_new(name=self.NAME,
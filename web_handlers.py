@@ -1,12 +1,24 @@
+import datetime
+import json
 import logging
 import os
+import time
 from concurrent.futures import ThreadPoolExecutor
 
-from tornado import gen
+from tornado import gen, httputil
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httputil import HTTPHeaders
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
 from tornado.web import RequestHandler
 
+from daemon import docker_pool, events, start_queue, throttle
 from daemon.exceptions import DaemonException
+from daemon.health_monitor import HealthMonitor
 from daemon.stand_manager import StandManager
+from daemon.task import DO_UPDATE, DONE, PRIORITIES
+from daemon.task_queue import TaskQueue
 
 log = logging.getLogger(__name__)
 
@@ -22,19 +34,78 @@ class CommonHandler(RequestHandler):
         assert isinstance(tpe, ThreadPoolExecutor)
         return tpe
 
-    def _get_long_task_tpe(self):
-        tpe = self.application.long_task_tpe
-        assert isinstance(tpe, ThreadPoolExecutor)
-        return tpe
+    def _get_task_queue(self):
+        queue = self.application.task_queue
+        assert isinstance(queue, TaskQueue)
+        return queue
+
+    def _get_start_queue(self):
+        queue = self.application.start_queue
+        assert isinstance(queue, start_queue.StartQueue)
+        return queue
+
+    def _get_health_monitor(self):
+        monitor = self.application.health_monitor
+        assert isinstance(monitor, HealthMonitor)
+        return monitor
+
+    @staticmethod
+    def _done_future(obj) -> Future:
+        """
+        Футура торнадо, которая завершится вместе с заявкой на запуск или задачей, без ожидания в потоке
+        """
+        future = Future()
+        io_loop = IOLoop.current()
+        obj.add_done_callback(lambda o: io_loop.add_callback(future.set_result, o))
+        return future
+
+    def _submit(self, task):
+        """
+        Поставить задачу в очередь, ?priority= меняет класс приоритета новой задачи. Задаче, в которую слился
+        запрос, приоритет передает StandManager
+        """
+        return self._get_task_queue().submit(task, priority=self.get_argument('priority', None))
+
+    def _task_text(self, task) -> str:
+        return 'Task added. Id: {}, position: {}'.format(task.id, self._get_task_queue().position(task))
+
+    @gen.coroutine
+    def _wait_done(self, obj):
+        """
+        Подождать завершения заявки или задачи не дольше ?wait= секунд
+        """
+        wait = self.get_argument('wait', None)
+        if not wait:
+            return
+        try:
+            yield gen.with_timeout(datetime.timedelta(seconds=int(wait)), self._done_future(obj))
+        except gen.TimeoutError:
+            pass
+        except ValueError:
+            raise DaemonException('wait should be a number of seconds')
+
+    def _ticket_text(self, ticket) -> str:
+        if ticket.status == start_queue.STARTED:
+            return 'Done'
+        if ticket.status == start_queue.ERROR:
+            return ticket.error
+        return 'Start queued. Ticket: {}, position: {}'.format(ticket.id, self._get_start_queue().position(ticket))
 
 
 class StandHandler(CommonHandler):
+    def prepare(self):
+        # Проверяем до создания задачи: задача, которая не попала в очередь, заняла бы стенд
+        priority = self.get_argument('priority', None)
+        if priority and priority not in PRIORITIES:
+            self.finish('Incorrect priority, use: {}'.format(', '.join(PRIORITIES)))
+
     @gen.coroutine
     def get(self, name, action):
         try:
             if action == '':
                 self.redirect(
                         self._get_stand_manager().get_url(name))
+                self._get_stand_manager().touch(name)
                 return
 
             if action == 'start':
@@ -46,58 +117,79 @@ class StandHandler(CommonHandler):
 
                 sm = self._get_stand_manager()
 
-                yield self._get_fast_task_tpe().submit(
-                        sm.start, name, wait=False)
-
-                # Выключение стенда по таймауту
-
-                # Tornado ``Futures`` do not support cancellation at current version
-                # if name in sm.stands_futures:
-                #     sm.stands_futures[name].cancel()
-                # Торнадовская футура передаст self в callback
-                def stop_callback(f):
-                    if f in sm.stands_futures.values():
-                        log.info('Stop %s by timeout', name)
-                        sm.stop(name)
-                    else:
-                        log.debug('Stand %s stop event was cancelled earlier', name)
-
-                if self._get_stand_manager().stop_by_timeout:
-                    future = gen.sleep(duration * 60)
-                    future.add_done_callback(stop_callback)
-                    sm.stands_futures[name] = future
+                # Ожидающее обновление само запустит стенд в конце, отдельный запуск до него лишний
+                pending = sm.pending_task(name)
+                if pending and pending.do == DO_UPDATE:
+                    def schedule_stop_after_task(f):
+                        if f.result().result == DONE and sm.stop_by_timeout:
+                            sm.schedule_stop(name, duration)
+
+                    task_future = self._done_future(pending)
+                    task_future.add_done_callback(schedule_stop_after_task)
+                    self.finish('Stand will be started by task {}'.format(pending.id))
+                    return
+
+                # Если места нет, запуск встает в очередь
+                ticket = yield self._get_fast_task_tpe().submit(
+                        self._get_start_queue().submit, name)
+
+                # Выключение стенда по таймауту, отсчитывается от фактического запуска
+                def schedule_stop(f):
+                    if f.result().status == start_queue.STARTED and sm.stop_by_timeout:
+                        sm.schedule_stop(name, duration)
+
+                ticket_future = self._done_future(ticket)
+                ticket_future.add_done_callback(schedule_stop)
+
+                if self.get_argument('wait', False):
+                    yield ticket_future
+                self.finish(self._ticket_text(ticket))
+                return
 
-                self.finish('Done')
+            if action == 'extend':
+                duration = self.get_argument('duration', 60)
+                try:
+                    duration = int(duration)
+                except ValueError:
+                    raise DaemonException('Incorrect duration')
+                self.finish(self._get_stand_manager().extend(name, duration))
                 return
 
             if action == 'stop':
+                if self.get_argument('pause', False):
+                    yield self._get_fast_task_tpe().submit(
+                            self._get_stand_manager().pause, name)
+                    self.finish('Done')
+                    return
                 yield self._get_fast_task_tpe().submit(
                         self._get_stand_manager().stop, name, wait=False)
+                self._get_start_queue().notify()
                 self.finish('Done')
                 return
 
             if action == 'update':
                 task = self._get_stand_manager().update(name,
                                                         change_branch=self.get_argument('change_branch', None),
+                                                        priority=self.get_argument('priority', None),
                                                         )
-                self._get_long_task_tpe().submit(task.run)
-                self.finish('Task added')
+                self.finish(self._task_text(self._submit(task)))
                 return
 
             if action == 'backup':
                 task = self._get_stand_manager().backup_db(name,
                                                            file=self.get_argument('file', None),
+                                                           preemptible=bool(self.get_argument('background', False)),
+                                                           priority=self.get_argument('priority', None),
                                                            )
-                self._get_long_task_tpe().submit(task.run)
-                self.finish('Task added')
+                self.finish(self._task_text(self._submit(task)))
                 return
 
             if action == 'restore':
                 task = self._get_stand_manager().restore_db(name,
                                                             file=self.get_argument('file', None),
+                                                            priority=self.get_argument('priority', None),
                                                             )
-                self._get_long_task_tpe().submit(task.run)
-                self.finish('Task added')
+                self.finish(self._task_text(self._submit(task)))
                 return
 
             if action == 'log':
@@ -117,12 +209,11 @@ class StandHandler(CommonHandler):
                         do_build=self.get_argument('do_build', False),
                         do_backup=self.get_argument('do_backup', False),
                 )
-                for task in task_l:
-                    self._get_long_task_tpe().submit(task.run)
-                self.finish('Tasks added')
+                task_l = [self._submit(task) for task in task_l]
+                self.finish('Tasks added. Ids: {}'.format(', '.join(str(task.id) for task in task_l)))
                 return
 
-            self.finish('Incorrect action, use: start, stop, update, log, backup, restore, clone')
+            self.finish('Incorrect action, use: start, extend, stop, update, log, backup, restore, clone')
             return
 
         except DaemonException as e:
@@ -162,14 +253,12 @@ class StandHandler(CommonHandler):
                         reduce=self.get_body_argument('reduce', False),
                         uni_schema=self.get_body_argument('uni_schema', None),
                 )
-                self._get_long_task_tpe().submit(task.run)
-                self.finish('Task added')
+                self.finish(self._task_text(self._submit(task)))
                 return
 
             if action == 'reduce':
-                task = self._get_stand_manager().reduce(name)
-                self._get_long_task_tpe().submit(task.run)
-                self.finish('Task added')
+                task = self._get_stand_manager().reduce(name, priority=self.get_argument('priority', None))
+                self.finish(self._task_text(self._submit(task)))
                 return
 
             self.finish('Incorrect action, use: add, reduce')
@@ -199,6 +288,284 @@ class ListHandler(CommonHandler):
             self.finish(str(e))
 
 
+class ProxyHandler(CommonHandler):
+    """
+    Проксирует запросы к стенду по пути /p/<стенд>/... или по заголовку Host <стенд>.<proxy_domain>.
+    Остановленный стенд запускается: браузер получает страницу ожидания с автообновлением, остальные
+    клиенты ждут готовности стенда не дольше proxy_start_timeout. Тело ответа стенда передается клиенту
+    по мере получения
+    """
+    SUPPORTED_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS')
+
+    # Заголовки соединения не передаются через прокси ни в запросе, ни в ответе. Content-Length торнадо
+    # выставляет сам: тело запроса уходит целиком, а ответ - частями в chunked
+    HOP_HEADERS = ('Connection', 'Keep-Alive', 'Proxy-Connection', 'Transfer-Encoding', 'Te', 'Trailer',
+                   'Upgrade', 'Content-Length')
+
+    # Не чаще раза в минуту пишем время обращения к стенду
+    TOUCH_INTERVAL = 60
+
+    STARTING_PAGE = ('<HTML><Head><meta http-equiv="refresh" content="5"><title>{name}</title></Head>'
+                     '<Body>Стенд {name} запускается, страница обновится автоматически</Body></HTML>')
+
+    @gen.coroutine
+    def _proxy(self, name=None, path=None):
+        if name is None:
+            # Маршрутизация по заголовку Host
+            name = self.request.host.split(':')[0].split('.')[0]
+            path = self.request.path
+            prefix = ''
+        elif path is None:
+            # Без завершающего слеша относительные ссылки стенда не будут работать
+            self.redirect(self.request.path + '/')
+            return
+        else:
+            prefix = '/p/{}'.format(name)
+
+        sm = self._get_stand_manager()
+        stand = sm.stands.get(name)
+        if not stand:
+            self.send_error(404)
+            return
+
+        if not stand.last_access or time.time() - stand.last_access > self.TOUCH_INTERVAL:
+            sm.touch(name)
+
+        monitor = self._get_health_monitor()
+        resumed = False
+        if not monitor.is_ready(name):
+            # Замороженный стенд был готов, после разморозки сразу отвечает
+            try:
+                resumed = yield self._get_fast_task_tpe().submit(sm.resume, name)
+            except DaemonException as e:
+                self.set_status(503)
+                self.finish(str(e))
+                return
+            if resumed and sm.stop_by_timeout:
+                sm.schedule_stop(name, self.application.conf.proxy_stop_minutes)
+        if not resumed and not monitor.is_ready(name):
+            running = yield self._get_fast_task_tpe().submit(stand.is_running)
+            if not running:
+                try:
+                    ticket = yield self._get_fast_task_tpe().submit(self._get_start_queue().submit, name)
+                except DaemonException as e:
+                    self.set_status(503)
+                    self.finish(str(e))
+                    return
+                if ticket.status == start_queue.ERROR:
+                    self.set_status(503)
+                    self.finish(ticket.error)
+                    return
+                if sm.stop_by_timeout:
+                    sm.schedule_stop(name, self.application.conf.proxy_stop_minutes)
+
+            if 'text/html' in self.request.headers.get('Accept', ''):
+                self.set_status(503)
+                self.set_header('Retry-After', 5)
+                self.finish(self.STARTING_PAGE.format(name=name))
+                return
+
+            deadline = time.time() + self.application.conf.proxy_start_timeout
+            while not monitor.is_ready(name):
+                if time.time() > deadline:
+                    self.set_status(504)
+                    self.finish('Stand {} was not started in time'.format(name))
+                    return
+                yield gen.sleep(2)
+
+        url = 'http://localhost:{}{}'.format(stand.ports[0], path)
+        if self.request.query:
+            url += '?' + self.request.query
+        # Заголовки, перечисленные в Connection, тоже относятся только к этому соединению
+        hop_headers = set(self.HOP_HEADERS)
+        hop_headers.update(h.strip().title() for h in self.request.headers.get('Connection', '').split(','))
+        headers = HTTPHeaders()
+        for header, value in self.request.headers.get_all():
+            if header not in hop_headers:
+                headers.add(header, value)
+        headers['X-Forwarded-Host'] = self.request.host
+        headers['X-Forwarded-For'] = self.request.remote_ip
+        headers['X-Forwarded-Proto'] = self.request.protocol
+        upstream = {}
+
+        def on_header(line):
+            # Первая строка - статус, пустая строка завершает заголовки. Ответы 1xx предваряют настоящий ответ
+            if line.startswith('HTTP/'):
+                upstream['start_line'] = httputil.parse_response_start_line(line.strip())
+                upstream['headers'] = HTTPHeaders()
+            elif line.strip():
+                upstream['headers'].parse_line(line.rstrip('\r\n'))
+            elif upstream['start_line'].code >= 200:
+                self._start_response(upstream['start_line'], upstream['headers'], prefix)
+
+        def on_chunk(chunk):
+            # Тело ответа уходит клиенту по частям, не собираясь целиком в памяти демона
+            self.write(chunk)
+            self.flush()
+
+        request = HTTPRequest(url,
+                              method=self.request.method,
+                              headers=headers,
+                              body=self.request.body if self.request.method in ('POST', 'PUT', 'PATCH') else None,
+                              follow_redirects=False,
+                              decompress_response=False,
+                              request_timeout=self.application.conf.proxy_timeout,
+                              header_callback=on_header,
+                              streaming_callback=on_chunk)
+        response = yield AsyncHTTPClient().fetch(request, raise_error=False)
+        if response.code == 599 and not self._headers_written:
+            self.clear()
+            self.set_status(502)
+            self.finish('Stand {} is not available: {}'.format(name, response.error))
+            return
+        if response.code == 599:
+            # Ответ оборвался на середине, клиент должен это увидеть
+            log.info('Proxy response of %s is broken: %s', name, response.error)
+            self.request.connection.close()
+            return
+        self.finish()
+
+    def _start_response(self, start_line, headers, prefix):
+        self.set_status(start_line.code, start_line.reason)
+        for header in ('Content-Type', 'Server', 'Date'):
+            self.clear_header(header)
+        # Заголовки, перечисленные в Connection, тоже относятся только к этому соединению
+        hop_headers = set(self.HOP_HEADERS)
+        hop_headers.update(h.strip().title() for h in headers.get('Connection', '').split(','))
+        for header, value in headers.get_all():
+            if header in hop_headers:
+                continue
+            if header == 'Location' and value.startswith('/'):
+                value = prefix + value
+            self.add_header(header, value)
+
+    get = head = post = put = delete = patch = options = _proxy
+
+
+class StartTicketHandler(CommonHandler):
+    @gen.coroutine
+    def get(self, ticket_id):
+        try:
+            ticket = self._get_start_queue().get(int(ticket_id))
+            yield self._wait_done(ticket)
+            self.finish(ticket.as_dict(position=self._get_start_queue().position(ticket)))
+        except DaemonException as e:
+            log.info(e)
+            self.finish(str(e))
+
+
+class TaskHandler(CommonHandler):
+    @gen.coroutine
+    def get(self, task_id, action):
+        try:
+            if action == 'cancel':
+                task = yield self._get_fast_task_tpe().submit(self._get_task_queue().cancel, int(task_id))
+            elif action == '':
+                task = self._get_task_queue().get(int(task_id))
+            else:
+                self.finish('Incorrect action, use: cancel')
+                return
+            yield self._wait_done(task)
+            self.finish(task.as_dict(position=self._get_task_queue().position(task)))
+        except DaemonException as e:
+            log.info(e)
+            self.finish(str(e))
+
+
+class TasksHandler(CommonHandler):
+    def get(self):
+        self.finish({'tasks': self._get_task_queue().as_list(with_finished=self.get_argument('all', False))})
+
+
+class ThrottleHandler(CommonHandler):
+    def get(self):
+        try:
+            params = {}
+            for key in ('io_class', 'io_level', 'cpu_nice', 'blkio_weight', 'bytes_per_sec'):
+                val = self.get_argument(key, None)
+                if val is not None:
+                    try:
+                        params[key] = int(val)
+                    except ValueError:
+                        raise DaemonException('{} should be a number'.format(key))
+            t = throttle.shared(self.application.conf)
+            if params:
+                t.update(**params)
+            self.finish(t.as_dict())
+        except DaemonException as e:
+            log.info(e)
+            self.finish(str(e))
+
+
+class MetricsHandler(CommonHandler):
+    def get(self):
+        self.finish({'docker': docker_pool.shared(self.application.conf).metrics(),
+                     'ports': self._get_stand_manager().port_allocator.stats()})
+
+
+class EventsHandler(CommonHandler):
+    # Как часто напоминать клиенту SSE о соединении, в секундах
+    HEARTBEAT = 15
+
+    @gen.coroutine
+    def get(self):
+        try:
+            bus = events.shared(self.application.conf)
+            stand = self.get_argument('stand', None)
+            # Без курсора клиент получает только новые события
+            cursor = self.request.headers.get('Last-Event-ID') or self.get_argument('cursor', None)
+            try:
+                cursor = int(cursor) if cursor else bus.cursor
+                timeout = int(self.get_argument('timeout', 30))
+            except ValueError:
+                raise DaemonException('cursor and timeout should be numbers')
+
+            if 'text/event-stream' in self.request.headers.get('Accept', ''):
+                yield self._stream(bus, cursor, stand)
+                return
+
+            # Long-poll: ждать первого подходящего события не дольше timeout
+            deadline = time.time() + timeout
+            cursor, found = self._next(bus, cursor, stand)
+            while not found and time.time() < deadline:
+                try:
+                    yield gen.with_timeout(datetime.timedelta(seconds=deadline - time.time()), bus.wait(cursor))
+                except gen.TimeoutError:
+                    break
+                cursor, found = self._next(bus, cursor, stand)
+            self.finish({'cursor': cursor, 'events': found})
+        except DaemonException as e:
+            log.info(e)
+            self.finish(str(e))
+
+    @staticmethod
+    def _next(bus, cursor, stand):
+        """
+        :return: новый курсор и события стенда после cursor. События других стендов тоже сдвигают курсор
+        """
+        found = bus.since(cursor)
+        if found:
+            cursor = found[-1]['id']
+        return cursor, [e for e in found if stand is None or e['stand'] == stand]
+
+    @gen.coroutine
+    def _stream(self, bus, cursor, stand):
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        while 1:
+            try:
+                yield gen.with_timeout(datetime.timedelta(seconds=self.HEARTBEAT), bus.wait(cursor))
+            except gen.TimeoutError:
+                self.write(': ping\n\n')
+            cursor, found = self._next(bus, cursor, stand)
+            for event in found:
+                self.write('id: {}\nevent: {}\ndata: {}\n\n'.format(event['id'], event['type'], json.dumps(event)))
+            try:
+                yield self.flush()
+            except StreamClosedError:
+                return
+
+
 class HelpHandler(CommonHandler):
     def get(self):
         with open(os.path.join(os.path.dirname(__file__), 'web_handlers_help.html')) as f: